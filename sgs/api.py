@@ -0,0 +1,161 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     SGs server HTTP API (TCP and/or Unix socket)
+#     --------------------------------------------
+#
+#   POST /sms   {"imsi" | "msisdn", "from", "text"}, a list of them or {"messages": [...]}
+#   GET  /sms   MT SMS queue statistics
+#   GET  /trace current per-message logging switches
+#   POST /trace {"add": [imsi, ...], "remove": [...], "debug": bool, "sample_every": n}
+#   POST /jobs  {"job": "page_lai" | "alert" | "reset" | "detach", parameters..., "rate": n} (see server.bulk_operation)
+#   GET  /jobs  progress of running and recent jobs, GET /jobs/{id} of one, DELETE /jobs/{id} cancels it
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import logging
+
+from aiohttp import web
+
+from sgsap import encode_imsi
+
+
+def load_msisdn_map(path):
+    """'msisdn,imsi' per line (blank lines and # comments ignored) to {msisdn: imsi}."""
+    msisdn_map = {}
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                msisdn, imsi = [field.strip() for field in line.split(',')[:2]]
+                msisdn_map[msisdn.lstrip('+')] = imsi
+    return msisdn_map
+
+
+def create_app(mt_sms, trace, msisdn_map=None, jobs=None):
+    msisdn_map = msisdn_map or {}
+
+    def resolve(entry):
+        imsi = entry.get('imsi')
+        if imsi is None and entry.get('msisdn') is not None:
+            imsi = msisdn_map.get(str(entry['msisdn']).lstrip('+'))
+        if imsi is None or not str(imsi).isdigit():
+            return None
+        return encode_imsi(str(imsi))
+
+    async def submit_sms(request):
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="invalid JSON")
+        if isinstance(body, dict):
+            body = body.get('messages', [body])
+        if not isinstance(body, list):
+            raise web.HTTPBadRequest(text="expected a message or a list of messages")
+
+        accepted = 0
+        rejected = []
+        for index, entry in enumerate(body):
+            if not isinstance(entry, dict) or 'text' not in entry:
+                rejected.append({'index': index, 'reason': "missing text"})
+                continue
+            imsi = resolve(entry)
+            if imsi is None:
+                rejected.append({'index': index, 'reason': "unknown imsi/msisdn"})
+                continue
+            reason = mt_sms.submit(imsi, str(entry.get('from', 'SGs')), str(entry['text']))
+            if reason is None:
+                accepted += 1
+            else:
+                rejected.append({'index': index, 'reason': reason})
+        return web.json_response({'accepted': accepted, 'rejected': rejected})
+
+    async def sms_stats(request):
+        return web.json_response(dict(mt_sms.stats, subscribers=len(mt_sms.queues), active=mt_sms.active))
+
+    async def get_trace(request):
+        return web.json_response(trace.state())
+
+    async def set_trace(request):
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="invalid JSON")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text="expected {\"add\": [imsi, ...], \"remove\": [...], ...}")
+        lists = {key: body.get(key, []) for key in ('add', 'remove')}
+        for key, imsis in lists.items():
+            if not isinstance(imsis, list) or not all(str(imsi).isdigit() for imsi in imsis):
+                raise web.HTTPBadRequest(text="%s: expected a list of IMSIs (digits)" % key)
+        sample_every = body.get('sample_every')
+        if sample_every is not None and (isinstance(sample_every, bool) or not isinstance(sample_every, int)
+                                         or sample_every < 0):
+            raise web.HTTPBadRequest(text="sample_every: expected a number >= 0")
+        for imsi in lists['add']:
+            trace.add(encode_imsi(str(imsi)))
+        for imsi in lists['remove']:
+            trace.remove(encode_imsi(str(imsi)))
+        if 'debug' in body:
+            trace.set_debug(bool(body['debug']))
+        if sample_every is not None:
+            trace.set_sample(sample_every)
+        logging.info("trace: %s", trace.state())
+        return web.json_response(trace.state())
+
+    async def start_job(request):
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="invalid JSON")
+        if not isinstance(body, dict) or 'job' not in body:
+            raise web.HTTPBadRequest(text="expected {\"job\": name, ...}")
+        try:
+            rate = float(body['rate']) if body.get('rate') else None
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text="rate: expected a number")
+        try:
+            job = jobs.start(str(body['job']), body, rate)
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        return web.json_response(job.progress(), status=202)
+
+    async def list_jobs(request):
+        return web.json_response([job.progress() for job in jobs.jobs.values()])
+
+    def find_job(request):
+        job = jobs.jobs.get(int(request.match_info['id']))
+        if job is None:
+            raise web.HTTPNotFound(text="no such job")
+        return job
+
+    async def get_job(request):
+        return web.json_response(find_job(request).progress())
+
+    async def cancel_job(request):
+        job = find_job(request)
+        jobs.cancel(job.id)
+        return web.json_response(job.progress())
+
+    app = web.Application(client_max_size=16 * 1024 * 1024)
+    app.router.add_post('/sms', submit_sms)
+    app.router.add_get('/sms', sms_stats)
+    app.router.add_get('/trace', get_trace)
+    app.router.add_post('/trace', set_trace)
+    if jobs is not None:
+        app.router.add_post('/jobs', start_job)
+        app.router.add_get('/jobs', list_jobs)
+        app.router.add_get(r'/jobs/{id:\d+}', get_job)
+        app.router.add_delete(r'/jobs/{id:\d+}', cancel_job)
+    return app
+
+
+async def start_api(app, address=None, port=None, path=None):
+    """Serve app on address:port and/or a Unix socket path. Returns the runner (cleanup() to stop)."""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    if port:
+        await web.TCPSite(runner, address, port).start()
+        logging.info("API listening on %s:%s", address, port)
+    if path:
+        await web.UnixSite(runner, path).start()
+        logging.info("API listening on %s", path)
+    return runner
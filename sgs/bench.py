@@ -0,0 +1,580 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     Codec and state benchmarks, round-trip and fuzz checks
+#     ------------------------------------------------------
+#
+#   -> a corpus of MME -> MSS PDUs: combined LU with new and old LAI, MO SMS (7-bit, UCS2, concatenated),
+#      CP-ACK / RP-ACK, detaches, service request, UE unreachable, reset, and malformed buffers
+#   -> per benchmark: ns per call (median and best of --rounds) and, under tracemalloc, the peak
+#      bytes allocated by one call and the bytes still held per call afterwards
+#   -> round-trip checks on random input (BCD, IMSI, GSM 7-bit, user data, SMS-SUBMIT, SGsAP messages)
+#      and fuzzing of the decoders with random and mutated PDUs; seeded, so failures reproduce
+#   -> scenarios: message sequences run through handle_decode with the server's tasks running
+#   -> --save writes the results as a JSON baseline, --compare reads one and exits 1 when a benchmark's
+#      best round got slower than --tolerance or a check failed
+#   -> no baseline is kept in the repository: ns per call only compare on the same machine and Python,
+#      so save one there before a change and compare after it (bench.json is ignored by git)
+#
+#   python bench.py --save bench.json
+#   python bench.py --compare bench.json -k sgs_decode -k handle_decode
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from optparse import OptionParser
+
+from gsm0338 import decode_user_data, encode_user_data, ext, gsm, gsm_decode, gsm_encode, pack_septets, to_septets
+from mme_sim import location_update_request, mme_name, sms_submit, uplink_nas, uplink_sms
+from sgsap import (SPECS, SgsDecodeError, check, decode_bcd, decode_imsi, encode, encode_bcd, encode_imsi,
+                   encode_lai, sgs_decode)
+from sms import (CP_ACK, CP_DATA, RP_ACK_MS, RP_DATA_MS, TP_SMS_SUBMIT, build_cp_data, build_rp_data,
+                 encode_address, parse_cp_data, parse_tpdu)
+
+IMSI = encode_imsi('001010123456789')
+MME = mme_name()
+LAI = encode_lai('001', '01', 1)
+OLD_LAI = encode_lai('001', '01', 2)
+SMSC = '351962100000'
+DESTINATION = '+351966789203'
+TEXT_160 = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore '
+            'et dolore magna aliqua. Ut enim ad minim veniam, quis nos')
+TEXT_UCS2 = 'Olá, já chegaste? Ligo-te às 9h ✓'
+
+GSM_CHARACTERS = [c for c in gsm if c != '\x1b'] + [c for c in ext if c != '`']
+
+
+def concat_submit(mr, destination, text, reference, total, sequence):
+    """7-bit SMS-SUBMIT with an 8 bit reference concatenation header (6 octets, 1 fill bit)."""
+    septets = to_septets(text)
+    digits, toa, da = encode_address(destination)
+    ud = bytes([5, 0x00, 3, reference, total, sequence]) + pack_septets(septets, fill_bits=1)
+    return b''.join((bytes([TP_SMS_SUBMIT | 0x40, mr, digits, toa]), da, bytes([0x00, 0x00, 7 + len(septets)]), ud))
+
+
+def uplink_tpdu(imsi_ie, mr, tpdu):
+    """UPLINK-UNITDATA carrying CP-DATA / RP-DATA (MS -> network) with any TPDU."""
+    da = encode_bcd(SMSC)
+    rp = b''.join((bytes([RP_DATA_MS, mr, 0x00, len(da) + 1, 0x91]), da, bytes([len(tpdu)]), tpdu))
+    return uplink_nas(imsi_ie, bytes([0x09, CP_DATA, len(rp)]) + rp)
+
+
+def corpus():
+    """(well formed PDUs, malformed PDUs) as {name: bytes}."""
+    lu_combined = encode('location_update_request', imsi=IMSI[2:], mme_name=MME, eps_location_update_type=2,
+                         lai=LAI[2:], old_lai=OLD_LAI[2:], tmsi_status=1, imeisv=bytes.fromhex('5371040099998801'),
+                         tai=bytes.fromhex('00f1100001'), e_cgi=bytes.fromhex('00f11000000101'))
+    pdus = {
+        'lu_combined': lu_combined,
+        'lu_imsi_attach': location_update_request(IMSI, MME),
+        'mo_sms_gsm7': uplink_sms(IMSI, 1, SMSC, DESTINATION, 'load test'),
+        'mo_sms_gsm7_160': uplink_sms(IMSI, 2, SMSC, DESTINATION, TEXT_160),
+        'mo_sms_ucs2': uplink_sms(IMSI, 3, SMSC, DESTINATION, TEXT_UCS2),
+        'mo_sms_concat': uplink_tpdu(IMSI, 4, concat_submit(4, DESTINATION, TEXT_160[:153], 7, 2, 1)),
+        'cp_ack': uplink_nas(IMSI, bytes([0x89, CP_ACK])),
+        'rp_ack': uplink_nas(IMSI, bytes([0x89, CP_DATA, 2, RP_ACK_MS, 1])),
+        'eps_detach': encode('eps_detach_indication', imsi=IMSI[2:], mme_name=MME,
+                             imsi_detach_from_eps_service_type=1),
+        'imsi_detach': encode('imsi_detach_indication', imsi=IMSI[2:], mme_name=MME,
+                              imsi_detach_from_non_eps_service_type=1),
+        'service_request': encode('service_request', imsi=IMSI[2:], service_indicator=2),
+        'ue_unreachable': encode('ue_unreachable', imsi=IMSI[2:], sgs_cause=6),
+        'reset_indication': encode('reset_indication', mme_name=MME),
+    }
+    malformed = {
+        'empty': b'',
+        'truncated_ie_header': lu_combined + b'\x04',
+        'ie_overrun': lu_combined[:-2],
+        'missing_mandatory': b'\x09' + IMSI + b'\x09' + bytes([len(MME)]) + MME,
+        'unknown_type': b'\x63' + IMSI,
+        'bad_cp_data': uplink_nas(IMSI, bytes([0x09, CP_DATA, 0x40, RP_DATA_MS])),
+    }
+    return pdus, malformed
+
+
+class Bench:
+    """One benchmark: fn(*args) called in a loop."""
+
+    def __init__(self, name, fn, *args):
+        self.name = name
+        self.fn = fn
+        self.args = args
+
+    def loop(self, number):
+        fn, args = self.fn, self.args
+        started = time.perf_counter_ns()
+        for _ in itertools.repeat(None, number):
+            fn(*args)
+        return time.perf_counter_ns() - started
+
+    def run(self, rounds=5, round_time=0.05):
+        number = 1
+        while True:  # calls per round: enough for round_time
+            elapsed = self.loop(number)
+            if elapsed >= round_time * 1e9 / 4 or number >= 1 << 24:
+                break
+            number *= 4
+        number = max(1, int(number * round_time * 1e9 / max(elapsed, 1)))
+        per_call = sorted(self.loop(number) / number for _ in range(rounds))
+
+        calls = 200
+        tracemalloc.start()
+        self.fn(*self.args)
+        before, _ = tracemalloc.get_traced_memory()
+        peak = 0
+        for _ in range(calls):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            self.fn(*self.args)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+        after, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {'ns': round(statistics.median(per_call), 1), 'best_ns': round(per_call[0], 1), 'calls': number,
+                'peak_bytes': peak, 'retained_bytes': max(0, (after - before) // calls)}
+
+
+def decode_or_error(pdu):
+    try:
+        return sgs_decode(pdu)
+    except SgsDecodeError as e:
+        return e
+
+
+def handle_pair(handle, first, second, association):
+    handle(first, association)
+    return handle(second, association)
+
+
+def benchmarks(pdus, malformed):
+    """Every benchmark; handle_decode ones need server.init_state() first."""
+    import server
+    from capture import ReplayAssociation
+
+    benches = [Bench('sgs_decode:' + name, decode_or_error, pdu)
+               for name, pdu in itertools.chain(pdus.items(), malformed.items())]
+    benches.append(Bench('check:lu_combined', check, sgs_decode(pdus['lu_combined'])))
+    packed, _ = gsm_encode(TEXT_160)
+    benches += [
+        Bench('decode_bcd:imsi', decode_bcd, IMSI[3:]),
+        Bench('encode_bcd:imsi', encode_bcd, '01010123456789'),
+        Bench('decode_imsi', decode_imsi, IMSI),
+        Bench('encode_imsi', encode_imsi, '001010123456789'),
+        Bench('gsm_encode:network_name', gsm_encode, 'Open5GS'),
+        Bench('gsm_encode:160', gsm_encode, TEXT_160),
+        Bench('gsm_decode:160', gsm_decode, packed, len(TEXT_160)),
+    ]
+    for name in ('mo_sms_gsm7', 'mo_sms_gsm7_160', 'mo_sms_ucs2', 'mo_sms_concat'):
+        nas = bytes(sgs_decode(pdus[name]).value(22))
+        benches.append(Bench('parse_cp_data:' + name, parse_cp_data, nas))
+        benches.append(Bench('parse_tpdu:' + name, parse_tpdu, parse_cp_data(nas)['tpdu']))
+    benches.append(Bench('encode:location_update_accept', server.LOCATION_UPDATE_ACCEPT, IMSI[2:], LAI[2:],
+                         b'\xf4\x00\x00\x00\x01'))
+
+    association = ReplayAssociation(1)
+    for name in ('lu_combined', 'lu_imsi_attach', 'mo_sms_gsm7', 'mo_sms_gsm7_160', 'mo_sms_ucs2', 'mo_sms_concat',
+                 'cp_ack', 'rp_ack', 'service_request', 'reset_indication', 'bad_cp_data'):
+        pdu = pdus.get(name) or malformed[name]
+        benches.append(Bench('handle_decode:' + name, server.handle_decode, sgs_decode(pdu), association))
+    lu = sgs_decode(pdus['lu_imsi_attach'])
+    for name in ('eps_detach', 'imsi_detach', 'ue_unreachable'):  # each removes or marks the subscriber: LU first
+        benches.append(Bench('handle_decode:lu+' + name, handle_pair, server.handle_decode, lu,
+                             sgs_decode(pdus[name]), association))
+    return benches
+
+
+# Round-trip properties: prop(rng) returns None, or the input it failed on
+
+def random_digits(rng, low, high):
+    return ''.join(rng.choice('0123456789') for _ in range(rng.randint(low, high)))
+
+
+def random_text(rng, high, gsm_only):
+    if gsm_only:
+        return ''.join(rng.choice(GSM_CHARACTERS) for _ in range(rng.randint(0, high)))
+    return ''.join(chr(rng.randint(0x20, 0xd7ff)) for _ in range(rng.randint(1, high)))
+
+
+def prop_bcd(rng):
+    digits = random_digits(rng, 1, 20)
+    return None if decode_bcd(encode_bcd(digits)) == digits else digits
+
+
+def prop_imsi(rng):
+    digits = random_digits(rng, 6, 15)
+    return None if decode_imsi(encode_imsi(digits)) == digits else digits
+
+
+def prop_gsm7(rng):
+    text = random_text(rng, 200, True)
+    packed, spare = gsm_encode(text)
+    septets = len(to_septets(text))
+    ok = gsm_decode(packed, septets) == text and len(packed) * 8 - septets * 7 == spare
+    return None if ok else text
+
+
+def prop_user_data(rng):
+    text = random_text(rng, 120, rng.random() < 0.5)
+    dcs, udl, ud = encode_user_data(text)
+    return None if decode_user_data(dcs, udl, ud) == text else text
+
+
+def prop_sms_submit(rng):
+    mr, destination = rng.randint(0, 255), '+' + random_digits(rng, 3, 15)
+    if rng.random() < 0.3:
+        text, concat = random_text(rng, 153, True), (rng.randint(0, 255), rng.randint(2, 5), rng.randint(1, 2))
+        tpdu = concat_submit(mr, destination, text, *concat)
+    else:
+        gsm_only = rng.random() < 0.5
+        text, concat = random_text(rng, 160 if gsm_only else 70, gsm_only), None
+        tpdu = sms_submit(mr, destination, text)
+    tpdu = parse_cp_data(sgs_decode(uplink_tpdu(IMSI, mr, tpdu)).value(22))['tpdu']
+    parsed = parse_tpdu(tpdu)
+    ok = (parsed['TP-MR'], parsed['TP-DA'], parsed['SMS Text'], parsed['Concatenation']) == (mr, destination, text,
+                                                                                              concat)
+    return None if ok else (mr, destination, text, concat)
+
+
+def prop_rp_data(rng):
+    ti, mr, smsc = rng.randint(0, 6), rng.randint(0, 255), random_digits(rng, 3, 16)
+    tpdu = bytes(rng.randint(0, 255) for _ in range(rng.randint(0, 140)))
+    cp = parse_cp_data(build_cp_data(ti, build_rp_data(mr, smsc, tpdu)))
+    return None if (cp['ti'], cp['rp_mr']) == (ti, mr) else (ti, mr, smsc, tpdu.hex())
+
+
+SPEC_LIST = sorted({spec.type: spec for spec in SPECS.values()}.values(), key=lambda spec: spec.type)
+
+
+def prop_sgsap(rng):
+    """encode() of a random message with random IE contents, then sgs_decode(): same IEs in the same order."""
+    spec = rng.choice(SPEC_LIST)
+    values = {}
+    for field, (_, _, size, mandatory) in spec.fields.items():
+        if mandatory or rng.random() < 0.5:
+            length = size if size is not None else rng.randint(1 if mandatory else 0, 40)  # see check()
+            values[field] = bytes(rng.randint(0, 255) for _ in range(length))
+    if 'old_lai' in values and 'lai' not in values:
+        del values['old_lai']
+    expected = sorted(((spec.fields[field][0], spec.fields[field][1], value) for field, value in values.items()))
+    pdu = sgs_decode(encode(spec.name, **values))
+    offsets = sorted(list(pdu.ies.items()) + list(pdu.repeated or ()), key=lambda ie: ie[1])
+    decoded = [(iei, bytes(pdu.buf[offset + 2:offset + 2 + pdu.buf[offset + 1]])) for iei, offset in offsets]
+    ok = pdu.type == spec.type and check(pdu) is None and decoded == [(iei, value) for _, iei, value in expected]
+    return None if ok else (spec.name, {field: value.hex() for field, value in values.items()})
+
+
+PROPERTIES = {'bcd': prop_bcd, 'imsi': prop_imsi, 'gsm7': prop_gsm7, 'user_data': prop_user_data,
+              'sms_submit': prop_sms_submit, 'rp_data': prop_rp_data, 'sgsap': prop_sgsap}
+
+
+# Scenarios: scenario(rng) returns None, or what went wrong
+
+class ScenarioAssociation:
+    """Stands in for server.Association; keeps what is written to it."""
+
+    def __init__(self):
+        self.mmes = set()
+        self.closed = False
+        self.sent = []
+
+    def write(self, message_list):
+        self.sent += [pdu for pdu in message_list if pdu is not None]
+        return True
+
+    def take(self, message_type):
+        """Remove and return the PDUs of one type written so far."""
+        found = [pdu for pdu in self.sent if pdu[0] == message_type]
+        self.sent = [pdu for pdu in self.sent if pdu[0] != message_type]
+        return found
+
+
+async def wait_for_pdu(association, message_type, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        found = association.take(message_type)
+        if found:
+            return found
+        await asyncio.sleep(0.01)
+    return []
+
+
+async def mt_store_resume(path):
+    import server
+
+    server.init_state(server.option_parser().parse_args(['--mt-store', path])[0])
+    store = server.mt_store
+    tasks = [server.mt_sms.start(), store.start()]
+    association = ScenarioAssociation()
+
+    def handle(pdu):  # as Association.handle: the answers go out on the association
+        association.write(server.handle_decode(sgs_decode(pdu), association))
+
+    try:
+        handle(location_update_request(IMSI, MME))
+        if server.mt_sms.submit(IMSI, DESTINATION, "stored") is not None:
+            return "MT SMS not accepted"
+        if not await wait_for_pdu(association, 1):
+            return "no PAGING-REQUEST for the MT SMS"
+        handle(encode('ue_unreachable', imsi=IMSI[2:], sgs_cause=6))
+        if len(store) != 1 or IMSI not in server.subscribers:
+            return "after UE-UNREACHABLE: %d stored, subscriber %s" % (
+                len(store), "kept" if IMSI in server.subscribers else "gone")
+
+        handle(encode('ue_activity_indication', imsi=IMSI[2:]))
+        if not await wait_for_pdu(association, 1):
+            return "no PAGING-REQUEST after UE-ACTIVITY-INDICATION"
+        handle(encode('service_request', imsi=IMSI[2:], service_indicator=2))
+        unitdata = association.take(7)
+        if len(unitdata) != 1:
+            return "%d DOWNLINK-UNITDATA after SERVICE-REQUEST" % len(unitdata)
+        nas = sgs_decode(unitdata[0]).value(22)
+        ti = nas[0] & 0x70 | 0x80 | 0x09
+        rp = bytes([RP_ACK_MS, nas[4]])
+        handle(uplink_nas(IMSI, bytes([ti, CP_DATA, len(rp)]) + rp))
+        if server.mt_sms.stats['delivered'] != 1 or server.mt_sms.stats['resumed'] != 1:
+            return "not delivered: %s" % server.mt_sms.stats
+    finally:
+        for task in tasks:
+            task.cancel()
+        await store.close()
+    return None
+
+
+def scenario_mt_store(rng):
+    """MT SMS in paging when UE-UNREACHABLE (31) arrives: stored, paged again on UE-ACTIVITY-INDICATION (16),
+    delivered and deleted from the store on RP-ACK."""
+    import server
+    from mt_store import MtStore
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'mt.db')
+        try:
+            failure = asyncio.run(mt_store_resume(path))
+        finally:
+            server.init_state(server.option_parser().parse_args([])[0])
+        if failure is None:
+            store = MtStore(path)
+            store.open()
+            left = store.db.execute("SELECT count(*) FROM messages").fetchone()[0]
+            store.db.close()
+            if left:
+                failure = "%d message(s) left in the store after delivery" % left
+    return failure
+
+
+def scenario_alert_ack(rng):
+    """ALERT-REQUEST (13) answered by ALERT-ACK (14): no longer pending, counted as answered."""
+    import server
+    from paging import ALERT
+
+    server.init_state(server.option_parser().parse_args([])[0])
+    association = ScenarioAssociation()
+    association.write(server.handle_decode(sgs_decode(location_update_request(IMSI, MME)), association))
+    if not server.pending.start(ALERT, IMSI, server.ALERT_REQUEST(IMSI[2:])):
+        return "ALERT-REQUEST not sent"
+    server.handle_decode(sgs_decode(encode('alert_ack', imsi=IMSI[2:])), association)
+    stats = server.pending.stats
+    failure = None if stats['answered'] == 1 and not len(server.pending) else "after ALERT-ACK: %s" % stats
+    server.init_state(server.option_parser().parse_args([])[0])
+    return failure
+
+
+def scenario_late_verdict(rng):
+    """PyHSS accepts a location update after its association went down: the MME is not bound to the dead
+    association, so the next message of one of its subscribers rebinds it."""
+    import server
+    from hss import ACCEPT
+
+    server.init_state(server.option_parser().parse_args([])[0])
+    association = ScenarioAssociation()
+    association.write(server.handle_decode(sgs_decode(location_update_request(IMSI, MME)), association))
+    association.sent.clear()
+    association.closed = True
+    server.unbind_association(association)
+    mme_ie = b'\x09' + bytes([len(MME)]) + MME
+    server.location_update_authorized(encode_imsi('001010123456780'), LAI, mme_ie, association, ACCEPT)
+    failure = None
+    if mme_ie not in server.unbound_mmes or server.mme_associations.get(mme_ie) is association:
+        failure = "MME bound to the closed association"
+    elif association.sent:
+        failure = "%d PDU(s) written to the closed association" % len(association.sent)
+    server.init_state(server.option_parser().parse_args([])[0])
+    return failure
+
+
+SCENARIOS = {'mt_store_resume': scenario_mt_store, 'alert_ack': scenario_alert_ack,
+             'late_verdict': scenario_late_verdict}
+
+
+# Fuzz targets: target(pdu) raises only what the server expects from it
+
+def fuzz_sgs_decode(pdu):
+    """Decodes or raises SgsDecodeError; every IE lies inside the buffer."""
+    try:
+        decode = sgs_decode(pdu)
+    except SgsDecodeError:
+        return
+    for iei, offset in itertools.chain(decode.ies.items(), decode.repeated or ()):
+        if offset + 2 + pdu[offset + 1] > len(pdu):
+            raise AssertionError("IE %d at %d overruns the PDU" % (iei, offset))
+
+
+def fuzz_sms(pdu):
+    """As handle_decode parses NAS containers: only IndexError / ValueError are caught there."""
+    try:
+        decode = sgs_decode(pdu)
+    except SgsDecodeError:
+        return
+    if 22 in decode:
+        try:
+            cp = parse_cp_data(decode.value(22))
+            if 'tpdu' in cp:
+                parse_tpdu(cp['tpdu'])
+        except (IndexError, ValueError):
+            pass
+
+
+def fuzz_handle_decode(pdu):
+    """PDUs that get past sgs_decode and check() must not make handle_decode raise (the reader task would end)."""
+    import server
+    from capture import ReplayAssociation
+
+    try:
+        decode = sgs_decode(pdu)
+    except SgsDecodeError:
+        return
+    if check(decode) is None:
+        server.handle_decode(decode, ReplayAssociation(2))
+
+
+FUZZ_TARGETS = {'sgs_decode': fuzz_sgs_decode, 'sms': fuzz_sms, 'handle_decode': fuzz_handle_decode}
+
+
+def mutate(rng, pdu):
+    """Random bytes, or a corpus PDU with a flipped byte, a length octet changed, a cut or an insertion."""
+    choice = rng.randrange(5)
+    if choice == 0 or not pdu:
+        return bytes(rng.randint(0, 255) for _ in range(rng.randint(0, 64)))
+    buf = bytearray(pdu)
+    position = rng.randrange(len(buf))
+    if choice == 1:
+        buf[position] ^= 1 << rng.randrange(8)
+    elif choice == 2:
+        buf[position] = rng.choice((0, 1, 2, 5, 0x7f, 0xff, buf[position] + 1 & 0xff, buf[position] - 1 & 0xff))
+    elif choice == 3:
+        del buf[position:]
+    else:
+        buf[position:position] = bytes(rng.randint(0, 255) for _ in range(rng.randint(1, 8)))
+    return bytes(buf)
+
+
+def run_checks(rng, cases, fuzz_cases, pdus, keep=5):
+    """{name: {'cases': n, 'failures': [...]}} for every property and fuzz target."""
+    results = {}
+    seeds = list(pdus.values())
+    runs = [('roundtrip:' + name, prop, cases) for name, prop in PROPERTIES.items()]
+    runs += [('fuzz:' + name, target, fuzz_cases) for name, target in FUZZ_TARGETS.items()]
+    runs += [('scenario:' + name, scenario, 1) for name, scenario in SCENARIOS.items()]
+    for name, fn, count in runs:
+        failures = []
+        for _ in range(count):
+            if name.startswith('fuzz:'):
+                pdu = mutate(rng, rng.choice(seeds))
+                try:
+                    fn(pdu)
+                    failure = None
+                except Exception as e:
+                    failure = "%s: %r" % (pdu.hex(), e)
+            else:
+                try:
+                    failure = fn(rng)
+                except Exception as e:
+                    failure = "%r" % e
+            if failure is not None and len(failures) < keep:
+                failures.append(str(failure))
+            elif failure is not None:
+                break
+        results[name] = {'cases': count, 'failures': failures}
+    return results
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-k", dest="only", action="append", default=[],
+                      help="only benchmarks whose name contains this (repeatable)")
+    parser.add_option("--rounds", dest="rounds", type="int", default=5, help="timed rounds per benchmark")
+    parser.add_option("--round-time", dest="round_time", type="float", default=0.05, help="seconds per round")
+    parser.add_option("--cases", dest="cases", type="int", default=2000, help="random cases per round-trip property")
+    parser.add_option("--fuzz", dest="fuzz", type="int", default=20000, help="inputs per fuzz target")
+    parser.add_option("--seed", dest="seed", type="int", default=1, help="random seed of checks and fuzzing")
+    parser.add_option("--no-checks", dest="checks", action="store_false", default=True,
+                      help="benchmarks only, no round-trip, fuzz and scenario checks")
+    parser.add_option("--save", dest="save", default=None, help="write the results to this JSON file")
+    parser.add_option("--compare", dest="compare", default=None, help="baseline JSON file to compare with")
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=0.25,
+                      help="slowdown against the baseline that counts as a regression (0.25: 25%)")
+    (options, args) = parser.parse_args()
+
+    import server
+
+    server.init_state(server.option_parser().parse_args([])[0])
+    logging.disable(logging.CRITICAL)  # the handlers log rejects and resets, not wanted in timings
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+
+    pdus, malformed = corpus()
+    results = {}
+    print("%-36s %10s %10s %8s %8s %10s %8s" % ("benchmark", "ns/call", "best", "peak B", "held B", "baseline",
+                                                 "delta"))
+    regressions = []
+    for bench in benchmarks(pdus, malformed):
+        if options.only and not any(pattern in bench.name for pattern in options.only):
+            continue
+        result = results[bench.name] = bench.run(options.rounds, options.round_time)
+        previous = baseline['benchmarks'].get(bench.name) if baseline else None
+        if previous:
+            delta = result['best_ns'] / previous['best_ns'] - 1  # best of the rounds: least noisy
+            if delta > options.tolerance:
+                regressions.append(bench.name)
+            reference = "%10.1f %+7.1f%%" % (previous['best_ns'], delta * 100)
+        else:
+            reference = ""
+        print("%-36s %10.1f %10.1f %8d %8d %s" % (bench.name, result['ns'], result['best_ns'], result['peak_bytes'],
+                                                 result['retained_bytes'], reference))
+
+    checks = {}
+    if options.checks:
+        checks = run_checks(random.Random(options.seed), options.cases, options.fuzz, dict(pdus, **malformed))
+        for name, check_result in checks.items():
+            print("%-36s %d cases, %s" % (name, check_result['cases'], "%d failed" % len(check_result['failures'])
+                                          if check_result['failures'] else "ok"))
+            for failure in check_result['failures']:
+                print("    %s" % failure)
+    failed = [name for name, check_result in checks.items() if check_result['failures']]
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'implementation': platform.python_implementation(),
+                       'machine': platform.machine(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'seed': options.seed, 'benchmarks': results, 'checks': checks}, f, indent=1, sort_keys=True)
+        print("results written to %s" % options.save)
+    if regressions:
+        print("slower than the baseline by more than %d%%: %s" % (options.tolerance * 100, ", ".join(regressions)))
+    if failed:
+        print("failed checks: %s" % ", ".join(failed))
+    sys.exit(1 if regressions or failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     SMS charging events to CGRateS
+#     ------------------------------
+#
+#   -> record() appends a tuple to an in-memory ring and returns: the SGs answer (RP-ACK) never waits
+#   -> a background task turns up to batch_size events into CDRsV1.ProcessEvent calls (*sms ToR) and
+#      sends them as one JSON-RPC batch; a server that answers a batch with anything but a list of
+#      responses gets the calls one by one (concurrently) from then on
+#   -> CGRateS unreachable or failing: the events go to an append-only spill file (one JSON-RPC call
+#      per line) without further attempts until a backoff expires; the file is resent in batches once
+#      CGRateS answers again (or at start, when an earlier run left one)
+#   -> OriginID is unique per event, so an event sent twice (spill resent after a partial failure)
+#      is recognised by CGRateS as the same CDR
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+from collections import deque
+
+import aiohttp
+
+MO, MT = 'mo', 'mt'
+
+
+class SmsEvents:
+    def __init__(self, url, spill_path, tenant='cgrates.org', flags=('*rals',), ring_size=100000, batch_size=200,
+                 interval=1.0, timeout=5.0, concurrency=16):
+        self.url = url
+        self.spill_path = spill_path
+        self.tenant = tenant
+        self.flags = list(flags)
+        self.ring = deque(maxlen=ring_size)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.batching = True  # until the server shows it does not take JSON-RPC batches
+        self.backlog = os.path.exists(spill_path)  # events in the spill file
+
+        self.origin = "sgs-%d-%d" % (os.getpid(), time.time())  # OriginID prefix, unique per process
+        self.ids = itertools.count(1)
+        self.session = None
+        self.wakeup = None
+        self.task = None
+        self.stats = {'recorded': 0, 'sent': 0, 'rejected': 0, 'spilled': 0, 'resent': 0, 'dropped': 0,
+                      'requests': 0}
+
+    def record(self, kind, imsi, account, destination):
+        """One SMS event, MSISDNs where known, else IMSIs. MO (submitted): account is the sender and
+        destination the TP-DA. MT (delivered): account is the receiving subscriber, destination the originator."""
+        if len(self.ring) == self.ring.maxlen:
+            self.stats['dropped'] += 1  # deque drops the oldest event
+        self.ring.append((kind, imsi, account, destination, time.time(), next(self.ids)))
+        self.stats['recorded'] += 1
+        if len(self.ring) >= self.batch_size and self.wakeup is not None and not self.wakeup.done():
+            self.wakeup.set_result(None)
+
+    def depth(self):
+        return len(self.ring)
+
+    def start(self):
+        """Open the session and start the flusher (call from the running loop)."""
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        return self.task
+
+    async def close(self):
+        """Stop the flusher and send (or spill) what is left."""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        while self.ring:
+            if not await self.flush():  # CGRateS down: no more attempts, spill the rest
+                await self.spill([self.call(event) for event in self.ring])
+                self.ring.clear()
+        if self.session is not None:
+            await self.session.close()
+
+    def call(self, event):
+        kind, imsi, account, destination, stamp, number = event
+        setup_time = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(stamp))
+        return {'jsonrpc': '2.0', 'id': number, 'method': 'CDRsV1.ProcessEvent', 'params': [{
+            'Flags': self.flags,
+            'CGREvent': {
+                'Tenant': self.tenant,
+                'ID': "%s-%d" % (self.origin, number),
+                'Event': {
+                    'ToR': '*sms', 'OriginID': "%s-%d" % (self.origin, number), 'OriginHost': 'sgs',
+                    'Source': 'SGs', 'RequestType': '*postpaid', 'Tenant': self.tenant,
+                    'Category': 'sms' if kind == MO else 'sms_mt', 'Account': account, 'Subject': account,
+                    'Destination': destination, 'SetupTime': setup_time, 'AnswerTime': setup_time, 'Usage': 1,
+                    'IMSI': imsi,
+                },
+            },
+        }]}
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        backoff = 0.0
+        retry_at = 0.0
+        while True:
+            if len(self.ring) < self.batch_size:
+                self.wakeup = loop.create_future()
+                try:
+                    await asyncio.wait_for(self.wakeup, self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup = None
+            if backoff and time.monotonic() < retry_at:  # CGRateS down: straight to the spill file
+                await self.spill(self.take())
+                continue
+            if self.ring:
+                up = await self.flush()
+            elif self.backlog:
+                up = await self.resend_spill()
+            else:
+                continue
+            if not up:
+                backoff = min(max(backoff * 2, self.interval), 30.0)
+                retry_at = time.monotonic() + backoff
+                continue
+            backoff = 0.0
+            if self.backlog:
+                await self.resend_spill()
+
+    def take(self):
+        """Calls for up to batch_size events from the ring."""
+        return [self.call(self.ring.popleft()) for _ in range(min(self.batch_size, len(self.ring)))]
+
+    async def flush(self):
+        """Send up to batch_size events, spill what did not get through. False when nothing did."""
+        calls = self.take()
+        if not calls:
+            return True
+        unsent = await self.send(calls)
+        await self.spill(unsent)
+        return len(unsent) < len(calls)
+
+    async def send(self, calls):
+        """The calls CGRateS could not be reached for (failures it reports per call are logged, not retried)."""
+        if self.batching:
+            responses = await self.post(calls)
+            if responses is None:
+                return calls
+            if isinstance(responses, list):
+                self.count(responses)
+                return []
+            self.batching = False
+            logging.info("CGRateS at %s does not take JSON-RPC batches, sending events one by one", self.url)
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def single(call):
+            async with slots:
+                return await self.post(call)
+        responses = await asyncio.gather(*[single(call) for call in calls])
+        self.count([response for response in responses if response is not None])
+        return [call for call, response in zip(calls, responses) if response is None]
+
+    async def post(self, body):
+        """Decoded JSON answer, or None when CGRateS could not be reached or failed."""
+        self.stats['requests'] += 1
+        try:
+            async with self.session.post(self.url, json=body) as response:
+                if response.status >= 500:
+                    logging.warning("CGRateS error %s: %s", response.status, (await response.text())[:200])
+                    return None
+                try:
+                    return await response.json(content_type=None)
+                except ValueError:
+                    return {'error': "HTTP %d, not JSON" % response.status}
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning("CGRateS request failed: %r", e)
+            return None
+
+    def count(self, responses):
+        for response in responses:
+            if isinstance(response, dict) and response.get('error') is None:
+                self.stats['sent'] += 1
+            else:
+                self.stats['rejected'] += 1
+                logging.warning("CGRateS rejected SMS event: %s", str(response)[:200])
+
+    async def spill(self, calls):
+        if not calls:
+            return
+        data = ''.join(json.dumps(call, separators=(',', ':')) + '\n' for call in calls)
+        self.backlog = True
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._append, self.spill_path, data)
+            self.stats['spilled'] += len(calls)
+        except OSError as e:
+            self.stats['dropped'] += len(calls)
+            logging.error("SMS events lost, cannot write %s: %s", self.spill_path, e)
+
+    @staticmethod
+    def _append(path, data):
+        with open(path, 'a') as f:
+            f.write(data)
+
+    async def resend_spill(self):
+        """Send the spill file in batches, until one fails; the rest goes to a new spill file.
+        False when CGRateS took none of it."""
+        sending = self.spill_path + '.sending'
+        self.backlog = False
+        try:
+            if not os.path.exists(sending):  # else left by a resend that was interrupted
+                os.rename(self.spill_path, sending)
+            lines = await asyncio.get_running_loop().run_in_executor(None, self._read_lines, sending)
+        except FileNotFoundError:
+            return True
+        calls = []
+        for line in lines:
+            try:
+                calls.append(json.loads(line))
+            except ValueError:
+                logging.warning("unreadable line in %s skipped", sending)
+        logging.info("resending %d spilled SMS events", len(calls))
+        up = True
+        resent = 0
+        for offset in range(0, len(calls), self.batch_size):
+            batch = calls[offset:offset + self.batch_size]
+            unsent = await self.send(batch) if up else batch
+            up = len(unsent) < len(batch)
+            resent += len(batch) - len(unsent)
+            await self.spill(unsent)
+        os.remove(sending)
+        self.stats['resent'] += resent
+        return resent > 0 or not calls
+
+    @staticmethod
+    def _read_lines(path):
+        with open(path) as f:
+            return [line for line in f if line.strip()]
@@ -0,0 +1,276 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     SGsAP capture: record, import from pcap, replay
+#     -----------------------------------------------
+#
+#   -> file: 8 byte magic, then per received PDU a 12 byte header
+#      (unix time float64, association id uint16, length uint16) and the raw PDU
+#   -> server.py --record FILE (or "record FILE" / "record off" on stdin) writes MME -> MSS PDUs
+#   -> pcap import takes SCTP DATA chunks towards the SGs port, fragments reassembled per stream
+#   -> replay runs the PDUs through sgs_decode / handle_decode, as fast as possible or at the
+#      recorded pace, optionally under cProfile
+#
+#   python capture.py import trace.pcap storm.sgs
+#   python capture.py replay storm.sgs --repeat 10 --profile storm.prof
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import socket
+import struct
+import sys
+import time
+from optparse import OptionParser
+
+MAGIC = b'SGSCAP01'
+RECORD = struct.Struct('!dHH')
+SGS_PORT = 29118
+
+
+class Recorder:
+    """Appends received PDUs to a capture file through a large write buffer."""
+
+    def __init__(self, path, buffer_size=1 << 20):
+        self.path = path
+        self.file = open(path, 'wb', buffering=buffer_size)
+        self.file.write(MAGIC)
+        self.count = 0
+
+    def record(self, association_id, pdu, now=None):
+        self.file.write(RECORD.pack(time.time() if now is None else now, association_id, len(pdu)))
+        self.file.write(pdu)
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """Yields (timestamp, association id, pdu) from a capture file."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not an SGs capture" % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, association_id, length = RECORD.unpack(header)
+            pdu = f.read(length)
+            if len(pdu) < length:
+                return  # truncated by a crash while recording
+            yield timestamp, association_id, pdu
+
+
+# pcap link types
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+
+def _ip_payload(linktype, frame):
+    """(source, destination, protocol, payload) of an IPv4/IPv6 packet in a captured frame, or None."""
+    if linktype == LINKTYPE_ETHERNET:
+        ethertype, offset = frame[12] << 8 | frame[13], 14
+        while ethertype in (0x8100, 0x88a8):  # VLAN tags
+            ethertype, offset = frame[offset + 2] << 8 | frame[offset + 3], offset + 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ethertype, offset = frame[14] << 8 | frame[15], 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        ethertype, offset = frame[0] << 8 | frame[1], 20
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        ethertype, offset = (0x0800 if frame[0] >> 4 == 4 else 0x86dd), 0
+    else:
+        raise ValueError("unsupported pcap link type %d" % linktype)
+
+    if ethertype == 0x0800:
+        header_length = (frame[offset] & 0x0f) * 4
+        total = frame[offset + 2] << 8 | frame[offset + 3]
+        if frame[offset + 6] & 0x3f or frame[offset + 7]:  # IP fragment
+            return None
+        return (socket.inet_ntop(socket.AF_INET, frame[offset + 12:offset + 16]),
+                socket.inet_ntop(socket.AF_INET, frame[offset + 16:offset + 20]),
+                frame[offset + 9], frame[offset + header_length:offset + total])
+    if ethertype == 0x86dd:  # extension headers are not followed
+        length = frame[offset + 4] << 8 | frame[offset + 5]
+        return (socket.inet_ntop(socket.AF_INET6, frame[offset + 8:offset + 24]),
+                socket.inet_ntop(socket.AF_INET6, frame[offset + 24:offset + 40]),
+                frame[offset + 6], frame[offset + 40:offset + 40 + length])
+    return None
+
+
+def read_pcap(path):
+    """Yields (timestamp, linktype, frame) from a classic (not pcapng) capture."""
+    with open(path, 'rb') as f:
+        header = f.read(24)
+        magic = header[:4]
+        if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+            endian = '<'
+        elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+            endian = '>'
+        else:
+            raise ValueError("%s is not a pcap file (pcapng must be converted with editcap -F pcap)" % path)
+        scale = 1e-9 if magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d') else 1e-6
+        linktype = struct.unpack(endian + 'I', header[20:24])[0] & 0x0fffffff
+        packet = struct.Struct(endian + 'IIII')
+        while True:
+            record = f.read(packet.size)
+            if len(record) < packet.size:
+                return
+            seconds, fraction, captured, _ = packet.unpack(record)
+            frame = f.read(captured)
+            if len(frame) < captured:
+                return
+            yield seconds + fraction * scale, linktype, frame
+
+
+def import_pcap(path, port=SGS_PORT):
+    """Yields (timestamp, association id, pdu) for SCTP DATA towards port, in capture order.
+
+    Associations are numbered by (source, source port, destination) in order of appearance.
+    """
+    associations = {}
+    fragments = {}  # (association id, stream) -> [chunks]
+    for timestamp, linktype, frame in read_pcap(path):
+        packet = _ip_payload(linktype, frame)
+        if packet is None or packet[2] != 132 or len(packet[3]) < 12:
+            continue
+        source, destination, _, sctp = packet
+        source_port, destination_port = struct.unpack('!HH', sctp[:4])
+        if destination_port != port:
+            continue
+        key = (source, source_port, destination)
+        association_id = associations.setdefault(key, len(associations))
+
+        offset = 12
+        while offset + 4 <= len(sctp):
+            chunk_type, flags, length = struct.unpack('!BBH', sctp[offset:offset + 4])
+            if length < 4:
+                break
+            if chunk_type == 0 and length >= 16:  # DATA: TSN, stream, SSN, PPID, then user data
+                stream = sctp[offset + 8] << 8 | sctp[offset + 9]
+                data = sctp[offset + 16:offset + length]
+                if flags & 0x03 == 0x03:  # unfragmented
+                    yield timestamp, association_id, bytes(data)
+                else:
+                    parts = fragments.setdefault((association_id, stream), [])
+                    if flags & 0x02:  # first fragment
+                        parts.clear()
+                    parts.append(bytes(data))
+                    if flags & 0x01:  # last fragment
+                        yield timestamp, association_id, b''.join(parts)
+                        del fragments[(association_id, stream)]
+            offset += (length + 3) & ~3
+
+
+class ReplayAssociation:
+    """Stands in for server.Association while replaying; answers are only counted."""
+
+    def __init__(self, association_id):
+        self.id = association_id
+        self.mmes = set()
+
+    def __repr__(self):
+        return "replay#%d" % self.id
+
+
+def replay(records, paced=False, speed=1.0, profile=None):
+    """Run (timestamp, association id, pdu) records through the server's decode and handling code.
+
+    Returns a summary dict. profile is a cProfile.Profile to enable around the handling only.
+    """
+    import server
+    from sgsap import SgsDecodeError, sgs_decode
+
+    associations = {}
+    messages = malformed = answers = 0
+    first = None
+    started = time.perf_counter()
+    if profile is not None:
+        profile.enable()
+    for timestamp, association_id, pdu in records:
+        if paced:
+            if first is None:
+                first = timestamp
+            delay = (timestamp - first) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+        association = associations.get(association_id)
+        if association is None:
+            association = associations[association_id] = ReplayAssociation(association_id)
+        messages += 1
+        try:
+            decode = sgs_decode(pdu)
+        except SgsDecodeError:
+            malformed += 1
+            continue
+        answers += len(server.handle_decode(decode, association)) - 1
+    if profile is not None:
+        profile.disable()
+    elapsed = time.perf_counter() - started
+    return {'messages': messages, 'malformed': malformed, 'answers': answers, 'seconds': elapsed,
+            'messages_per_s': messages / elapsed if elapsed else 0.0, 'subscribers': len(server.subscribers)}
+
+
+def main():
+    parser = OptionParser(usage="%prog import PCAP CAPTURE | info CAPTURE | replay CAPTURE [options]")
+    parser.add_option("--port", dest="port", type="int", default=SGS_PORT, help="SGs SCTP port (import)")
+    parser.add_option("--paced", dest="paced", action="store_true", default=False,
+                      help="replay at the recorded pace instead of as fast as possible")
+    parser.add_option("--speed", dest="speed", type="float", default=1.0, help="pace multiplier with --paced")
+    parser.add_option("--repeat", dest="repeat", type="int", default=1, help="replay the capture N times")
+    parser.add_option("--profile", dest="profile", default=None,
+                      help="cProfile the replay; '-' prints the top functions, else dump stats to this file")
+    (options, args) = parser.parse_args()
+
+    if args[:1] == ['import'] and len(args) == 3:
+        recorder = Recorder(args[2])
+        for timestamp, association_id, pdu in import_pcap(args[1], options.port):
+            recorder.record(association_id, pdu, timestamp)
+        recorder.close()
+        print("%d PDUs written to %s" % (recorder.count, args[2]))
+
+    elif args[:1] == ['info'] and len(args) == 2:
+        count = size = 0
+        first = last = None
+        types = {}
+        for timestamp, association_id, pdu in read_capture(args[1]):
+            count += 1
+            size += len(pdu)
+            first = timestamp if first is None else first
+            last = timestamp
+            if pdu:
+                types[pdu[0]] = types.get(pdu[0], 0) + 1
+        print("%d PDUs, %d bytes, %.1f s, types %s" % (count, size, (last - first) if count else 0.0,
+                                                        dict(sorted(types.items()))))
+
+    elif args[:1] == ['replay'] and len(args) == 2:
+        import server
+
+        server.init_state(server.option_parser().parse_args([])[0])
+        records = list(read_capture(args[1])) * options.repeat
+        profile = None
+        if options.profile:
+            import cProfile
+            profile = cProfile.Profile()
+        summary = replay(records, options.paced, options.speed, profile)
+        print("%(messages)d messages (%(malformed)d malformed, %(answers)d answers) in %(seconds).3f s, "
+              "%(messages_per_s).0f msg/s, %(subscribers)d subscribers" % summary)
+        if profile is not None:
+            if options.profile == '-':
+                import pstats
+                pstats.Stats(profile, stream=sys.stdout).sort_stats('cumulative').print_stats(30)
+            else:
+                profile.dump_stats(options.profile)
+                print("profile written to %s" % options.profile)
+
+    else:
+        parser.error("unknown command")
+
+
+if __name__ == "__main__":
+    main()
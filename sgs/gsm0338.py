@@ -0,0 +1,147 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     GSM 03.38 / 23.038 text codec
+#     -----------------------------
+#
+#   -> default alphabet + extension table, packed 7-bit (little endian septets)
+#   -> UCS2 for text outside the GSM alphabet
+#   -> encode and decode are table lookups, no per-bit string handling
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+gsm = (
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+ext = (
+    "````````````````````^```````````````````{}`````\\````````````[~]`|````````````````````````````````````€``````````````````````````")
+
+ESC = 0x1b
+
+DCS_GSM7 = 0x00
+DCS_8BIT = 0x04
+DCS_UCS2 = 0x08
+
+
+class _EncodeTable(dict):
+    def __missing__(self, c):
+        return b'?'  # not representable in GSM 7-bit
+
+
+_ENCODE = _EncodeTable()
+for _i, _c in enumerate(gsm):
+    if _i != ESC:
+        _ENCODE[_c] = bytes([_i])
+for _i, _c in enumerate(ext):
+    if _c != '`':
+        _ENCODE[_c] = bytes([ESC, _i])
+
+_DECODE = {_i: _c for _i, _c in enumerate(gsm)}
+_EXT_DECODE = {_i: _c for _i, _c in enumerate(ext) if _c != '`'}
+
+
+def is_gsm(text):
+    """True if every character has a GSM 7-bit (default or extension) representation."""
+    return all(c in _ENCODE for c in text)
+
+
+def to_septets(text):
+    """Text to unpacked septets (one byte each); extension characters become ESC + code."""
+    return b''.join(map(_ENCODE.__getitem__, text))
+
+
+def from_septets(septets):
+    text = bytes(septets).decode('latin-1')
+    if '\x1b' not in text:
+        return text.translate(_DECODE)
+    parts = text.split('\x1b')
+    out = [parts[0].translate(_DECODE)]
+    for part in parts[1:]:
+        if part:
+            out.append(_EXT_DECODE.get(ord(part[0]), ' ') + part[1:].translate(_DECODE))
+    return ''.join(out)
+
+
+def pack_septets(septets, fill_bits=0):
+    """Pack septets LSB first, 8 septets per 7 octets. fill_bits pads the start (UDH alignment)."""
+    n = len(septets)
+    out = bytearray()
+    for i in range(0, n, 8):
+        acc = 0
+        shift = 0
+        for s in septets[i:i + 8]:
+            acc |= s << shift
+            shift += 7
+        out += acc.to_bytes(7, 'little')
+    if fill_bits:
+        return (int.from_bytes(out, 'little') << fill_bits).to_bytes((7 * n + fill_bits + 7) // 8, 'little')
+    return bytes(out[:(7 * n + 7) // 8])
+
+
+def unpack_septets(data, count, fill_bits=0):
+    """First count septets of packed data, skipping fill_bits leading bits."""
+    data = bytes(data)
+    if fill_bits:
+        data = (int.from_bytes(data, 'little') >> fill_bits).to_bytes(len(data), 'little')
+    out = bytearray()
+    for i in range(0, len(data), 7):
+        acc = int.from_bytes(data[i:i + 7], 'little')
+        for _ in range(8):
+            out.append(acc & 0x7f)
+            acc >>= 7
+    return bytes(out[:count])
+
+
+def gsm_encode(plaintext):
+    """Packed 7-bit text and the number of spare bits in its last octet (Network Name IE format)."""
+    septets = to_septets(plaintext)
+    return pack_septets(septets), (8 - 7 * len(septets) % 8) % 8
+
+
+def gsm_decode(data, count, fill_bits=0):
+    return from_septets(unpack_septets(data, count, fill_bits))
+
+
+def ucs2_encode(text):
+    return text.encode('utf-16-be')
+
+
+def ucs2_decode(data):
+    return bytes(data).decode('utf-16-be', errors='replace')
+
+
+def dcs_alphabet(dcs):
+    """Character set of a TP-DCS value (23.038 clause 4): DCS_GSM7, DCS_8BIT or DCS_UCS2."""
+    group = dcs >> 4
+    if group <= 0x7:  # general data coding (bit 6 only marks automatic deletion)
+        alphabet = dcs & 0x0c
+        return alphabet if alphabet != 0x0c else DCS_GSM7  # reserved, treat as default alphabet
+    if group in (0xc, 0xd):  # message waiting, store/discard
+        return DCS_GSM7
+    if group == 0xe:  # message waiting, store, UCS2
+        return DCS_UCS2
+    if group == 0xf:
+        return DCS_8BIT if dcs & 0x04 else DCS_GSM7
+    return DCS_GSM7
+
+
+def encode_user_data(text):
+    """Text to (TP-DCS, TP-UDL, TP-UD): GSM 7-bit when possible, UCS2 otherwise."""
+    if is_gsm(text):
+        septets = to_septets(text)
+        return DCS_GSM7, len(septets), pack_septets(septets)
+    ud = ucs2_encode(text)
+    return DCS_UCS2, len(ud), ud
+
+
+def decode_user_data(dcs, udl, ud, header_length=0):
+    """TP-UD to text. header_length is the UDH size in octets (UDHL + 1), 0 without UDH.
+
+    For 7-bit text UDL counts septets including the header, which is padded to a septet boundary.
+    """
+    alphabet = dcs_alphabet(dcs)
+    if alphabet == DCS_GSM7:
+        header_septets = (header_length * 8 + 6) // 7
+        fill_bits = header_septets * 7 - header_length * 8
+        return gsm_decode(ud[header_length:], udl - header_septets, fill_bits)
+    if alphabet == DCS_UCS2:
+        return ucs2_decode(ud[header_length:udl])
+    return bytes(ud[header_length:udl]).hex()
@@ -0,0 +1,153 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     Subscriber authorization against PyHSS
+#     --------------------------------------
+#
+#   -> a LOCATION-UPDATE-REQUEST (9) is accepted when PyHSS knows the IMSI and has it enabled
+#      (REST API on :8080, GET /subscriber/imsi/{imsi}), else rejected with an MM cause
+#   -> verdicts are cached per IMSI IE: LRU of size entries, kept ttl seconds for known subscribers and
+#      negative_ttl for unknown or disabled ones; a hit is one dict lookup, nothing is decoded or awaited
+#   -> a miss starts one lookup per IMSI; LUs for an IMSI already being looked up wait on that lookup
+#   -> PyHSS unreachable or failing: the last verdict (even expired) is used, else fail_open decides;
+#      either is kept error_ttl seconds, so a down HSS is not asked again for every LU
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+from sgsap import decode_imsi
+
+# verdicts: ACCEPT or an MM reject cause (24.008 10.5.3.6) for LOCATION-UPDATE-REJECT
+ACCEPT = 0
+IMSI_UNKNOWN_IN_HLR = 2
+ILLEGAL_MS = 3
+NETWORK_FAILURE = 17
+
+
+class SubscriberAuth:
+    def __init__(self, url, size=100000, ttl=300.0, negative_ttl=60.0, error_ttl=5.0, fail_open=True, timeout=2.0,
+                 concurrency=32, pending_limit=10000):
+        self.url = url.rstrip('/')
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.error_ttl = error_ttl
+        self.fail_open = fail_open
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.pending_limit = pending_limit
+
+        self.cache = OrderedDict()  # IMSI IE -> (verdict, expiry)
+        self.pending = {}  # IMSI IE -> callbacks waiting for its lookup
+        self.lookups = set()  # their tasks
+        self.session = None
+        self.slots = None
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'overflow': 0, 'errors': 0, 'requests': 0,
+                      'rejected': 0}
+
+    def __len__(self):
+        return len(self.cache)
+
+    def start(self):
+        """Open the session (call from the running loop)."""
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.slots = asyncio.Semaphore(self.concurrency)
+
+    async def close(self):
+        for task in list(self.lookups):
+            task.cancel()
+        if self.session is not None:
+            await self.session.close()
+
+    def verdict(self, imsi):
+        """Cached verdict for an IMSI IE (bytes), None when PyHSS has to be asked (see ask)."""
+        entry = self.cache.get(imsi)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        self.cache.move_to_end(imsi)
+        self.stats['hits'] += 1
+        if entry[0]:
+            self.stats['rejected'] += 1
+        return entry[0]
+
+    def ask(self, imsi, done):
+        """Look an IMSI IE up and call done(verdict) with the answer. Never waits: the lookup runs in a task,
+        and an IMSI already being looked up is not asked for twice."""
+        waiting = self.pending.get(imsi)
+        if waiting is not None:
+            waiting.append(done)
+            self.stats['coalesced'] += 1
+            return
+        if len(self.pending) >= self.pending_limit:  # PyHSS far behind: answer without it
+            self.stats['overflow'] += 1
+            self._answer([done], self._fallback(imsi))
+            return
+        self.stats['misses'] += 1
+        self.pending[imsi] = [done]
+        task = asyncio.get_running_loop().create_task(self.lookup(imsi))
+        self.lookups.add(task)
+        task.add_done_callback(self.lookups.discard)
+
+    async def lookup(self, imsi):
+        digits = decode_imsi(imsi)
+        verdict = None
+        ttl = self.error_ttl
+        try:
+            async with self.slots:
+                self.stats['requests'] += 1
+                async with self.session.get("%s/subscriber/imsi/%s" % (self.url, digits)) as response:
+                    if response.status == 404:
+                        verdict, ttl = IMSI_UNKNOWN_IN_HLR, self.negative_ttl
+                    elif response.status == 200:
+                        subscriber = await response.json(content_type=None)
+                        if isinstance(subscriber, dict) and subscriber.get('enabled', True) is not False:
+                            verdict, ttl = ACCEPT, self.ttl
+                        else:
+                            verdict, ttl = ILLEGAL_MS, self.negative_ttl
+                    else:
+                        logging.warning("PyHSS answered HTTP %d for IMSI %s", response.status, digits)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.warning("PyHSS lookup of IMSI %s failed: %r", digits, e)
+        except asyncio.CancelledError:
+            self.pending.pop(imsi, None)
+            raise
+        if verdict is None:
+            self.stats['errors'] += 1
+            verdict = self._fallback(imsi)
+        elif verdict:
+            logging.info("IMSI %s not authorized by PyHSS (MM cause %d)", digits, verdict)
+        self._store(imsi, verdict, ttl)
+        self._answer(self.pending.pop(imsi), verdict)
+
+    def _fallback(self, imsi):
+        entry = self.cache.get(imsi)
+        if entry is not None:
+            return entry[0]
+        return ACCEPT if self.fail_open else NETWORK_FAILURE
+
+    def _store(self, imsi, verdict, ttl):
+        cache = self.cache
+        cache[imsi] = (verdict, time.monotonic() + ttl)
+        cache.move_to_end(imsi)
+        if len(cache) > self.size:
+            cache.popitem(last=False)
+
+    def _answer(self, callbacks, verdict):
+        if verdict:
+            self.stats['rejected'] += len(callbacks)
+        for done in callbacks:
+            done(verdict)
+
+    def forget(self, imsi=None):
+        """Drop the cached verdict of an IMSI IE, or all of them."""
+        if imsi is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(imsi, None)
@@ -0,0 +1,108 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     Bulk operations as rate-limited background jobs
+#     -----------------------------------------------
+#
+#   -> a job walks its targets lazily and applies one action per target, at most rate per second
+#      (token bucket), so normal traffic keeps the event loop between actions
+#   -> progress (done / failed / skipped, rate, elapsed) is logged every few seconds and at the end,
+#      and is available to the API and the "jobs" command
+#   -> the operations themselves (page a LAI, alert a list, RESET every MME, detach an MME's
+#      subscribers) are defined by server.py: operation(name, params) -> (description, targets, action)
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import asyncio
+import itertools
+import logging
+import time
+
+from mt_sms import TokenBucket
+
+DONE, FAILED, SKIPPED = True, False, None  # action results
+
+
+class Job:
+    def __init__(self, job_id, name, description, targets, action, total=None):
+        self.id = job_id
+        self.name = name
+        self.description = description
+        self.targets = targets
+        self.action = action
+        self.total = total
+        self.counts = {'done': 0, 'failed': 0, 'skipped': 0}
+        self.state = 'running'
+        self.started = time.monotonic()
+        self.finished = None
+        self.task = None
+
+    def progress(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        processed = sum(self.counts.values())
+        return dict(self.counts, id=self.id, job=self.name, description=self.description, state=self.state,
+                    total=self.total, elapsed=round(elapsed, 3), rate=round(processed / elapsed, 1) if elapsed else 0.0)
+
+    def __str__(self):
+        p = self.progress()
+        return ("job %(id)d %(job)s (%(description)s) %(state)s: %(done)d done, %(failed)d failed, "
+                "%(skipped)d skipped of %(total)s, %(rate).0f/s" % p)
+
+
+class JobRunner:
+    """Runs jobs built by operation(name, params), which raises ValueError for bad requests."""
+
+    def __init__(self, operation, rate=200.0, report_interval=5.0, keep=20):
+        self.operation = operation
+        self.rate = rate
+        self.report_interval = report_interval
+        self.keep = keep  # finished jobs kept for progress queries
+        self.jobs = {}
+        self.ids = itertools.count(1)
+
+    def start(self, name, params, rate=None):
+        description, targets, action, total = self.operation(name, params)
+        job = Job(next(self.ids), name, description, iter(targets), action, total)
+        self.jobs[job.id] = job
+        job.task = asyncio.get_running_loop().create_task(self.run(job, TokenBucket(rate or self.rate)))
+        logging.info("%s", job)
+        self._forget()
+        return job
+
+    def _forget(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.state != 'running']
+        for job_id in finished[:max(0, len(finished) - self.keep)]:
+            del self.jobs[job_id]
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.state != 'running':
+            return False
+        job.task.cancel()
+        return True
+
+    async def run(self, job, bucket):
+        next_report = time.monotonic() + self.report_interval
+        try:
+            for target in job.targets:
+                await bucket.take()
+                result = job.action(target)
+                job.counts['done' if result is DONE else 'skipped' if result is SKIPPED else 'failed'] += 1
+                if time.monotonic() >= next_report:
+                    logging.info("%s", job)
+                    next_report = time.monotonic() + self.report_interval
+            job.state = 'finished'
+        except asyncio.CancelledError:
+            job.state = 'cancelled'
+        except Exception:
+            job.state = 'failed'
+            logging.exception("job %d failed", job.id)
+        finally:
+            job.finished = time.monotonic()
+            if job.total is None:
+                job.total = sum(job.counts.values())
+            logging.info("%s", job)
+
+    def stop(self):
+        for job in self.jobs.values():
+            if job.state == 'running':
+                job.task.cancel()
@@ -0,0 +1,91 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     Logging for the SGs server
+#     --------------------------
+#
+#   -> records go through a queue to a background writer thread,
+#      the event loop never formats or writes log lines itself
+#   -> per-message logs only for traced IMSIs, or sampled when debug is on
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import logging
+import logging.handlers
+import queue
+import sys
+
+from sgsap import decode_imsi
+
+FORMAT = "%(asctime)s.%(msecs)03d %(levelname).1s %(message)s"
+DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted; the listener thread does the formatting.
+
+    Arguments are therefore formatted later, so never log views into reused buffers (pass bytes/str).
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level=logging.INFO, stream=None):
+    """Route the root logger through a queue to a single stream handler. Returns the started listener."""
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(FORMAT, DATEFMT))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+    listener.start()
+    return listener
+
+
+class Trace:
+    """Runtime switches for per-message logging.
+
+    Messages of traced IMSIs (IMSI IEs) are always logged; with debug on, one message in
+    sample_every of the others is logged as well.
+    """
+
+    def __init__(self, level=logging.INFO, sample_every=100):
+        self.imsis = set()
+        self.level = level
+        self.debug = level <= logging.DEBUG
+        self.sample_every = sample_every
+        self._count = 0
+
+    def add(self, imsi_ie):
+        self.imsis.add(bytes(imsi_ie))
+
+    def remove(self, imsi_ie):
+        self.imsis.discard(bytes(imsi_ie))
+
+    def set_sample(self, sample_every):
+        self.sample_every = sample_every
+
+    def set_debug(self, on):
+        self.debug = on
+        logging.getLogger().setLevel(logging.DEBUG if on else max(self.level, logging.INFO))
+
+    def wants(self, imsi_ie):
+        if self.imsis and bytes(imsi_ie) in self.imsis:
+            return True
+        if self.debug and self.sample_every:
+            self._count += 1
+            if self._count >= self.sample_every:
+                self._count = 0
+                return True
+        return False
+
+    def state(self):
+        return {'imsis': sorted(decode_imsi(imsi) for imsi in self.imsis), 'debug': self.debug,
+                'sample_every': self.sample_every}
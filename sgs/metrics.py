@@ -0,0 +1,135 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     Prometheus metrics for the SGs server
+#     -------------------------------------
+#
+#   -> text exposition format on GET /metrics (port 9091 like the other NFs)
+#   -> hot path only bumps list slots and ints, rendering happens on scrape
+#   -> gauges are callbacks read at scrape time (queue depths, subscribers, ...)
+#   -> with --workers the parent's /metrics also carries every worker's, labelled worker="N" (shard.py)
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import logging
+from bisect import bisect_left
+
+from aiohttp import web
+
+from sgsap import MESSAGE_NAMES
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % item for item in labels) + '}'
+
+
+class MessageCounter:
+    """SGsAP messages by direction ('rx' from the MMEs, 'tx' towards them) and message type."""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.rx = [0] * 256
+        self.tx = [0] * 256
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        for direction, counts in (('rx', self.rx), ('tx', self.tx)):
+            for message_type, count in enumerate(counts):
+                if count or message_type in MESSAGE_NAMES:
+                    name = MESSAGE_NAMES.get(message_type, str(message_type))
+                    lines.append('%s{direction="%s",type="%s"} %d' % (self.name, direction, name, count))
+        return lines
+
+
+class Callback:
+    """Counter or gauge whose value(s) come from fn() at scrape time.
+
+    fn returns a number, or a dict of {label value: number} when label is given.
+    """
+
+    def __init__(self, name, help, fn, kind='gauge', label=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.kind = kind
+        self.label = label
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        value = self.fn()
+        if self.label is None:
+            lines.append("%s %s" % (self.name, value))
+        else:
+            lines += ['%s{%s="%s"} %s' % (self.name, self.label, key, v) for key, v in value.items()]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = tuple(labels)
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append("%s_bucket%s %d" % (self.name, _labels(self.labels + (('le', le),)), cumulative))
+        lines.append("%s_sum%s %r" % (self.name, _labels(self.labels), self.sum))
+        lines.append("%s_count%s %d" % (self.name, _labels(self.labels), self.count))
+        return lines
+
+    def render(self):
+        return ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name] + self.samples()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+def create_metrics_app(registry, more=None):
+    async def get_metrics(request):
+        text = registry.render()
+        if more is not None:
+            text += await more()
+        return web.Response(text=text, content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', get_metrics)
+    return app
+
+
+async def start_metrics(registry, address=None, port=9091, more=None):
+    """Serve /metrics on address:port, followed by the text of await more() if given. Returns the runner
+    (cleanup() to stop)."""
+    runner = web.AppRunner(create_metrics_app(registry, more), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, address, port).start()
+    logging.info("metrics listening on %s:%s", address, port)
+    return runner
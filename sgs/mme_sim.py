@@ -0,0 +1,296 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     MME simulator / SGs load generator
+#     ----------------------------------
+#
+#   -> N associations towards server.py (SCTP, or TCP with --transport tcp on both sides)
+#   -> weighted mix of LU, MO SMS, EPS/IMSI detach and UE activity for a pool of IMSIs at a target rate
+#   -> answers paging (SERVICE-REQUEST) and MT SMS (CP-ACK + RP-ACK), acks RESET
+#   -> reports throughput and p50/p99/p999 answer latency per procedure
+#
+#   python mme_sim.py -a 127.0.0.1 --transport tcp --rate 20000 --duration 30 --mix lu=4,sms=4,detach=1,activity=1
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import asyncio
+import json
+import random
+import socket
+import struct
+import time
+from collections import deque
+from optparse import OptionParser
+
+from gsm0338 import encode_user_data
+from sgsap import SERVICE_SMS, encode, encode_bcd, encode_imsi, sgs_decode
+from sms import CP_ACK, CP_DATA, RP_ACK_MS, RP_DATA_MS, RP_DATA_N, TP_SMS_SUBMIT, encode_address
+
+MME_NAME = b'mmec01.mmegi0001.mme.epc.mnc001.mcc001.3gppnetwork.org'
+LAI = b'\x00\xf1\x10\x00\x01'  # 001/01, LAC 1
+
+# procedure -> message type of the answer that completes it (None: no answer expected)
+PROCEDURES = {'lu': 10, 'sms': 7, 'detach': 18, 'imsi_detach': 20, 'activity': None}
+
+
+def mme_name(name=MME_NAME):
+    """MME name IE contents: the FQDN as DNS labels."""
+    return b''.join(bytes([len(label)]) + label for label in name.split(b'.'))
+
+
+def location_update_request(imsi_ie, mme):
+    return encode('location_update_request', imsi=imsi_ie[2:], mme_name=mme, eps_location_update_type=1, lai=LAI)
+
+
+def sms_submit(mr, destination, text):
+    dcs, udl, ud = encode_user_data(text)
+    digits, toa, da = encode_address(destination)
+    return b''.join((bytes([TP_SMS_SUBMIT, mr, digits, toa]), da, bytes([0x00, dcs, udl]), ud))
+
+
+def uplink_sms(imsi_ie, mr, smsc, destination, text):
+    """UPLINK-UNITDATA carrying CP-DATA / RP-DATA (MS -> network) / SMS-SUBMIT."""
+    tpdu = sms_submit(mr, destination, text)
+    da = encode_bcd(smsc)
+    rp = b''.join((bytes([RP_DATA_MS, mr, 0x00, len(da) + 1, 0x91]), da, bytes([len(tpdu)]), tpdu))
+    return uplink_nas(imsi_ie, bytes([0x09, CP_DATA, len(rp)]) + rp)
+
+
+def uplink_nas(imsi_ie, nas):
+    return encode('uplink_unitdata', imsi=imsi_ie[2:], nas_message_container=nas)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Link:
+    """One association: SCTP keeps message boundaries, TCP frames each PDU with a 2 byte length."""
+
+    def __init__(self, address, port, transport):
+        self.address = (address, port)
+        self.framed = transport == 'tcp'
+        self.sock = None
+        self.reader = self.writer = None
+
+    async def connect(self):
+        if self.framed:
+            self.reader, self.writer = await asyncio.open_connection(*self.address)
+            self.writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_SCTP)
+            self.sock.setblocking(False)
+            await asyncio.get_running_loop().sock_connect(self.sock, self.address)
+
+    async def send(self, pdu):
+        if self.framed:
+            self.writer.write(struct.pack('!H', len(pdu)) + pdu)
+            if self.writer.transport.get_write_buffer_size() > 1 << 20:
+                await self.writer.drain()
+        else:
+            await asyncio.get_running_loop().sock_sendall(self.sock, pdu)
+
+    async def recv(self):
+        """Next PDU, b'' when the server closed the association."""
+        if self.framed:
+            try:
+                header = await self.reader.readexactly(2)
+                return await self.reader.readexactly(header[0] << 8 | header[1])
+            except asyncio.IncompleteReadError:
+                return b''
+        return await asyncio.get_running_loop().sock_recv(self.sock, 65536)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.sock is not None:
+            self.sock.close()
+
+
+class Simulator:
+    def __init__(self, options):
+        self.options = options
+        self.imsis = [encode_imsi('%015d' % (int(options.imsi_base) + i)) for i in range(options.imsis)]
+        self.mme_name = mme_name()
+        names, weights = zip(*options.mix)
+        self.names = names
+        self.weights = weights
+        self.pending = {}  # (answer type, imsi IE) -> deque of (procedure, send time)
+        self.latencies = {name: [] for name in PROCEDURES}
+        self.sent = dict.fromkeys(PROCEDURES, 0)
+        self.answered = dict.fromkeys(PROCEDURES, 0)
+        self.received = 0
+        self.served = {'paging': 0, 'mt_sms': 0, 'reset': 0}
+        self.mr = 0
+        self.links = []
+
+    def build(self, procedure, imsi):
+        if procedure == 'lu':
+            return location_update_request(imsi, self.mme_name)
+        if procedure == 'sms':
+            self.mr = (self.mr + 1) % 256
+            return uplink_sms(imsi, self.mr, self.options.smsc, self.options.destination, self.options.text)
+        if procedure == 'detach':  # network initiated EPS detach
+            return encode('eps_detach_indication', imsi=imsi[2:], mme_name=self.mme_name,
+                          imsi_detach_from_eps_service_type=1)
+        if procedure == 'imsi_detach':  # explicit UE initiated IMSI detach
+            return encode('imsi_detach_indication', imsi=imsi[2:], mme_name=self.mme_name,
+                          imsi_detach_from_non_eps_service_type=1)
+        return encode('ue_activity_indication', imsi=imsi[2:])
+
+    async def receive(self, link):
+        while True:
+            pdu = await link.recv()
+            if not pdu:
+                return
+            now = time.perf_counter()
+            self.received += 1
+            decode = sgs_decode(pdu)
+            imsi = bytes(decode[1]) if 1 in decode else None
+
+            key = (decode.type, imsi)
+            if decode.type == 7 and 22 in decode and decode.value(22)[1] != CP_ACK:
+                key = None  # an MO SMS is answered by its CP-ACK, RP-ACK/MT CP-DATA are handled below
+            waiting = self.pending.get(key)
+            if waiting:
+                procedure, started = waiting.popleft()
+                if not waiting:
+                    del self.pending[key]
+                self.answered[procedure] += 1
+                self.latencies[procedure].append(now - started)
+                continue
+
+            if decode.type == 1:  # paging-request: the UE answers
+                self.served['paging'] += 1
+                indicator = decode.value(32) if 32 in decode else SERVICE_SMS
+                await link.send(encode('service_request', imsi=imsi[2:], service_indicator=indicator))
+            elif decode.type == 7 and 22 in decode:  # MT SMS: CP-ACK then RP-ACK
+                nas = decode.value(22)
+                if nas[1] == CP_DATA and nas[3] & 0x07 == RP_DATA_N:
+                    self.served['mt_sms'] += 1
+                    ti = nas[0] & 0x70 | 0x80 | 0x09
+                    await link.send(uplink_nas(imsi, bytes([ti, CP_ACK])))
+                    rp = bytes([RP_ACK_MS, nas[4]])
+                    await link.send(uplink_nas(imsi, bytes([ti, CP_DATA, len(rp)]) + rp))
+            elif decode.type == 21:  # reset-indication
+                self.served['reset'] += 1
+                await link.send(encode('reset_ack', mme_name=self.mme_name))
+
+    async def generate(self):
+        """Send at options.rate for options.duration seconds, in small bursts every millisecond."""
+        rate = self.options.rate
+        deadline = time.perf_counter() + self.options.duration
+        start = time.perf_counter()
+        count = 0
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            due = int((now - start) * rate) - count
+            for procedure in random.choices(self.names, self.weights, k=due):
+                imsi = random.choice(self.imsis)
+                answer = PROCEDURES[procedure]
+                if answer is not None:
+                    self.pending.setdefault((answer, imsi), deque()).append((procedure, time.perf_counter()))
+                self.sent[procedure] += 1
+                await self.links[count % len(self.links)].send(self.build(procedure, imsi))
+                count += 1
+            await asyncio.sleep(0.001)
+        return time.perf_counter() - start
+
+    async def run(self):
+        options = self.options
+        self.links = [Link(options.address, options.port, options.transport) for _ in range(options.associations)]
+        for link in self.links:
+            await link.connect()
+        readers = [asyncio.ensure_future(self.receive(link)) for link in self.links]
+
+        if options.attach:  # register every IMSI before the measured run
+            for i, imsi in enumerate(self.imsis):
+                await self.links[i % len(self.links)].send(location_update_request(imsi, self.mme_name))
+            await asyncio.sleep(1.0)
+
+        elapsed = await self.generate()
+        drain_until = time.perf_counter() + options.drain
+        while self.pending and time.perf_counter() < drain_until:
+            await asyncio.sleep(0.01)
+
+        for task in readers:
+            task.cancel()
+        for link in self.links:
+            link.close()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        procedures = {}
+        for name in PROCEDURES:
+            if not self.sent[name]:
+                continue
+            ordered = sorted(self.latencies[name])
+            procedures[name] = {
+                'sent': self.sent[name], 'answered': self.answered[name],
+                'p50_ms': percentile(ordered, 0.50) * 1000, 'p99_ms': percentile(ordered, 0.99) * 1000,
+                'p999_ms': percentile(ordered, 0.999) * 1000,
+                'max_ms': ordered[-1] * 1000 if ordered else 0.0}
+        sent = sum(self.sent.values())
+        return {'seconds': elapsed, 'sent': sent, 'sent_per_s': sent / elapsed,
+                'answered_per_s': sum(self.answered.values()) / elapsed, 'received': self.received,
+                'unanswered': sum(len(waiting) for waiting in self.pending.values()),
+                'served': self.served, 'procedures': procedures}
+
+
+def parse_mix(text):
+    mix = []
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in PROCEDURES:
+            raise ValueError("unknown procedure %r (one of %s)" % (name, ', '.join(PROCEDURES)))
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def print_report(report):
+    print("%.1f s, %d sent (%.0f/s), %.0f answered/s, %d unanswered, served %s" % (
+        report['seconds'], report['sent'], report['sent_per_s'], report['answered_per_s'], report['unanswered'],
+        report['served']))
+    print("%-12s %9s %9s %9s %9s %9s %9s" % ('procedure', 'sent', 'answered', 'p50 ms', 'p99 ms', 'p999 ms',
+                                             'max ms'))
+    for name, row in report['procedures'].items():
+        print("%-12s %9d %9d %9.3f %9.3f %9.3f %9.3f" % (name, row['sent'], row['answered'], row['p50_ms'],
+                                                         row['p99_ms'], row['p999_ms'], row['max_ms']))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-a", "--address", dest="address", default="127.0.0.1", help="SGs server address")
+    parser.add_option("-p", "--port", dest="port", type="int", default=29118, help="SGs server port")
+    parser.add_option("--transport", dest="transport", choices=["sctp", "tcp"], default="sctp",
+                      help="sctp, or tcp with 2 byte length framing (server.py --transport tcp)")
+    parser.add_option("-n", "--associations", dest="associations", type="int", default=1, help="associations")
+    parser.add_option("--imsis", dest="imsis", type="int", default=10000, help="synthetic IMSIs")
+    parser.add_option("--imsi-base", dest="imsi_base", default="001010000000000", help="first IMSI")
+    parser.add_option("--rate", dest="rate", type="float", default=1000.0, help="procedures per second")
+    parser.add_option("--duration", dest="duration", type="float", default=10.0, help="seconds of load")
+    parser.add_option("--drain", dest="drain", type="float", default=2.0,
+                      help="seconds to wait for outstanding answers")
+    parser.add_option("--mix", dest="mix", default="lu=4,sms=4,detach=1,activity=1",
+                      help="procedure weights: " + ", ".join(PROCEDURES))
+    parser.add_option("--attach", dest="attach", action="store_true", default=False,
+                      help="location update every IMSI before the run")
+    parser.add_option("--smsc", dest="smsc", default="351962100000", help="RP-DA of MO SMS")
+    parser.add_option("--destination", dest="destination", default="+351966789203", help="TP-DA of MO SMS")
+    parser.add_option("--text", dest="text", default="load test", help="MO SMS text")
+    parser.add_option("--json", dest="json", action="store_true", default=False, help="print the report as JSON")
+    (options, args) = parser.parse_args()
+    options.mix = parse_mix(options.mix)
+
+    report = asyncio.run(Simulator(options).run())
+    if options.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     MT SMS dispatcher
+#     -----------------
+#
+#   -> one queue per subscriber, one delivery at a time per subscriber
+#   -> idle UE: PAGING-REQUEST (1), then DOWNLINK-UNITDATA (7) on SERVICE-REQUEST (6)
+#   -> next message goes out as soon as the RP-ACK for the previous one arrives
+#   -> pages are rate limited, subscribers in delivery are capped
+#   -> unanswered PAGING-REQUEST / DOWNLINK-UNITDATA are resent up to retries times, every timeout
+#      seconds, before the queue is given up; the timers live in a shared TimerWheel
+#   -> with a store (mt_store.py), a queue given up on is stored instead of dropped, as are messages for
+#      subscribers not registered; resume() delivers them once the UE shows up again
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+from sgsap import SERVICE_SMS, downlink_unitdata, paging_request
+from sms import build_cp_data, build_rp_data, build_sms_deliver
+from timers import TimerWheel
+
+IDLE, READY, PAGING, DELIVERING = range(4)
+
+
+class TokenBucket:
+    """rate operations per second on average, bursts of up to burst."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate / 10)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class MtQueue:
+    __slots__ = ('messages', 'state', 'ti', 'mr', 'timer', 'attempts', 'pdu')
+
+    def __init__(self):
+        self.messages = deque()  # (SMS-DELIVER TPDU, originator, store id or None)
+        self.state = IDLE
+        self.ti = 0
+        self.mr = None
+        self.timer = None
+        self.attempts = 0
+        self.pdu = None  # last PAGING-REQUEST / DOWNLINK-UNITDATA, for retransmission
+
+
+class MtSmsDispatcher:
+    """Queues MT SMS per IMSI IE and drives paging and delivery over SGs.
+
+    transmit(imsi, pdu) sends a PDU to the association serving imsi and returns False when there is none.
+    The on_* handlers are called from handle_decode and return PDUs to answer on the same association.
+    delivered(imsi, originator) is called for every message the UE acknowledged (RP-ACK).
+    store is an MtStore for what cannot be delivered now, or None to drop it.
+    """
+
+    def __init__(self, subscribers, vlr_ie, smsc, transmit, scts, rate=1000.0, concurrency=500,
+                 queue_limit=100, timeout=10.0, retries=2, timers=None, delivered=None, store=None):
+        self.subscribers = subscribers
+        self.vlr_ie = vlr_ie
+        self.smsc = smsc
+        self.transmit = transmit
+        self.scts = scts
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.retries = retries
+        self.timers = timers if timers is not None else TimerWheel()
+        self.delivered = delivered
+        self.store = store
+
+        self.queues = {}
+        self.loading = set()  # IMSIs whose stored messages are being read
+        self.loaders = set()  # their tasks
+        self.ready = None
+        self.slots = None
+        self.mr = 0
+        self.active = 0  # subscribers being paged or served
+        self.stats = {'submitted': 0, 'rejected': 0, 'delivered': 0, 'failed': 0, 'queued': 0,
+                      'retransmitted': 0, 'stored': 0, 'resumed': 0}
+
+    def start(self):
+        """Create the loop-bound primitives and return the dispatch task."""
+        self.ready = asyncio.Queue()
+        self.slots = asyncio.Semaphore(self.concurrency)
+        return asyncio.get_running_loop().create_task(self.run())
+
+    def submit(self, imsi, originator, text):
+        """Queue (or store) one message. Returns None when accepted, else the reason for rejecting it."""
+        store = self.store
+        if imsi not in self.subscribers and store is None:
+            return self._reject("subscriber not registered")
+        q = self.queues.get(imsi)
+        if q is not None and len(q.messages) >= self.queue_limit:
+            return self._reject("subscriber queue full")
+        try:
+            tpdu = build_sms_deliver(originator, text, self.scts())
+        except ValueError as e:
+            return self._reject(str(e))
+        if store is not None and (imsi not in self.subscribers or store.has(imsi) or imsi in self.loading
+                                  or imsi in self.subscribers.unreachable):
+            if store.add(imsi, tpdu, originator) is None:  # behind the stored ones
+                return self._reject("subscriber store full")
+            self.stats['submitted'] += 1
+            self.stats['stored'] += 1
+            return None
+        if q is None:
+            q = self.queues[imsi] = MtQueue()
+
+        q.messages.append((tpdu, originator, None))
+        self.stats['submitted'] += 1
+        self.stats['queued'] += 1
+        if q.state == IDLE:
+            q.state = READY
+            self.ready.put_nowait(imsi)
+        return None
+
+    def _reject(self, reason):
+        self.stats['rejected'] += 1
+        return reason
+
+    async def run(self):
+        while True:
+            imsi = await self.ready.get()
+            q = self.queues.get(imsi)
+            if q is None or q.state != READY:
+                continue
+            await self.slots.acquire()
+            await self.bucket.take()
+            if self.queues.get(imsi) is not q:  # dropped while waiting
+                self.slots.release()
+                continue
+            self._page(imsi, q)
+
+    def _page(self, imsi, q):
+        q.state = PAGING
+        self.active += 1
+        self._arm(imsi, q)
+        sub = self.subscribers.get(imsi)
+        if sub is None:
+            self._fail(imsi, q, "subscriber detached")
+            return
+        q.pdu = paging_request(sub.imsi, self.vlr_ie, SERVICE_SMS, sub.tmsi, sub.lai)
+        if not self.transmit(imsi, q.pdu):
+            self._fail(imsi, q, "no association")
+
+    def _arm(self, imsi, q, attempts=0):
+        if q.timer is not None:
+            q.timer.cancel()
+        q.attempts = attempts
+        q.timer = self.timers.schedule(self.timeout, self._expire, imsi)
+
+    def _expire(self, imsi):
+        q = self.queues.get(imsi)
+        if q is None:
+            return
+        q.timer = None
+        if q.attempts >= self.retries or imsi not in self.subscribers:
+            self._fail(imsi, q, "timeout")
+        elif not self.transmit(imsi, q.pdu):
+            self._fail(imsi, q, "no association")
+        else:
+            self.stats['retransmitted'] += 1
+            self._arm(imsi, q, q.attempts + 1)
+
+    def _next_unitdata(self, imsi, q):
+        q.state = DELIVERING
+        q.ti = (q.ti + 1) % 7
+        q.mr = self.mr = (self.mr + 1) % 256
+        self._arm(imsi, q)
+        q.pdu = downlink_unitdata(imsi, build_cp_data(q.ti, build_rp_data(q.mr, self.smsc, q.messages[0][0])))
+        return q.pdu
+
+    def _finish(self, imsi, q):
+        if q.timer is not None:
+            q.timer.cancel()
+        if q.state in (PAGING, DELIVERING):
+            self.active -= 1
+            self.slots.release()
+        del self.queues[imsi]
+
+    def _fail(self, imsi, q, reason):
+        self.stats['queued'] -= len(q.messages)
+        if self.store is None:
+            logging.info("MT SMS to %s failed (%s), dropping %d message(s)", imsi.hex(), reason, len(q.messages))
+            self.stats['failed'] += len(q.messages)
+        else:
+            rows = [row for _, _, row in q.messages if row is not None]
+            stored = sum(self.store.add(imsi, tpdu, originator) is not None for tpdu, originator, row in q.messages
+                         if row is None)
+            kept = len(rows)
+            self.store.kept(imsi, rows)
+            logging.info("MT SMS to %s failed (%s), %d message(s) stored, %d dropped", imsi.hex(), reason,
+                         kept + stored, len(q.messages) - kept - stored)
+            self.stats['stored'] += kept + stored
+            self.stats['failed'] += len(q.messages) - kept - stored
+        self._finish(imsi, q)
+
+    def on_service_request(self, imsi):
+        q = self.queues.get(imsi)
+        if q is None or q.state != PAGING:
+            return []
+        return [self._next_unitdata(imsi, q)]
+
+    def on_rp_result(self, imsi, mr, ok):
+        """RP-ACK (ok) or RP-ERROR for the message in delivery; returns the next DOWNLINK-UNITDATA if any."""
+        q = self.queues.get(imsi)
+        if q is None or q.state != DELIVERING or mr != q.mr:
+            return []
+        _, originator, row = q.messages.popleft()
+        self.stats['queued'] -= 1
+        self.stats['delivered' if ok else 'failed'] += 1
+        if row is not None:  # RP-ERROR too: the UE has seen it
+            self.store.delete(row)
+        if ok and self.delivered is not None:
+            self.delivered(imsi, originator)
+        if q.messages:
+            return [self._next_unitdata(imsi, q)]
+        self._finish(imsi, q)
+        self.resume(imsi)  # stored while this queue was served
+        return []
+
+    def resume(self, imsi):
+        """Deliver the messages stored for imsi: the UE is active again (UE-ACTIVITY-INDICATION, ALERT-ACK,
+        location update). Cheap when nothing is stored; the store is read in a task."""
+        store = self.store
+        if store is None or imsi not in store.counts or imsi in self.queues or imsi in self.loading \
+                or imsi not in self.subscribers:
+            return
+        self.loading.add(imsi)
+        task = asyncio.get_running_loop().create_task(self._resume(imsi))
+        self.loaders.add(task)
+        task.add_done_callback(self.loaders.discard)
+
+    async def _resume(self, imsi):
+        try:
+            rows = await self.store.load(imsi)
+        except Exception:
+            logging.exception("MT SMS to %s: reading the stored messages failed", imsi.hex())
+            self.store.counts.setdefault(imsi, 1)  # try again on the next resume
+            return
+        finally:
+            self.loading.discard(imsi)
+        if not rows:
+            return
+        q = self.queues.get(imsi)
+        if q is None:
+            q = self.queues[imsi] = MtQueue()
+        q.messages.extend((tpdu, originator, row) for row, tpdu, originator in rows)
+        self.stats['queued'] += len(rows)
+        self.stats['resumed'] += len(rows)
+        logging.info("MT SMS to %s: %d stored message(s) resumed", imsi.hex(), len(rows))
+        if q.state == IDLE:
+            q.state = READY
+            self.ready.put_nowait(imsi)
+
+    def on_paging_reject(self, imsi):
+        q = self.queues.get(imsi)
+        if q is not None and q.state in (PAGING, DELIVERING):
+            self._fail(imsi, q, "paging rejected")
+
+    def on_unreachable(self, imsi):
+        self.drop(imsi, "UE unreachable")
+
+    def drop(self, imsi, reason):
+        """Give up everything queued for imsi."""
+        q = self.queues.get(imsi)
+        if q is not None:
+            self._fail(imsi, q, reason)
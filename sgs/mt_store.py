@@ -0,0 +1,210 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     Store-and-forward of MT SMS for unreachable UEs
+#     -----------------------------------------------
+#
+#   -> SQLite in WAL mode with synchronous=NORMAL: a commit appends to the WAL without fsync, the WAL
+#      is synced at checkpoints; a crash of the process loses nothing, a power loss the last commits
+#   -> add() and delete() only queue the change; a flusher commits what queued up in one transaction
+#      every interval seconds (sooner past flush_size changes), on a thread of its own
+#   -> ids are handed out here, so nothing is read back after an insert; a message keeps its row until
+#      the UE acknowledged it (RP-ACK / RP-ERROR): a crash during delivery sends it again, never loses it
+#   -> messages are kept ttl seconds, at most per_subscriber of them per IMSI
+#   -> stored messages per IMSI are counted in memory, so "anything stored for this IMSI?" (asked on
+#      every location update) is one dict lookup
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import asyncio
+import itertools
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, imsi BLOB NOT NULL, tpdu BLOB NOT NULL, "
+    "originator TEXT NOT NULL, expires REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS messages_imsi ON messages (imsi, id)",
+    "CREATE INDEX IF NOT EXISTS messages_expires ON messages (expires)",
+)
+
+
+class MtStore:
+    def __init__(self, path, ttl=172800.0, per_subscriber=100, interval=0.2, flush_size=5000, purge_interval=60.0):
+        self.path = path
+        self.ttl = ttl
+        self.per_subscriber = per_subscriber
+        self.interval = interval
+        self.flush_size = flush_size
+        self.purge_interval = purge_interval
+
+        self.db = None
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='mt-store')  # every query, in order
+        self.counts = {}  # IMSI IE -> messages stored and not handed out by load()
+        self.handed = {}  # id -> IMSI IE of the messages handed out by load(), until delete() or kept()
+        self.inserts = []
+        self.deletes = []
+        self.ids = None
+        self.wakeup = None
+        self.task = None
+        self.stats = {'stored': 0, 'loaded': 0, 'deleted': 0, 'expired': 0, 'refused': 0, 'commits': 0}
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def open(self):
+        """Open (or create) the database, drop expired messages and count the others by IMSI."""
+        db = self.db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            db.execute(statement)
+        self._purge(time.time())
+        self.counts = {bytes(imsi): count for imsi, count in
+                       db.execute("SELECT imsi, count(*) FROM messages GROUP BY imsi")}
+        self.ids = itertools.count(db.execute("SELECT coalesce(max(id), 0) FROM messages").fetchone()[0] + 1)
+        if self.counts:
+            logging.info("%d stored MT SMS for %d subscribers in %s", len(self), len(self.counts), self.path)
+
+    def start(self):
+        """Start the flusher (call from the running loop)."""
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        return self.task
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.db.close)
+        self.executor.shutdown()
+
+    def has(self, imsi):
+        return imsi in self.counts
+
+    def add(self, imsi, tpdu, originator):
+        """Keep one message for an IMSI IE; returns its id, or None when per_subscriber are kept already."""
+        count = self.counts.get(imsi, 0)
+        if count >= self.per_subscriber:
+            self.stats['refused'] += 1
+            return None
+        self.counts[imsi] = count + 1
+        row = next(self.ids)
+        self.inserts.append((row, imsi, tpdu, originator, time.time() + self.ttl))
+        self.stats['stored'] += 1
+        self._changed()
+        return row
+
+    def kept(self, imsi, rows):
+        """Messages handed out by load() for imsi (their ids) were not delivered and stay stored; those that
+        expired meanwhile are gone."""
+        count = sum(self.handed.pop(row, None) is not None for row in rows)
+        if count:
+            self.counts[imsi] = self.counts.get(imsi, 0) + count
+
+    def delete(self, row):
+        """A message handed out by load() was delivered."""
+        self.handed.pop(row, None)
+        self.deletes.append((row,))
+        self.stats['deleted'] += 1
+        self._changed()
+
+    def _changed(self):
+        if len(self.inserts) + len(self.deletes) >= self.flush_size and self.wakeup is not None \
+                and not self.wakeup.done():
+            self.wakeup.set_result(None)
+
+    async def load(self, imsi):
+        """The messages stored for an IMSI IE, oldest first, as (id, tpdu, originator). They stay in the
+        database until delete(); until kept() gives them back, the IMSI counts as having none stored."""
+        self.counts.pop(imsi, None)
+        await self.flush()  # deletes of delivered messages and inserts queued so far first
+        now = time.time()
+        try:
+            rows = await asyncio.get_running_loop().run_in_executor(self.executor, self._select, imsi)
+        except sqlite3.Error as e:
+            logging.error("MT SMS store %s: %s", self.path, e)
+            self.counts.setdefault(imsi, 1)  # try again on the next resume
+            return []
+        handed = self.handed
+        for row in rows:  # expired ones too: no longer counted, the purge only forgets them
+            handed[row[0]] = imsi
+        rows = [row[:3] for row in rows if row[3] > now]
+        self.stats['loaded'] += len(rows)
+        return rows
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        purge_at = time.monotonic() + self.purge_interval
+        while True:
+            self.wakeup = loop.create_future()
+            try:
+                await asyncio.wait_for(self.wakeup, self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup = None
+            await self.flush()
+            if time.monotonic() >= purge_at:
+                purge_at = time.monotonic() + self.purge_interval
+                await self.purge()
+
+    async def flush(self):
+        """Commit the queued inserts and deletes in one transaction."""
+        if not self.inserts and not self.deletes:
+            return
+        inserts, deletes = self.inserts, self.deletes
+        self.inserts, self.deletes = [], []
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self._commit, inserts, deletes)
+            self.stats['commits'] += 1
+        except sqlite3.Error as e:
+            logging.error("MT SMS store %s: %s, %d messages lost", self.path, e, len(inserts))
+
+    async def purge(self):
+        """Drop expired messages and take them off the counts of their IMSIs. Messages handed out by load()
+        are not counted: they are only forgotten, so kept() does not count them again."""
+        try:
+            expired = await asyncio.get_running_loop().run_in_executor(self.executor, self._purge, time.time())
+        except sqlite3.Error as e:
+            logging.error("MT SMS store %s: %s", self.path, e)
+            return
+        counts, handed = self.counts, self.handed
+        for row, imsi in expired:
+            if handed.pop(row, None) is None:
+                left = counts.get(imsi, 0) - 1
+                if left > 0:
+                    counts[imsi] = left
+                else:
+                    counts.pop(imsi, None)
+        if expired:
+            self.stats['expired'] += len(expired)
+            logging.info("%d stored MT SMS expired", len(expired))
+
+    # # # on the store thread # # #
+
+    def _commit(self, inserts, deletes):
+        db = self.db
+        db.execute("BEGIN")
+        try:
+            db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?)", inserts)
+            db.executemany("DELETE FROM messages WHERE id = ?", deletes)
+            db.execute("COMMIT")
+        except sqlite3.Error:
+            db.execute("ROLLBACK")
+            raise
+
+    def _select(self, imsi):
+        return self.db.execute("SELECT id, tpdu, originator, expires FROM messages WHERE imsi = ? ORDER BY id",
+                               (imsi,)).fetchall()
+
+    def _purge(self, now):
+        """Delete the expired messages; returns their (id, IMSI IE)."""
+        expired = [(row, bytes(imsi)) for row, imsi in
+                   self.db.execute("SELECT id, imsi FROM messages WHERE expires <= ?", (now,))]
+        if expired:
+            self.db.execute("DELETE FROM messages WHERE expires <= ?", (now,))
+        return expired
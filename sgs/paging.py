@@ -0,0 +1,77 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     Outstanding pages and alerts
+#     ----------------------------
+#
+#   -> PAGING-REQUEST (1) waits for SERVICE-REQUEST (6), PAGING-REJECT (2) or UE-UNREACHABLE (31)
+#   -> ALERT-REQUEST (13) waits for ALERT-ACK (14) or ALERT-REJECT (15)
+#   -> unanswered requests are resent every interval seconds, retries times, then given up
+#   -> one wheel timer per request; answers cancel it, nothing is scanned
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import logging
+
+PAGE, ALERT = 'page', 'alert'
+
+
+class Pending:
+    __slots__ = ('pdu', 'attempts', 'timer')
+
+    def __init__(self, pdu):
+        self.pdu = pdu
+        self.attempts = 0
+        self.timer = None
+
+
+class PendingRequests:
+    """Tracks requests per (kind, IMSI IE) until answered.
+
+    transmit(imsi, pdu) is server.transmit: False when no association serves imsi.
+    """
+
+    def __init__(self, timers, transmit, interval=5.0, retries=2):
+        self.timers = timers
+        self.transmit = transmit
+        self.interval = interval
+        self.retries = retries
+        self.requests = {}
+        self.stats = {'sent': 0, 'answered': 0, 'rejected': 0, 'retransmitted': 0, 'expired': 0}
+
+    def __len__(self):
+        return len(self.requests)
+
+    def start(self, kind, imsi, pdu):
+        """Send pdu and wait for its answer; a request of the same kind still pending is replaced."""
+        key = (kind, bytes(imsi))
+        previous = self.requests.pop(key, None)
+        if previous is not None:
+            previous.timer.cancel()
+        if not self.transmit(key[1], pdu):
+            return False
+        request = self.requests[key] = Pending(pdu)
+        request.timer = self.timers.schedule(self.interval, self._expire, key)
+        self.stats['sent'] += 1
+        return True
+
+    def _expire(self, key):
+        request = self.requests.get(key)
+        if request is None:
+            return
+        if request.attempts < self.retries and self.transmit(key[1], request.pdu):
+            request.attempts += 1
+            request.timer = self.timers.schedule(self.interval, self._expire, key)
+            self.stats['retransmitted'] += 1
+            return
+        del self.requests[key]
+        self.stats['expired'] += 1
+        logging.debug("%s of %s unanswered after %d attempt(s)", key[0], key[1].hex(), request.attempts + 1)
+
+    def answered(self, kind, imsi, ok=True):
+        """Answer received: ok for SERVICE-REQUEST / ALERT-ACK, else a reject. False if nothing was pending."""
+        request = self.requests.pop((kind, bytes(imsi)), None)
+        if request is None:
+            return False
+        request.timer.cancel()
+        self.stats['answered' if ok else 'rejected'] += 1
+        return True
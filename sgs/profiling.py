@@ -0,0 +1,118 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     Stage timers and sampling profiler for the SGs server
+#     -----------------------------------------------------
+#
+#   -> StageTimers: time spent per received PDU in recv, decode (sgs_decode + check), handle
+#      (handle_decode, answers encoded) and send (queueing + socket send), one histogram per stage
+#      and message type; only the event loop thread writes them, so plain list slots and no locks
+#   -> switched on and off at run time: while off the server only tests one global for None
+#   -> Sampler: SIGPROF every interval seconds of CPU time, the stack of the interrupted Python code
+#      is counted; dump() writes folded stacks ("a;b;c count" lines) for flamegraph.pl / speedscope
+#   -> no timer runs while the sampler is stopped, so it costs nothing then
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import os
+import signal
+import time
+
+from metrics import Histogram
+from sgsap import MESSAGE_NAMES
+
+STAGES = ('recv', 'decode', 'handle', 'send')
+STAGE_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.001, 0.01, 0.1)
+
+
+class StageTimers:
+    """sgs_stage_seconds{stage, type} histograms, created for a message type when it is first seen."""
+
+    def __init__(self, name='sgs_stage_seconds', help="Time spent per received PDU by stage and message type"):
+        self.name = name
+        self.help = help
+        self.rows = [None] * 256  # message type -> histogram per stage
+
+    def _row(self, message_type):
+        type_name = MESSAGE_NAMES.get(message_type, str(message_type))
+        row = self.rows[message_type] = [Histogram(self.name, self.help, STAGE_BUCKETS,
+                                                   (('stage', stage), ('type', type_name))) for stage in STAGES]
+        return row
+
+    def observe(self, message_type, recv, decode, handle, send):
+        """Seconds per stage of one PDU; recv is None when the read was counted for an earlier PDU."""
+        row = self.rows[message_type] or self._row(message_type)
+        if recv is not None:
+            row[0].observe(recv)
+        row[1].observe(decode)
+        row[2].observe(handle)
+        row[3].observe(send)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        for row in self.rows:
+            if row is not None:
+                for histogram in row:
+                    lines += histogram.samples()
+        return lines
+
+
+class Sampler:
+    """Statistical profiler of the main thread (the event loop), on SIGPROF from an ITIMER_PROF timer.
+
+    CPU time drives the timer, so an idle server takes (almost) no samples.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}  # tuple of code objects, outermost first -> samples
+        self.samples = 0
+        self.started = None
+
+    @property
+    def running(self):
+        return self.started is not None
+
+    def start(self):
+        """Reset the counts and start sampling; False if already running."""
+        if self.running:
+            return False
+        self.stacks = {}
+        self.samples = 0
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.started = time.monotonic()
+        return True
+
+    def stop(self):
+        """Stop sampling. Returns the seconds it ran (None if it was not running)."""
+        if not self.running:
+            return None
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)  # a signal still in flight must not end the process
+        elapsed = time.monotonic() - self.started
+        self.started = None
+        return elapsed
+
+    def _sample(self, signum, frame):
+        codes = []
+        while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        key = tuple(reversed(codes))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def folded(self):
+        """Folded stack lines, most sampled first."""
+        lines = []
+        for codes, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+            lines.append("%s %d" % (";".join("%s:%s" % (os.path.basename(code.co_filename), code.co_name)
+                                             for code in codes), count))
+        return lines
+
+    def dump(self, path):
+        """Write the folded stacks to path; returns the number of samples."""
+        with open(path, 'w') as f:
+            for line in self.folded():
+                f.write(line + "\n")
+        return self.samples
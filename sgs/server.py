@@ -3,65 +3,129 @@
 #     Simple MSS SGs Server
 #     ---------------------
 #
-#   -> only one SCTP session
-#   -> only one user (i.e. IMSI)
+#   -> any number of SCTP associations (one reader task each)
+#   -> --transport tcp: same over TCP, each PDU prefixed with its 2 byte length (test benches without SCTP)
+#   -> any number of users, indexed by IMSI / TMSI / MME
+#   -> RESET-INDICATION from an MME, or the loss of its association, only marks that MME's subscribers
+#      unconfirmed (subscribers.py); requests for a subscriber go to its MME's association directly
+#   -> pages, alerts and MT SMS are retransmitted and given up on by one timer wheel (timers.py)
+#   -> with --mt-store, MT SMS for unreachable UEs are kept in SQLite (mt_store.py) and sent when the UE
+#      is seen again: UE-ACTIVITY-INDICATION (16), ALERT-ACK (14) or a location update
+#   -> with --hss-url, location updates are authorized by PyHSS through a cache (hss.py); an LU that
+#      misses the cache is answered when PyHSS has replied, without holding up the association
+#   -> "stages on" times recv / decode / handle / send per message type, "profile" or SIGUSR1 samples
+#      the stacks of the event loop into a folded stacks file (profiling.py)
 #
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
-import random
+import signal
 import socket
 import struct
 import time
-import select
-import aiohttp
-import traceback
 import asyncio
+import itertools
+import zlib
+from collections import deque
+from functools import partial
 from optparse import OptionParser
 import logging
-import binascii
-
-from binascii import hexlify, unhexlify
-
 import sys
 import os
-import subprocess
-
-import datetime
-
-# Configure Logger
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
-console_handler.setFormatter(formatter)
-logging.getLogger().addHandler(console_handler)
 
-logging.debug("Starting SGsAP MSS Server...")
-
-gsm = (
-    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
-ext = (
-    "````````````````````^```````````````````{}`````\\````````````[~]`|````````````````````````````````````€``````````````````````````")
+from api import create_app, load_msisdn_map, start_api
+from billing import MO, MT, SmsEvents
+from capture import Recorder
+from gsm0338 import gsm_encode
+from hss import ACCEPT, SubscriberAuth
+from jobs import DONE, SKIPPED, JobRunner
+from logconfig import Trace, setup_logging
+from metrics import Callback, Histogram, MessageCounter, Registry, start_metrics
+from mt_sms import MtSmsDispatcher
+from mt_store import MtStore
+from paging import ALERT, PAGE, PendingRequests
+from profiling import Sampler, StageTimers
+from sgsap import (CAUSE_INVALID_MANDATORY_INFORMATION, CAUSE_SEMANTICALLY_INCORRECT, DOWNLINK_UNITDATA,
+                   MESSAGE_NAMES, SERVICE_CS_CALL, SERVICE_SMS, SgsDecodeError, Template, check, decode_fqdn,
+                   decode_imsi, encode_fqdn, encode_imsi, encode_lai, paging_request, sgs_decode, status)
+from sms import (CP_ACK, CP_ERROR, RP_ACK_MS, RP_ERROR_MS, Reassembler, build_cp_ack, build_cp_data, build_rp_ack,
+                 build_sms_submit_report, parse_cp_data, parse_tpdu)
+from smsc import forwarder_from_env
+from snapshot import Persistence
+from subscribers import SubscriberStore
+from timers import TimerWheel
+from tmsi import TmsiAllocator
 
 NETWORK_NAME = 'vinoc'
 
+SMSC_ADDRESS = '351962100000'
+
 MCC = '001'
 MNC = '001'
 VLR_NAME = 'mss.epc.mnc' + MNC + '.mcc' + MCC + '.3gppnetwork.org'
 
+RECV_BUFFER_SIZE = 65536
+
+# send queue per association: answers wait for it to drain below SEND_QUEUE_HIGH before the next PDU is read,
+# requests towards an association holding more than SEND_QUEUE_LIMIT bytes are refused
+SEND_QUEUE_HIGH = 1 << 18
+SEND_QUEUE_LIMIT = 1 << 22
+
+# SCTP socket options and ancillary data (linux/sctp.h)
+SCTP_SNDRCV = 1
+SCTP_INITMSG = 2
+SCTP_STATUS = 14
+SCTP_INITMSG_FORMAT = struct.Struct('=HHHH')  # outbound streams, max inbound streams, attempts, timeout
+SCTP_STATUS_FORMAT = struct.Struct('=iiIHHHH')  # assoc id, state, rwnd, unacked, pending, inbound, outbound
+SCTP_SNDRCVINFO = struct.Struct('=HHH2xIIIIIi')  # stream, ssn, flags, ppid, context, ttl, tsn, cumtsn, assoc
+
+
+def encode_vlr_name(name):
+    """VLR name IE: the FQDN as DNS labels."""
+    labels = encode_fqdn(name)
+    return b'\x02' + bytes([len(labels)]) + labels
+
+
+def mm_information_templates(network_name):
+    """MM information contents around its time field: (full + short network name + time IEI, DST IE)."""
+    gsm_text, spare_bits = gsm_encode(network_name)
+    name = bytes([1 + len(gsm_text), 128 + spare_bits]) + gsm_text
+    head = b'\x43' + name + b'\x45' + name + b'\x47'
+    return head, b'\x49\x01\x00'  # dst
+
+
+VLR_IE = encode_vlr_name(VLR_NAME)
+VLR_NAME_VALUE = VLR_IE[2:]
+MM_INFORMATION_HEAD, MM_INFORMATION_TAIL = mm_information_templates(NETWORK_NAME)
+
+# operator test messages (stdin "2" and "3")
+TEST_CLI = b'\x01\x80\x12\x05\x00\x83\xf4'
+TEST_SMS_ORIGINATOR = '+351966872903'
+TEST_SMS_TEXT = 'Teste'
+
+# answers sent from handle_decode
+LOCATION_UPDATE_ACCEPT = Template('location_update_accept', 'imsi', 'lai', 'mobile_identity')
+LOCATION_UPDATE_REJECT = Template('location_update_reject', 'imsi', 'reject_cause', 'lai')
+MM_INFORMATION_REQUEST = Template('mm_information_request', 'imsi', 'mm_information')
+EPS_DETACH_ACK = Template('eps_detach_ack', 'imsi')
+IMSI_DETACH_ACK = Template('imsi_detach_ack', 'imsi')
+RESET_ACK = Template('reset_ack', 'vlr_name')
+
+# requests sent by bulk jobs
+ALERT_REQUEST = Template('alert_request', 'imsi')
+RESET_INDICATION = Template('reset_indication', 'vlr_name')
+
+SWAPPED_BCD = bytes((v % 10) << 4 | v // 10 for v in range(100))
+_time_cache = [None, b'']
+_association_ids = itertools.count()
+
 
 #
 #   SGs Messages Codes (29.118):
 #
 #	1 SGsAP-PAGING-REQUEST	             - from MSS to MME: Request <<<<<< ------------------- Can by sent by this app
-#	2 SGsAP-PAGING-REJECT	             - from MME to MSS: Answer to 1 (no success)
-#	6 SGsAP-SERVICE-REQUEST	             - from MME to MSS: Answer to 1 (success)
-#	7 SGsAP-DOWNLINK-UNITDATA	         - from MSS to MME  <<<<<< --------------------------- Can by sent by this app
+#	2 SGsAP-PAGING-REJECT	             - from MME to MSS: Answer to 1 (no success) ----------- Processed by this app (MT SMS)
+#	6 SGsAP-SERVICE-REQUEST	             - from MME to MSS: Answer to 1 (success) -------------- Processed by this app (MT SMS)
+#	7 SGsAP-DOWNLINK-UNITDATA	         - from MSS to MME  <<<<<< --------------------------- Can by sent by this app (MT SMS API)
 #	8 SGsAP-UPLINK-UNITDATA	             - from MME to MSS  >>>>>> --------------------------- Processed by this app
 #	9 SGsAP-LOCATION-UPDATE-REQUEST	     - from MME to MSS: Request -------------------------- Processed by this app
 #	10 SGsAP-LOCATION-UPDATE-ACCEPT	     - from MSS to MME: Answer to 9 (success)
@@ -85,369 +149,1098 @@ VLR_NAME = 'mss.epc.mnc' + MNC + '.mcc' + MCC + '.3gppnetwork.org'
 #	31 SGsAP-UE-UNREACHABLE	             - from MME to MSS:
 
 
-def binary2bytes(s):
-    return bytes(int(s[i: i + 8], 2) for i in range(0, len(s), 8))
-
-
-def splitbytes(b):
-    return bytes(b[i] for i in range(len(b) - 1, -1, -1))
-
-
-def gsm_encode(plaintext):
-    res = ""
-    for c in plaintext:
-        idx = gsm.find(c)
-        # print(c, idx)
-        if idx != -1:
-            res = '{0:08b}'.format(idx)[-7:] + res
-            # print (res, len(res))
-            continue
-        idx = ext.find(c)
-        if idx != -1:
-            res = '{0:08b}'.format(27)[-7:] + res
-            res = '{0:08b}'.format(idx)[-7:] + res
-
-    spare_bits = (8 - len(res) % 8) % 8
-    # print(spare_bits)
-    res = '0' * spare_bits + res
-
-    return splitbytes(binary2bytes(res)), spare_bits
-
-def decode_bcd(bcd_bytes):
-    """Convert BCD-encoded bytes to a string (e.g., IMSI or phone numbers)."""
-    return "".join(f"{(b & 0x0F)}{(b >> 4) & 0x0F}" for b in bcd_bytes).lstrip("f")  # Remove padding
-
-
-def parse_tpdu(tpdu_bytes):
-    """Parses a GSM 03.40 TPDU message (SMS-SUBMIT)."""
-    tp_mti = tpdu_bytes[0] & 0x03  # Extract Message Type Indicator
-    tp_pid = tpdu_bytes[1]  # Protocol Identifier
-    tp_udl = tpdu_bytes[2]  # User-Data Length
-    tp_user_data = tpdu_bytes[3:3 + tp_udl]  # Extract message content
-
-    # Attempt to decode SMS content
-    try:
-        sms_text = tp_user_data.decode("ascii").strip()
-    except UnicodeDecodeError:
-        sms_text = binascii.hexlify(tp_user_data).decode()  # Raw hex if decoding fails
+def handle_decode(decode, association=None):  # MME to MSS: Only processes messages that need answer
+    answer_list = [None]
 
-    return {
-        "TP-MTI": tp_mti,
-        "TP-PID": tp_pid,
-        "TP-UDL": tp_udl,
-        "SMS Text": sms_text
-    }
+    traced = 1 in decode and trace.wants(decode[1])
+    if unbound_mmes and association is not None and 1 in decode:
+        bind_restored(decode[1], association)
+    if traced:
+        logging.info("rx %s on %s", repr(decode), association)
 
+    if decode.type == 9:  # location-update-request
+        if 1 in decode and 4 in decode:
+            if hss is None:
+                location_update(decode[1], decode[4], decode.get(9), association, answer_list)
+            else:
+                imsi = bytes(decode[1])
+                cause = hss.verdict(imsi)
+                if cause is None:  # answered once PyHSS has replied; the views into the receive buffer are copied
+                    mme = decode.get(9)
+                    hss.ask(imsi, partial(location_update_authorized, imsi, bytes(decode[4]),
+                                          bytes(mme) if mme is not None else None, association))
+                elif cause == ACCEPT:
+                    location_update(decode[1], decode[4], decode.get(9), association, answer_list)
+                else:
+                    location_update_reject(imsi, decode[4], cause, answer_list)
 
-def handle_decode(decode):  # MME to MSS: Only processes messages that need answer
-    global session_dict
+    elif decode.type == 17:  # eps-detach-indication
+        if 1 in decode:
+            answer_list.append(EPS_DETACH_ACK(decode.value(1)))
+            subscribers.evict(decode[1])
 
-    answer_list = [None]
-    try:
-        decode[0]
-    except:
-        return answer_list
+    elif decode.type == 19:  # imsi-detach-indication
+        if 1 in decode:
+            answer_list.append(IMSI_DETACH_ACK(decode.value(1)))
+            subscribers.evict(decode[1])
+
+    elif decode.type == 21:  # reset-indication (the MME restarted and lost its SGs associations)
+        if 9 in decode:
+            mme = bytes(decode[9])
+            marked = subscribers.mark_unconfirmed(mme)
+            if association is not None:
+                bind_mme(mme, association)
+            logging.info("MME %s reset: %d subscribers unconfirmed until their next location update",
+                         decode_fqdn(mme[2:]), marked)
+            answer_list.append(RESET_ACK(VLR_NAME_VALUE))
+
+    elif decode.type == 22:  # reset-ack
+        if 9 in decode and association is not None:
+            bind_mme(bytes(decode[9]), association)
+
+    elif decode.type == 31:  # ue-unreachable
+        if 1 in decode:
+            pending.answered(PAGE, decode[1], ok=False)
+            imsi = bytes(decode[1])
+            subscribers.mark_unreachable(imsi)  # kept: stored MT SMS are paged with its TMSI and LAI later
+            mt_sms.on_unreachable(imsi)
 
-    if decode[0] == 9:  # location-update-request
+    elif decode.type == 6:  # service-request (paging answered)
+        if 1 in decode:
+            pending.answered(PAGE, decode[1])
+            answer_list += mt_sms.on_service_request(bytes(decode[1]))
 
-        if 1 in decode and 4 in decode:
-            # location-update-accept
-            logging.debug("location-update-accept")
-            answer = b'\x0a'
-            tmsi = b'\x0e\x05\xf4' + struct.pack('!I', random.randrange(pow(2, 32) - 1))
-            answer += decode[1] + decode[4] + tmsi
-            answer_list.append(answer)
-
-            session_dict['tmsi'] = b'\x03\x04' + tmsi[-4:]
-            session_dict['imsi'] = decode[1]
-            session_dict['lai'] = decode[4]
-            session_dict['mme'] = b'\x09' + bytes([len(decode[9])]) + decode[9]
-
-            # mm-information-request
-            gsm_text, spare_bits = gsm_encode(NETWORK_NAME)
-            answer = b'\x1a'
-            answer += decode[1]
-
-            answer += b'\x17' + bytes([17 + 2 * len(gsm_text)])
-            answer += b'\x43' + bytes([1 + len(gsm_text)]) + bytes([128 + spare_bits]) + gsm_text
-            answer += b'\x45' + bytes([1 + len(gsm_text)]) + bytes([128 + spare_bits]) + gsm_text
-            answer += b'\x47' + universal_time_and_local_time_zone()
-            answer += b'\x49\x01\x00'  # dst
-            answer_list.append(answer)
-
-
-    elif decode[0] == 17:  # eps-detach-indication
+    elif decode.type == 2:  # paging-reject
         if 1 in decode:
-            answer = b'\x12'
-            answer += decode[1]
-            answer_list.append(answer)
+            pending.answered(PAGE, decode[1], ok=False)
+            mt_sms.on_paging_reject(bytes(decode[1]))
 
-    elif decode[0] == 19:  # imsi-detach-indication
+    elif decode.type == 14:  # alert-ack
         if 1 in decode:
-            answer = b'\x14'
-            answer += decode[1]
-            answer_list.append(answer)
+            pending.answered(ALERT, decode[1])
+            imsi = bytes(decode[1])
+            subscribers.reachable(imsi)
+            mt_sms.resume(imsi)
 
-    elif decode[0] == 21:  # reset-indication
+    elif decode.type == 16:  # ue-activity-indication
         if 1 in decode:
-            answer = b'\x16'
-            answer += session_dict['vlr']
-            answer_list.append(answer)
+            imsi = bytes(decode[1])
+            subscribers.reachable(imsi)
+            mt_sms.resume(imsi)
 
+    elif decode.type == 15:  # alert-reject
+        if 1 in decode:
+            pending.answered(ALERT, decode[1], ok=False)
 
-    elif decode[0] == 8:  # sms
+    elif decode.type == 8:  # sms
         if 1 in decode and 22 in decode:
-            logging.debug("sms %s",  decode)
-            imsi = decode_bcd(decode[1])  # Decode IMSI
-            sms_hex = binascii.hexlify(decode[22]).decode()  # Convert NAS container (SMS TPDU) to hex
+            imsi = decode_imsi(decode[1])  # Decode IMSI
+
+            cp = None
+            parsed_tpdu = None
+            try:
+                cp = parse_cp_data(decode.value(22))
+                if 'tpdu' in cp:
+                    parsed_tpdu = parse_tpdu(cp['tpdu'])  # Extract TPDU
+                    if traced:
+                        logging.info("SMS Received: IMSI=%s, TPDU=%s %s", imsi, decode[22].hex(), parsed_tpdu)
+            except (IndexError, ValueError) as e:
+                logging.warning("undecodable SMS from IMSI=%s: %r %s", imsi, e, decode[22].hex())
+
+
+            if cp is not None and cp['cp'] not in (CP_ACK, CP_ERROR):
+                ti = cp['ti'] ^ 0x08  # answers go in the sender's transaction
+                answer_list.append(DOWNLINK_UNITDATA(decode.value(1), build_cp_ack(ti)))
+                if cp['ti'] < 0x08 and 'rp_mr' in cp:  # the MS started it: RP-ACK for its RP message
+                    rp = build_rp_ack(cp['rp_mr'], build_sms_submit_report(universal_time_and_local_time_zone()))
+                    answer_list.append(DOWNLINK_UNITDATA(decode.value(1), build_cp_data(ti, rp)))
+
+            if cp is not None and cp.get('rp_mti') in (RP_ACK_MS, RP_ERROR_MS):  # answer to an MT SMS
+                answer_list += mt_sms.on_rp_result(bytes(decode[1]), cp['rp_mr'], cp['rp_mti'] == RP_ACK_MS)
+
+            if parsed_tpdu is not None and "SMS Text" in parsed_tpdu:  # MO SMS
+                message = reassembler.add(imsi, parsed_tpdu)
+                if message is not None and smsc is not None:  # queued only
+                    smsc.forward(msisdn_by_imsi.get(imsi, imsi), message["TP-DA"], message["SMS Text"])
+                if billing is not None:  # one event per part, appended to a ring only
+                    billing.record(MO, imsi, msisdn_by_imsi.get(imsi, imsi), parsed_tpdu["TP-DA"])
 
-            raw_data = decode[22]
+    return answer_list
 
-            start_index = raw_data.index(b'\x16') + 2  # Skip Element ID and Length
-            tpdu_bytes = raw_data[start_index:]  # Extract TPDU
 
-            parsed_tpdu = parse_tpdu(tpdu_bytes)
+def location_update(imsi, lai, mme, association, answer_list):
+    """Accept a location update (IMSI, LAI and MME name IEs): LOCATION-UPDATE-ACCEPT and MM-INFORMATION-REQUEST."""
+    global last_imsi
 
-            logging.debug("SMS Received: IMSI=%s, TPDU=%s %s", imsi, sms_hex, parsed_tpdu)
+    sub = subscribers.update(imsi, lai, mme)
+    tmsi = subscribers.assign_tmsi(sub)  # kept across location updates, new one only for new UEs
 
+    # location-update-accept (without new TMSI when the TMSI space is exhausted, the UE then uses its IMSI)
+    if tmsi is not None:
+        identity = b'\xf4' + struct.pack('!I', tmsi)  # mobile identity: TMSI
+        answer_list.append(LOCATION_UPDATE_ACCEPT(imsi[2:], lai[2:], identity))
+    else:
+        logging.error("TMSI space exhausted")
+        answer_list.append(LOCATION_UPDATE_ACCEPT(imsi[2:], lai[2:], None))
 
-            if decode[22][3:4] != b'\x04' and decode[22][3:4] != b'\x10':
-                answer = b'\x07'
-                answer += decode[1]
-                answer += b'\x16\x00'  # length with zero. we put the length in the end.
+    if sub.mme is not None and association is not None:
+        bind_mme(sub.mme, association)
+    last_imsi = sub.imsi
+    mt_sms.resume(sub.imsi)
 
-                init_len = len(answer)
-                if decode[22][2] > 128:
-                    answer += bytes([decode[22][2] - 128]) + b'\x04'
-                else:
-                    answer += bytes([decode[22][2] + 128]) + b'\x04'
+    # mm-information-request
+    answer_list.append(MM_INFORMATION_REQUEST(imsi[2:], b''.join((
+        MM_INFORMATION_HEAD, universal_time_and_local_time_zone(), MM_INFORMATION_TAIL))))
 
-                nas_len = len(answer) - init_len
-                answer = bytearray(answer)
-                answer[init_len - 1] = nas_len
-                answer_list.append(answer)
 
-                if decode[22][2] < 128:
-                    answer = b'\x07'
-                    answer += decode[1]
-                    answer += b'\x16\x00'  # length with zero. we put the len in the end.
-                    init_len = len(answer)
+def location_update_reject(imsi, lai, cause, answer_list):
+    """LOCATION-UPDATE-REJECT with an MM cause; a subscriber known from earlier updates is forgotten."""
+    answer_list.append(LOCATION_UPDATE_REJECT(imsi[2:], cause, lai[2:]))
+    subscribers.evict(imsi)
 
-                    rp_message_reference = decode[22][6:7]
-                    answer += bytes([decode[22][2] + 128]) + b'\x01\x0d\x03' + rp_message_reference
-                    answer += b'\x41\x09\x01\x00' + universal_time_and_local_time_zone()
 
-                    nas_len = len(answer) - init_len
-                    answer = bytearray(answer)
-                    answer[init_len - 1] = nas_len
-                    answer_list.append(answer)
+def location_update_authorized(imsi, lai, mme, association, cause):
+    """PyHSS verdict for a location update that missed the cache (SubscriberAuth.ask callback).
 
-    return answer_list
+    Dropped when the association went down meanwhile: nothing was answered, the MME repeats the location
+    update on its next association, and binding its MME here would undo unbind_association.
+    """
+    if association is not None and association.closed:
+        logging.info("location update of %s: association %s went down before PyHSS answered", decode_imsi(imsi),
+                     association)
+        return
+    answer_list = [None]
+    if cause == ACCEPT:
+        location_update(imsi, lai, mme, association, answer_list)
+    else:
+        location_update_reject(imsi, lai, cause, answer_list)
+    if association is not None:
+        association.write(answer_list)
+
+
+def sms_delivered(imsi, originator):
+    """MT SMS acknowledged by the UE (mt_sms delivered hook)."""
+    if billing is not None:
+        digits = decode_imsi(imsi)
+        billing.record(MT, digits, msisdn_by_imsi.get(digits, digits), originator)
+
+
+def bind_restored(imsi, association):
+    """Subscribers restored from a snapshot (or left by a lost association) know their MME but not its
+    association: the first message about any of them tells which association the MME now uses."""
+    sub = subscribers.get(bytes(imsi))
+    if sub is not None and sub.mme in unbound_mmes:
+        bind_mme(sub.mme, association)
+        logging.info("MME %s is on association %s", decode_fqdn(sub.mme[2:]), association)
+
+
+def bind_mme(mme, association):
+    """Requests for the subscribers of mme (name IE) go to association from now on."""
+    previous = mme_associations.get(mme)
+    if previous is not association:
+        if previous is not None:
+            previous.mmes.discard(mme)
+        mme_associations[mme] = association
+        association.mmes.add(mme)
+    unbound_mmes.discard(mme)
+
+
+def unbind_association(association):
+    """Association lost: its MMEs' subscribers are kept, unconfirmed, and rebound by bind_restored."""
+    for mme in association.mmes:
+        if mme_associations.get(mme) is association:
+            del mme_associations[mme]
+        marked = subscribers.mark_unconfirmed(mme)
+        if mme in subscribers.unconfirmed:
+            unbound_mmes.add(mme)
+        logging.info("MME %s lost with %s: %d subscribers unconfirmed", decode_fqdn(mme[2:]), association, marked)
+    association.mmes.clear()
 
 
 def universal_time_and_local_time_zone():
-    return bcd(time.strftime("%Y%m%d%H%M%S")[2:]) + b'\x00'
-
-
-def bcd(chars):
-    bcd_string = ""
-    for i in range(len(chars) // 2):
-        bcd_string += chars[1 + 2 * i] + chars[2 * i]
-    bcd_bytes = bytearray.fromhex(bcd_string)
-    return bcd_bytes
+    """Semi-octet YYMMDDhhmmss + time zone 0, rebuilt at most once per second."""
+    now = int(time.time())
+    if now != _time_cache[0]:
+        t = time.localtime(now)
+        _time_cache[0] = now
+        _time_cache[1] = bytes(SWAPPED_BCD[v] for v in (t.tm_year % 100, t.tm_mon, t.tm_mday,
+                                                         t.tm_hour, t.tm_min, t.tm_sec, 0))
+    return _time_cache[1]
 
 
-def handle_send(message):
-    global session_dict
-
+def handle_send(message, imsi=None):
     request_list = [None]
 
+    sub = subscribers.get(imsi if imsi is not None else last_imsi)
+
     if message == 1:  # paging sms
-        if session_dict['imsi'] is not None and session_dict['tmsi'] is not None and session_dict['lai'] is not None:
-            request = b'\x01'
-            request += session_dict['imsi']
-            request += session_dict['vlr']
-            request += b'\x20\x01\x02'
-            request += session_dict['tmsi']
-            request += session_dict['lai']
-            request_list.append(request)
+        if sub is not None and sub.tmsi is not None and sub.lai is not None:
+            request_list.append(paging_request(sub.imsi, VLR_IE, SERVICE_SMS, sub.tmsi, sub.lai))
 
     if message == 2:  # paging cs call
-        if session_dict['imsi'] is not None and session_dict['tmsi'] is not None and session_dict['lai'] is not None:
-            request = b'\x01'
-            request += session_dict['imsi']
-            request += session_dict['vlr']
-            request += b'\x20\x01\x01'
-            request += session_dict['tmsi']
-            request += b'\x1c\x07\x01\x80\x12\x05\x00\x83\xf4'
-            request += session_dict['lai']
-            request_list.append(request)
-
-    elif message == 3:  # sms
-
-        if session_dict['imsi'] is not None:
-            request = b'\x07'
-            request += session_dict['imsi']
-            # example sms#
-            request += b'\x16\x27\x09\x01\x24\x01\x01\x07\x91\x53\x91\x26\x01\x00\x00\x00\x18\x04\x0c\x91\x53\x91\x66\x78\x92\x30\x00\x00\x02\x50\x50\x71\x84\x03\x40\x05\xd4\xf2\x9c\x5e\x06'
-            request_list.append(request)
+        if sub is not None and sub.tmsi is not None and sub.lai is not None:
+            request_list.append(paging_request(sub.imsi, VLR_IE, SERVICE_CS_CALL, sub.tmsi, sub.lai, TEST_CLI))
 
     elif message == 4:  # alert
-        request = b'\x0d'
-        request += session_dict['imsi']
-        request_list.append(request)
+        if sub is not None:
+            request_list.append(ALERT_REQUEST(sub.imsi[2:]))
 
     elif message == 5:  # reset
-        request = b'\x15'
-        request += session_dict['vlr']
-        request_list.append(request)
+        request_list.append(RESET_INDICATION(VLR_NAME_VALUE))
 
     return request_list
 
 
-# Information Elements
-
-# 1	    IMSI
-# 2	    VLR name
-# 3	    TMSI
-# 4	    Location area identifier
-# 5	    Channel Needed
-# 6	    eMLPP Priority
-# 7	    TMSI status
-# 8	    SGs cause
-# 9	    MME name
-# 10    EPS location update type
-# 11    Global CN-Id
-# 14    Mobile identity
-# 15    Reject cause
-# 16	IMSI detach from EPS service type
-# 17	IMSI detach from non-EPS service type
-# 21	IMEISV
-# 22	NAS message container
-# 23	MM information
-# 27	Erroneous message
-# 28    CLI
-# 29	LCS client identity
-# 30	LCS indicator
-# 31	SS code
-# 32	Service indicator
-# 33	UE Time Zone
-# 34	Mobile Station Classmark 2
-# 35	Tracking Area Identity
-# 36	E-UTRAN Cell Global Identity
-# 37	UE EMM mode
-# 38	Additional paging indicators
-# 39	TMSI based NRI container
-# 40	Selected CS domain operator
-# 41	Maximum UE Availability Time
-# 42	SM Delivery Timer
-# 43	SM Delivery Start Time
-# 44	Additional UE Unreachable indicators
-# 45	Maximum Retransmission Time
-# 46	Requested Retransmission Time
-
-def sgs_decode(buffer):
-    decode = {}
+def parse_lai(text):
+    """'MCC-MNC-LAC' (e.g. 001-01-1) or the 10 hex digits of the LAI IE contents to the LAI IE."""
+    parts = text.split('-')
+    if len(parts) == 3 and all(part.isdigit() for part in parts) and len(parts[0]) == 3 and len(parts[1]) in (2, 3):
+        return encode_lai(parts[0], parts[1], int(parts[2]))
+    if len(text) == 10:
+        return b'\x04\x05' + bytes.fromhex(text)
+    raise ValueError("LAI %r is neither MCC-MNC-LAC nor 10 hex digits" % text)
 
-    try:
-        decode[0] = buffer[0]
-        pointer = 1
-        while pointer < len(buffer):
-            if buffer[
-                pointer] not in decode:  # just catch new LAI (first occurrence). old LAI uses same Information Element ID but is not needed
-                decode[buffer[pointer]] = buffer[pointer:pointer + 2 + buffer[pointer + 1]]
-            pointer += 2 + buffer[pointer + 1]
 
-        return decode
-    except Exception as e:
+JOBS = ('page_lai', 'alert', 'reset', 'detach')  # the jobs bulk_operation knows
 
-        return decode
 
+def bulk_operation(name, params):
+    """Jobs for the JobRunner: (description, targets, action, total) for a job name and its parameters.
 
+    page_lai  {lai, service: sms|cs}   PAGING-REQUEST to every subscriber last seen in the LAI
+    alert     {imsis: [...]}           ALERT-REQUEST to each listed subscriber
+    reset     {}                       RESET-INDICATION on every association
+    detach    {mme: fqdn}              forget every subscriber behind the MME (implicit detach)
+    """
+    if name == 'page_lai':
+        lai = parse_lai(str(params.get('lai', '')))
+        service = SERVICE_CS_CALL if params.get('service') == 'cs' else SERVICE_SMS
+        imsis = subscribers.imsis_in(lai)
 
+        def page(imsi):
+            sub = subscribers.get(imsi)
+            if sub is None:
+                return SKIPPED
+            return pending.start(PAGE, imsi, paging_request(sub.imsi, VLR_IE, service, sub.tmsi, sub.lai))
+        return "LAI %s" % lai[2:].hex(), imsis, page, len(imsis)
 
-def main():
-    global server, session_dict
+    if name == 'alert':
+        imsis = [encode_imsi(str(imsi)) for imsi in params.get('imsis', []) if str(imsi).isdigit()]
+
+        def alert(imsi):
+            if imsi not in subscribers:
+                return SKIPPED
+            return pending.start(ALERT, imsi, ALERT_REQUEST(imsi[2:]))
+        return "%d IMSIs" % len(imsis), imsis, alert, len(imsis)
+
+    if name == 'reset':
+        targets = list(associations)
 
-    session_dict = {}
-    session_dict['imsi'] = None
-    session_dict['tmsi'] = None
-    session_dict['lai'] = None
+        def reset(association):
+            if association.closed:
+                return SKIPPED
+            return association.write([None, RESET_INDICATION(VLR_NAME_VALUE)])
+        return "%d associations" % len(targets), targets, reset, len(targets)
 
-    vlr_bytes = bytes()
-    vlr_l = VLR_NAME.split(".")
-    for word in vlr_l:
-        vlr_bytes += struct.pack("!B", len(word)) + word.encode()
-    session_dict['vlr'] = b'\x02' + bytes([len(vlr_bytes)]) + vlr_bytes
-    # session_dict['vlr'] = b'\x02' + bytes([len(VLR_NAME)]) + VLR_NAME
+    if name == 'detach':
+        labels = encode_fqdn(str(params.get('mme', '')))
+        mme = b'\x09' + bytes([len(labels)]) + labels
+        imsis = [sub.imsi for sub in subscribers.subscribers_of(mme)]
 
+        def detach(imsi):
+            if subscribers.evict(imsi) is None:
+                return SKIPPED
+            mt_sms.drop(imsi, "subscriber detached")
+            return DONE
+        return "MME %s" % params.get('mme'), imsis, detach, len(imsis)
 
+    raise ValueError("unknown job %r" % name)
 
-    server_address = ("172.22.0.40", 29118)
+
+def association_of(imsi):
+    """Association of the MME currently serving an IMSI, or None."""
+    sub = subscribers.get(imsi)
+    if sub is None or sub.mme is None:
+        return None
+    return mme_associations.get(sub.mme)
+
+
+def transmit(imsi, request):
+    """Send one request towards the MME serving imsi; False if it has no association."""
+    association = association_of(imsi)
+    if association is None:
+        return False
+    return association.write([None, request])
+
+
+def sctp_outbound_streams(sock):
+    """Outbound streams negotiated for an accepted SCTP association (1 if unknown)."""
+    try:
+        return max(1, SCTP_STATUS_FORMAT.unpack_from(sock.getsockopt(socket.IPPROTO_SCTP, SCTP_STATUS, 256))[6])
+    except OSError:
+        return 1
+
+
+class Association:
+    """One SCTP association with an MME, served by its own reader task.
+
+    framed: TCP connection standing in for an association, PDUs carry a 2 byte length prefix.
+
+    Outgoing PDUs go through write(), which queues them and sends whatever the socket takes without
+    waiting; the rest is sent when the socket becomes writable. On SCTP every UE related PDU is sent
+    on a stream chosen by its IMSI (stream 0 for the others, 29.118 section 9.1), so a message that
+    waits for retransmission only holds back UEs hashed onto the same stream.
+    """
+
+    def __init__(self, sock, address, framed=False):
+        self.sock = sock
+        self.address = address
+        self.framed = framed
+        self.id = next(_association_ids) & 0xffff  # in capture files
+        self.messages = 0
+        self.malformed = 0
+        self.task = None
+        self.mmes = set()  # name IEs of the MMEs served, see bind_mme
+        self.recv_time = None  # seconds in the last read, while stage timing is on
+
+        self.streams = 1 if framed else sctp_outbound_streams(sock)
+        self.sndrcv = [SCTP_SNDRCVINFO.pack(stream, 0, 0, 0, 0, 0, 0, 0, 0) for stream in range(self.streams)]
+        self.queue = deque()  # framed: bytes to send, SCTP: (pdu, stream)
+        self.queued = 0  # bytes
+        self.writing = False  # waiting for the socket to become writable
+        self.drained = None  # future of a reader waiting for the queue to drain
+        self.closed = False
+
+    def __repr__(self):
+        return "%s:%s" % self.address[:2]
+
+    def stream_of(self, pdu):
+        if self.streams < 2 or len(pdu) < 3 or pdu[1] != 1:  # IMSI IE comes first in every UE related message
+            return 0
+        return 1 + zlib.crc32(pdu[3:3 + pdu[2]]) % (self.streams - 1)
+
+    def write(self, message_list):
+        """Queue PDUs (None entries are skipped) and send what the socket takes now.
+
+        Returns False, without queueing anything, when the association is gone or holds more than
+        SEND_QUEUE_LIMIT bytes.
+        """
+        if self.closed or self.queued > SEND_QUEUE_LIMIT:
+            stats['send_refused'] += 1
+            return False
+        for pdu in message_list:
+            if pdu is not None:
+                message_counts.tx[pdu[0]] += 1
+                if self.framed:
+                    self.queue.append(struct.pack('!H', len(pdu)))
+                    self.queue.append(pdu)
+                    self.queued += 2 + len(pdu)
+                else:
+                    self.queue.append((pdu, self.stream_of(pdu)))
+                    self.queued += len(pdu)
+        if not self.writing:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Send queued PDUs until the socket would block; framed PDUs are coalesced into one send."""
+        queue = self.queue
+        try:
+            if self.framed:
+                while queue:
+                    data = b''.join(queue)
+                    sent = self.sock.send(data)
+                    queue.clear()
+                    self.queued -= sent
+                    if sent < len(data):
+                        queue.append(data[sent:])
+                        break
+            else:
+                ancillary = self.sndrcv
+                while queue:
+                    pdu, stream = queue[0]
+                    self.sock.sendmsg([pdu], [(socket.IPPROTO_SCTP, SCTP_SNDRCV, ancillary[stream])])
+                    queue.popleft()
+                    self.queued -= len(pdu)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:  # the reader sees the association go down
+            logging.warning("send to %s failed: %s", self, e)
+            self.close_queue()
+            return
+
+        loop = asyncio.get_running_loop()
+        if queue and not self.writing:
+            loop.add_writer(self.sock.fileno(), self.flush)
+            self.writing = True
+            stats['send_blocked'] += 1
+        elif not queue and self.writing:
+            loop.remove_writer(self.sock.fileno())
+            self.writing = False
+        if self.drained is not None and self.queued <= SEND_QUEUE_HIGH:
+            self.drained.set_result(None)
+            self.drained = None
+
+    async def drain(self):
+        """Wait until the send queue is below SEND_QUEUE_HIGH."""
+        if self.queued > SEND_QUEUE_HIGH and not self.closed:
+            self.drained = asyncio.get_running_loop().create_future()
+            await self.drained
+
+    def close_queue(self):
+        if self.writing:
+            asyncio.get_running_loop().remove_writer(self.sock.fileno())
+            self.writing = False
+        self.closed = True
+        self.queue.clear()
+        self.queued = 0
+        if self.drained is not None:
+            self.drained.set_result(None)
+            self.drained = None
+
+    async def wait_readable(self):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        loop.add_reader(self.sock.fileno(), waiter.set_result, None)
+        try:
+            await waiter
+        finally:
+            loop.remove_reader(self.sock.fileno())
+
+    async def serve(self):
+        """Read SCTP messages into one reusable buffer and answer each complete one.
+
+        A message ends where recvmsg reports MSG_EOR, so a PDU split over several reads is
+        reassembled in place. Everything already queued on the socket is drained before waiting.
+        """
+        buf = bytearray(RECV_BUFFER_SIZE)
+        view = memoryview(buf)
+        filled = 0
+        oversized = False
+        while True:
+            timing = stage_timing
+            if timing is not None:
+                started = time.perf_counter()
+            try:
+                nbytes, ancdata, flags, address = self.sock.recvmsg_into([view[filled:]])
+            except (BlockingIOError, InterruptedError):
+                await self.wait_readable()
+                continue
+            if timing is not None:
+                self.recv_time = time.perf_counter() - started
+            if nbytes == 0:
+                break
+            filled += nbytes
+
+            if not flags & socket.MSG_EOR:
+                if filled < len(buf):
+                    continue  # rest of the message is still to come
+                oversized = True  # larger than any SGsAP message; drop it up to its end
+                filled = 0
+                continue
+            if oversized:
+                oversized = False
+                filled = 0
+                self.report_malformed(SgsDecodeError("PDU larger than %d bytes" % len(buf), len(buf), b''))
+                continue
+
+            pdu = view[:filled]
+            filled = 0
+            await self.handle(pdu)
+
+    async def serve_framed(self):
+        """Length prefixed PDUs from a TCP stream, read into one reusable buffer."""
+        buf = bytearray(RECV_BUFFER_SIZE)
+        view = memoryview(buf)
+        filled = 0
+        while True:
+            timing = stage_timing
+            if timing is not None:
+                started = time.perf_counter()
+            try:
+                nbytes = self.sock.recv_into(view[filled:])
+            except (BlockingIOError, InterruptedError):
+                await self.wait_readable()
+                continue
+            if timing is not None:
+                self.recv_time = time.perf_counter() - started  # counted for the first PDU of the read
+            if nbytes == 0:
+                break
+            filled += nbytes
+
+            start = 0
+            while filled - start >= 2:
+                length = buf[start] << 8 | buf[start + 1]
+                if filled - start - 2 < length:
+                    break
+                await self.handle(view[start + 2:start + 2 + length])
+                start += 2 + length
+            if start:
+                buf[:filled - start] = buf[start:filled]
+                filled -= start
+            elif filled == len(buf):  # a 65535 byte frame does not fit; no SGsAP PDU is that long
+                raise ConnectionError("frame larger than %d bytes" % len(buf))
+
+    async def handle(self, pdu):
+        global messages_total
+
+        started = time.perf_counter()
+        timing = stage_timing  # None unless stage timing is on
+        self.messages += 1
+        messages_total += 1
+        if recorder is not None:
+            recorder.record(self.id, pdu)
+        try:
+            decode = sgs_decode(pdu)
+        except SgsDecodeError as e:
+            self.report_malformed(e)
+            if len(pdu) and pdu[0] != 29:  # never answer a STATUS with one
+                self.write([None, status(CAUSE_INVALID_MANDATORY_INFORMATION, pdu)])
+            return
+        message_counts.rx[decode.type] += 1
+        cause = check(decode)
+        if cause is not None:  # unknown message type or mandatory IE missing
+            logging.warning("rejected PDU from %s (SGs cause %d): %s", self, cause, bytes(pdu).hex())
+            if decode.type != 29:
+                self.write([None, status(cause, pdu, decode.get(1))])
+            return
+        if timing is not None:
+            decoded = time.perf_counter()
+        try:
+            answer_list = handle_decode(decode, self)
+        except Exception:  # one bad PDU must not take the association down
+            self.report_failed(decode, pdu)
+            return
+        if timing is not None:
+            handled = time.perf_counter()
+        self.write(answer_list)
+        finished = time.perf_counter()
+        latency.observe(finished - started)
+        if timing is not None:
+            timing.observe(decode.type, self.recv_time, decoded - started, handled - decoded, finished - handled)
+            self.recv_time = None
+        if self.queued > SEND_QUEUE_HIGH:  # the MME reads slower than it sends: stop reading for a while
+            await self.drain()
+
+    def report_failed(self, decode, pdu):
+        stats['failed'] += 1
+        logging.exception("handling %s from %s failed: %s", MESSAGE_NAMES.get(decode.type, decode.type), self,
+                          bytes(pdu).hex())
+        if decode.type != 29:
+            self.write([None, status(CAUSE_SEMANTICALLY_INCORRECT, pdu, decode.get(1))])
+
+    def report_malformed(self, error):
+        self.malformed += 1
+        stats['malformed'] += 1
+        logging.warning("malformed PDU from %s: %s %s", self, error, error.pdu.hex())
+
+
+async def serve_association(sock, address, framed=False):
+    association = Association(sock, address, framed)
+    association.task = asyncio.current_task()
+    associations[association] = None
+    stats['peak_associations'] = max(stats['peak_associations'], len(associations))
+    logging.info("association up %s (%d active)", association, len(associations))
+
+    try:
+        await (association.serve_framed() if framed else association.serve())
+    except (ConnectionError, OSError) as e:
+        logging.warning("association %s failed: %s", association, e)
+    except Exception:
+        logging.exception("association %s failed", association)
+    finally:
+        association.close_queue()
+        del associations[association]
+        unbind_association(association)
+        sock.close()
+        logging.info("association down %s (%d active, %d messages)", association, len(associations),
+                     association.messages)
+
+
+async def accept_associations(server, framed=False):
+    loop = asyncio.get_running_loop()
+    while True:
+        sock, address = await loop.sock_accept(server)
+        sock.setblocking(False)
+        if framed:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        loop.create_task(serve_association(sock, address, framed))
+
+
+async def report_stats(interval):
+    """Periodically log association count and message rate, with peaks seen so far."""
+    last_total = messages_total
+    last_time = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        rate = (messages_total - last_total) / (now - last_time)
+        last_total, last_time = messages_total, now
+        stats['peak_rate'] = max(stats['peak_rate'], rate)
+        if recorder is not None:
+            recorder.flush()
+        logging.info("stats: associations=%d (peak %d) msg/s=%.0f (peak %.0f) total=%d malformed=%d",
+                     len(associations), stats['peak_associations'], rate, stats['peak_rate'], messages_total,
+                     stats['malformed'])
+
+
+def handle_stdin(stop):
+    handle_command(sys.stdin.readline(), stop)
+
+
+def handle_command(msg, stop):
+    """One operator command line (stdin, or forwarded by the shard controller)."""
+    global recorder
+
+    parts = msg.split()
+    if msg == "" or parts[:1] == ["q"]:
+        stop.set_result(None)
+    elif parts[:1] in (["trace"], ["untrace"]) and len(parts) == 2:  # per-IMSI message logging
+        if parts[0] == "trace":
+            trace.add(encode_imsi(parts[1]))
+        else:
+            trace.remove(encode_imsi(parts[1]))
+        logging.info("trace: %s", trace.state())
+    elif parts[:1] == ["debug"] and len(parts) == 2:  # "debug on|off": sampled logging of all messages
+        trace.set_debug(parts[1] == "on")
+        logging.info("trace: %s", trace.state())
+    elif parts[:1] == ["record"] and len(parts) == 2:  # "record <file>" / "record off": capture received PDUs
+        if recorder is not None:
+            recorder.close()
+            logging.info("recorded %d PDUs to %s", recorder.count, recorder.path)
+            recorder = None
+        if parts[1] != "off":
+            recorder = Recorder(parts[1])
+            logging.info("recording to %s", parts[1])
+    elif parts[:1] == ["sample"] and len(parts) == 2 and parts[1].isdigit():
+        trace.set_sample(int(parts[1]))
+        logging.info("trace: %s", trace.state())
+    elif parts[:1] == ["job"] and len(parts) >= 2:  # bulk operation, see bulk_operation
+        params = {'page_lai': lambda: {'lai': parts[2], 'service': parts[3] if len(parts) > 3 else 'sms'},
+                  'alert': lambda: {'imsis': read_imsi_list(parts[2])},
+                  'detach': lambda: {'mme': parts[2]}}.get(parts[1], dict)
+        try:
+            jobs.start(parts[1], params())
+        except (IndexError, ValueError, OSError) as e:
+            logging.warning("job not started: %s (job page_lai <lai> [sms|cs] | alert <imsi,...|@file> | reset | "
+                            "detach <mme name>)", e)
+    elif parts[:1] == ["mmes"]:  # subscribers per MME and the association serving it
+        for mme, (confirmed, unconfirmed) in sorted(subscribers.mmes().items()):
+            logging.info("MME %s on %s: %d subscribers, %d unconfirmed", decode_fqdn(mme[2:]),
+                         mme_associations.get(mme, "no association"), confirmed + unconfirmed, unconfirmed)
+    elif parts[:1] == ["hss"] and parts[1:2] == ["forget"]:  # "hss forget [imsi]": drop cached PyHSS verdicts
+        if hss is not None:
+            hss.forget(encode_imsi(parts[2]) if len(parts) > 2 else None)
+            logging.info("PyHSS verdicts cached: %d", len(hss))
+    elif parts[:1] == ["stages"] and parts[1:2] in (["on"], ["off"]):  # per-stage timing of received PDUs
+        set_stage_timing(parts[1] == "on")
+    elif parts[:1] == ["profile"]:  # "profile [seconds [file]]": start the sampler, or stop it and dump
+        try:
+            profile(float(parts[1]) if len(parts) > 1 else None, parts[2] if len(parts) > 2 else None)
+        except (ValueError, OSError) as e:
+            logging.warning("profile: %s (profile [seconds [file]])", e)
+    elif parts[:1] == ["jobs"]:
+        for job in jobs.jobs.values():
+            logging.info("%s", job)
+    elif parts[:1] == ["cancel"] and len(parts) == 2 and parts[1].isdigit():
+        if not jobs.cancel(int(parts[1])):
+            logging.warning("no running job %s", parts[1])
+    elif parts and parts[0].isdigit():  # "<message> [imsi]", default is the last updated subscriber
+        message = int(parts[0])
+        imsi = encode_imsi(parts[1]) if len(parts) > 1 else last_imsi
+        if message == 3:  # test SMS, through the MT SMS queue: paged, stored while the UE is unreachable
+            reason = mt_sms.submit(imsi, TEST_SMS_ORIGINATOR, TEST_SMS_TEXT) if imsi else "no subscriber"
+            if reason is not None:
+                logging.warning("test SMS not sent: %s", reason)
+            return
+        request_list = handle_send(message, imsi)
+        if message in (1, 2, 4) and len(request_list) > 1:  # answered requests: retransmitted until then
+            if not pending.start(ALERT if message == 4 else PAGE, imsi, request_list[1]):
+                logging.warning("no association serving %s", decode_imsi(imsi))
+            return
+        targets = list(associations) if message == 5 else [association_of(imsi)]
+        for association in targets:
+            if association is None:
+                logging.warning("no association serving %s", decode_imsi(imsi) if imsi else "any subscriber")
+                continue
+            if not association.write(request_list):
+                logging.warning("send queue of %s is full", association)
+
+
+def set_stage_timing(on):
+    global stage_timing
+
+    stage_timing = stage_timers if on else None
+    logging.info("stage timing %s", "on" if on else "off")
+
+
+def profile(seconds=None, path=None):
+    """Start the sampling profiler, for seconds if given, or stop it and write the folded stacks."""
+    global profile_path, profile_timer
+
+    if profile_timer is not None:
+        profile_timer.cancel()
+        profile_timer = None
+    if sampler.running:
+        elapsed = sampler.stop()
+        samples = sampler.dump(profile_path)
+        logging.info("profiled %.1f s: %d samples in %s", elapsed, samples, profile_path)
+        return
+    profile_path = path or os.path.join(profile_dir, "sgs-%d-%s.folded" % (os.getpid(),
+                                                                           time.strftime('%Y%m%d-%H%M%S')))
+    sampler.start()
+    if seconds:
+        profile_timer = asyncio.get_running_loop().call_later(seconds, profile)
+    logging.info("profiling into %s (%s)", profile_path,
+                 "%g s" % seconds if seconds else "until SIGUSR1 or \"profile\"")
+
+
+def read_imsi_list(argument):
+    """'imsi,imsi,...' or '@file' with IMSIs separated by commas or whitespace."""
+    if argument.startswith('@'):
+        with open(argument[1:]) as f:
+            argument = f.read()
+    return argument.replace(',', ' ').split()
+
+
+def create_registry():
+    registry = Registry()
+    registry.add(message_counts)
+    registry.add(latency)
+    registry.add(stage_timers)
+    registry.add(Callback('sgs_malformed_total', "PDUs that could not be decoded", lambda: stats['malformed'],
+                          kind='counter'))
+    registry.add(Callback('sgs_failed_total', "Decoded PDUs whose handling raised an exception",
+                          lambda: stats['failed'], kind='counter'))
+    registry.add(Callback('sgs_associations', "MME associations up", lambda: len(associations)))
+    registry.add(Callback('sgs_send_queue_bytes', "Bytes waiting in association send queues",
+                          lambda: sum(association.queued for association in associations)))
+    registry.add(Callback('sgs_send_total', "Sends that found the socket full (blocked) or the queue over its limit "
+                          "(refused)", kind='counter', label='result',
+                          fn=lambda: {'blocked': stats['send_blocked'], 'refused': stats['send_refused']}))
+    registry.add(Callback('sgs_subscribers', "Subscribers with a location update", lambda: len(subscribers)))
+    registry.add(Callback('sgs_subscribers_unconfirmed', "Subscribers whose MME reset or went away since their "
+                          "last location update", lambda: subscribers.count_unconfirmed()))
+    registry.add(Callback('sgs_mt_sms_queued', "MT SMS waiting for delivery", lambda: mt_sms.stats['queued']))
+    registry.add(Callback('sgs_mt_sms_active', "Subscribers being paged or served", lambda: mt_sms.active))
+    registry.add(Callback('sgs_mt_sms_total', "MT SMS by outcome", kind='counter', label='result',
+                          fn=lambda: {k: mt_sms.stats[k] for k in ('submitted', 'rejected', 'delivered', 'failed',
+                                                                   'stored', 'resumed')}))
+    registry.add(Callback('sgs_retransmissions_total', "Unanswered requests sent again", kind='counter',
+                          fn=lambda: mt_sms.stats['retransmitted'] + pending.stats['retransmitted']))
+    registry.add(Callback('sgs_requests_total', "Operator pages and alerts by outcome", kind='counter',
+                          label='result', fn=lambda: {k: pending.stats[k] for k in
+                                                      ('sent', 'answered', 'rejected', 'expired')}))
+    registry.add(Callback('sgs_timers_pending', "Timers in the timer wheel", lambda: len(timers)))
+    registry.add(Callback('sgs_concat_pending', "Incomplete concatenated MO SMS", lambda: len(reassembler)))
+    if mt_store is not None:
+        registry.add(Callback('sgs_mt_sms_stored', "MT SMS stored for unreachable UEs", lambda: len(mt_store)))
+        registry.add(Callback('sgs_mt_store_commits_total', "Transactions committed to the MT SMS store",
+                              lambda: mt_store.stats['commits'], kind='counter'))
+    if smsc is not None:
+        registry.add(Callback('sgs_smsc_queue_depth', "MO SMS waiting for the SMSC (queue and spill)",
+                              smsc.depth))
+        registry.add(Callback('sgs_smsc_total', "MO SMS forwarding by outcome", kind='counter', label='result',
+                              fn=lambda: {k: smsc.stats[k] for k in ('forwarded', 'failed', 'spilled', 'dropped')}))
+    if billing is not None:
+        registry.add(Callback('sgs_sms_events_queued', "SMS charging events waiting for CGRateS", billing.depth))
+        registry.add(Callback('sgs_sms_events_total', "SMS charging events by outcome", kind='counter',
+                              label='result', fn=lambda: {k: billing.stats[k] for k in
+                                                          ('recorded', 'sent', 'rejected', 'spilled', 'dropped')}))
+    if hss is not None:
+        registry.add(Callback('sgs_hss_cache_entries', "PyHSS verdicts cached", lambda: len(hss)))
+        registry.add(Callback('sgs_hss_lookups_total', "Location update authorizations by cache outcome",
+                              kind='counter', label='result', fn=lambda: {k: hss.stats[k] for k in
+                                                                          ('hits', 'misses', 'coalesced',
+                                                                           'overflow', 'errors')}))
+        registry.add(Callback('sgs_location_updates_rejected_total', "Location updates rejected for PyHSS",
+                              lambda: hss.stats['rejected'], kind='counter'))
+    return registry
+
+
+def listening_socket(options):
+    """Bound and listening SGs socket; returns (socket, framed)."""
+    server_address = (options.address, options.port)
     logging.debug("starting up on %s port %s" % server_address)
 
     # socket options
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_SCTP)
+    framed = options.transport == 'tcp'
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0 if framed else socket.IPPROTO_SCTP)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind(server_address)
 
-    sctp_default_send_param = bytearray(server.getsockopt(132, 10, 32))
-    sctp_default_send_param[11] = 0  # PPI = 0
-    server.setsockopt(132, 10, sctp_default_send_param)
+    if not framed:  # ask for streams, so PDUs of different UEs do not queue behind each other (see Association)
+        server.setsockopt(socket.IPPROTO_SCTP, SCTP_INITMSG,
+                          SCTP_INITMSG_FORMAT.pack(options.sctp_streams, options.sctp_streams, 0, 0))
+
+    server.listen(socket.SOMAXCONN)
+    server.setblocking(False)
+    return server, framed
+
+
+def stop_on_sigterm(loop, stop):
+    loop.add_signal_handler(signal.SIGTERM, lambda: stop.done() or stop.set_result(None))  # docker stop
+
+
+def profile_on_sigusr1(loop, command):
+    loop.add_signal_handler(signal.SIGUSR1, command, "profile")  # kill -USR1: start, then stop and dump
+
+
+async def start_services(options, metrics_port):
+    """MSISDN map, SMSC forwarder, metrics, stats and MT SMS dispatch: what serving associations needs.
+
+    Returns (msisdn_map, exporter, tasks) for stop_services.
+    """
+    global smsc, msisdn_by_imsi, billing, hss
+
+    msisdn_map = load_msisdn_map(options.msisdn_map) if options.msisdn_map else {}
+    msisdn_by_imsi = {imsi: msisdn for msisdn, imsi in msisdn_map.items()}
+
+    smsc = forwarder_from_env(options.smsc_url, options.smsc_workers)
+    if smsc is not None:
+        smsc.start()
+        logging.info("forwarding MO SMS to %s", smsc.url)
+    if options.cgrates_url:
+        billing = SmsEvents(options.cgrates_url, options.sms_events_spill, options.cgrates_tenant)
+        logging.info("SMS events to CGRateS at %s (spill file %s)", billing.url, billing.spill_path)
+    if options.hss_url:
+        hss = SubscriberAuth(options.hss_url, options.hss_cache_size, options.hss_ttl, options.hss_negative_ttl,
+                             fail_open=not options.hss_fail_closed)
+        hss.start()
+        logging.info("location updates authorized by PyHSS at %s", hss.url)
+
+    exporter = None
+    if metrics_port:
+        exporter = await start_metrics(create_registry(), options.api_address, metrics_port)
+
+    loop = asyncio.get_running_loop()
+    tasks = [loop.create_task(report_stats(options.stats_interval)), loop.create_task(timers.run()), mt_sms.start()]
+    if billing is not None:
+        tasks.append(billing.start())
+    if mt_store is not None:
+        tasks.append(mt_store.start())
+    if persistence is not None:
+        tasks.append(loop.create_task(persistence.run(subscribers, options.state_flush, options.snapshot_interval)))
+    return msisdn_map, exporter, tasks
+
+
+async def stop_services(exporter, tasks):
+    jobs.stop()
+    if sampler.running:
+        profile()  # stop and dump
+    for task in tasks:
+        task.cancel()
+    if persistence is not None:
+        await persistence.close(subscribers)
+    if mt_store is not None:
+        await mt_store.close()
+    if exporter is not None:
+        await exporter.cleanup()
+    if smsc is not None:
+        await smsc.close()
+    if billing is not None:
+        await billing.close()
+    if hss is not None:
+        await hss.close()
+    for association in list(associations):
+        association.task.cancel()
+
+
+async def serve(options):
+    global server
+
+    server, framed = listening_socket(options)
+
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    try:
+        loop.add_reader(sys.stdin, handle_stdin, stop)
+    except (OSError, ValueError):  # stdin is not pollable (e.g. /dev/null inside a container)
+        logging.debug("stdin control disabled")
+    stop_on_sigterm(loop, stop)
+    profile_on_sigusr1(loop, lambda line: handle_command(line, stop))
+
+    msisdn_map, exporter, tasks = await start_services(options, options.metrics_port)
+    api = await start_api(create_app(mt_sms, trace, msisdn_map, jobs), options.api_address, options.api_port,
+                          options.api_socket)
+    tasks.append(loop.create_task(accept_associations(server, framed)))
+    try:
+        await stop
+    finally:
+        await api.cleanup()
+        await stop_services(exporter, tasks)
+        server.close()
+
+
+def option_parser():
+    parser = OptionParser()
+    parser.add_option("-a", "--address", dest="address", default=os.environ.get('SGS_IP', '172.22.0.40'),
+                      help="local address to listen on")
+    parser.add_option("-p", "--port", dest="port", type="int", default=29118, help="local SCTP port")
+    parser.add_option("--transport", dest="transport", choices=["sctp", "tcp"], default="sctp",
+                      help="sctp, or tcp with 2 byte length framing (benchmarks where SCTP is unavailable)")
+    parser.add_option("--sctp-streams", dest="sctp_streams", type="int", default=16,
+                      help="SCTP streams to offer; stream 0 carries non UE messages, IMSIs are hashed on the others")
+    parser.add_option("--stats-interval", dest="stats_interval", type="float", default=10.0,
+                      help="seconds between association/throughput reports")
+    parser.add_option("--api-address", dest="api_address", default=os.environ.get('SGS_IP', '0.0.0.0'),
+                      help="HTTP API address")
+    parser.add_option("--api-port", dest="api_port", type="int", default=8029, help="HTTP API port (0 disables)")
+    parser.add_option("--api-socket", dest="api_socket", default=None, help="HTTP API Unix socket path")
+    parser.add_option("--msisdn-map", dest="msisdn_map", default=None,
+                      help="file of 'msisdn,imsi' lines for MT SMS addressed by MSISDN")
+    parser.add_option("--smsc-url", dest="smsc_url", default=None,
+                      help="SMSC HTTP API for MO SMS (default: $SMSC_API_URL, enabled by it or $SMSC_API_TOKEN)")
+    parser.add_option("--smsc-workers", dest="smsc_workers", type="int", default=8,
+                      help="concurrent SMSC requests")
+    parser.add_option("--cgrates-url", dest="cgrates_url", default=os.environ.get('CGRATES_URL'),
+                      help="CGRateS JSON-RPC URL for SMS charging events, e.g. http://cgrates:2080/jsonrpc")
+    parser.add_option("--cgrates-tenant", dest="cgrates_tenant",
+                      default=os.environ.get('CGRATES_TENANT', 'cgrates.org'),
+                      help="CGRateS tenant of the SMS events")
+    parser.add_option("--sms-events-spill", dest="sms_events_spill", default="sms_events.spill",
+                      help="file keeping SMS events while CGRateS is unavailable")
+    parser.add_option("--hss-url", dest="hss_url", default=os.environ.get('PYHSS_URL'),
+                      help="PyHSS REST API authorizing location updates, e.g. http://pyhss:8080 (unset: all accepted)")
+    parser.add_option("--hss-ttl", dest="hss_ttl", type="float", default=300.0,
+                      help="seconds a subscriber known to PyHSS stays authorized without asking again")
+    parser.add_option("--hss-negative-ttl", dest="hss_negative_ttl", type="float", default=60.0,
+                      help="seconds an IMSI unknown to (or disabled in) PyHSS stays rejected without asking again")
+    parser.add_option("--hss-cache-size", dest="hss_cache_size", type="int", default=100000,
+                      help="PyHSS verdicts cached at most")
+    parser.add_option("--hss-fail-closed", dest="hss_fail_closed", action="store_true", default=False,
+                      help="reject (network failure) location updates PyHSS cannot be asked about, instead of "
+                      "accepting them")
+    parser.add_option("--concat-timeout", dest="concat_timeout", type="float", default=60.0,
+                      help="seconds to wait for the missing parts of a concatenated MO SMS")
+    parser.add_option("--concat-pending", dest="concat_pending", type="int", default=10000,
+                      help="incomplete concatenated MO SMS kept at most")
+    parser.add_option("--mt-rate", dest="mt_rate", type="float", default=1000.0, help="MT SMS pages per second")
+    parser.add_option("--mt-concurrency", dest="mt_concurrency", type="int", default=500,
+                      help="subscribers in MT SMS delivery at the same time")
+    parser.add_option("--mt-queue-limit", dest="mt_queue_limit", type="int", default=100,
+                      help="queued MT SMS per subscriber")
+    parser.add_option("--mt-timeout", dest="mt_timeout", type="float", default=10.0,
+                      help="seconds to wait for SERVICE-REQUEST / RP-ACK before sending again")
+    parser.add_option("--mt-retries", dest="mt_retries", type="int", default=2,
+                      help="MT SMS PAGING-REQUEST / DOWNLINK-UNITDATA retransmissions before giving up")
+    parser.add_option("--mt-store", dest="mt_store", default=os.environ.get('SGS_MT_STORE'),
+                      help="SQLite database keeping MT SMS for unreachable UEs (unset: they are dropped)")
+    parser.add_option("--mt-store-ttl", dest="mt_store_ttl", type="float", default=172800.0,
+                      help="seconds a stored MT SMS is kept")
+    parser.add_option("--mt-store-limit", dest="mt_store_limit", type="int", default=100,
+                      help="stored MT SMS per subscriber")
+    parser.add_option("--page-interval", dest="page_interval", type="float", default=5.0,
+                      help="seconds to wait for the answer to an operator page or alert before sending again")
+    parser.add_option("--page-retries", dest="page_retries", type="int", default=2,
+                      help="operator page / alert retransmissions before giving up")
+    parser.add_option("--job-rate", dest="job_rate", type="float", default=200.0,
+                      help="targets per second of bulk jobs (page a LAI, alert a list, reset, detach an MME)")
+    parser.add_option("--metrics-port", dest="metrics_port", type="int", default=9091,
+                      help="Prometheus /metrics port on the API address (0 disables)")
+    parser.add_option("--stage-timers", dest="stage_timers", action="store_true", default=False,
+                      help="time recv / decode / handle / send of received PDUs from the start (\"stages on|off\")")
+    parser.add_option("--profile-interval", dest="profile_interval", type="float", default=0.005,
+                      help="CPU seconds between stack samples of the profiler (\"profile\" or SIGUSR1)")
+    parser.add_option("--profile-dir", dest="profile_dir", default=os.environ.get('SGS_PROFILE_DIR', '.'),
+                      help="directory of the folded stacks files written by the profiler")
+    parser.add_option("--log-level", dest="log_level", default=os.environ.get('SGS_LOG_LEVEL', 'INFO'),
+                      help="DEBUG, INFO, WARNING, ...")
+    parser.add_option("--log-sample", dest="log_sample", type="int", default=100,
+                      help="with debug on, log one message in N (0: only traced IMSIs)")
+    parser.add_option("--workers", dest="workers", type="int", default=int(os.environ.get('SGS_WORKERS', 1)),
+                      help="worker processes; above 1 the parent hands associations to workers (see shard.py)")
+    parser.add_option("--shared-capacity", dest="shared_capacity", type="int", default=1 << 21,
+                      help="subscriber slots of the shared table with --workers")
+    parser.add_option("--state", dest="state", default=os.environ.get('SGS_STATE'),
+                      help="keep subscribers across restarts in <STATE>.snap and <STATE>.log.N")
+    parser.add_option("--snapshot-interval", dest="snapshot_interval", type="float", default=300.0,
+                      help="seconds between snapshots with --state (0: only at shutdown)")
+    parser.add_option("--state-flush", dest="state_flush", type="float", default=0.2,
+                      help="seconds between change log writes with --state")
+    parser.add_option("--nri", dest="nri", type="int", default=0, help="NRI carried in allocated TMSIs")
+    parser.add_option("--nri-bits", dest="nri_bits", type="int", default=0, help="NRI length in bits (0-10)")
+    parser.add_option("--tmsi-capacity", dest="tmsi_capacity", type="int", default=1 << 24,
+                      help="TMSIs available for allocation")
+    parser.set_defaults(tmsi_partition=(0, 1))  # (worker, workers) with --workers
+    parser.add_option("--record", dest="record", default=None,
+                      help="append every received PDU to this capture file (see capture.py)")
+    return parser
+
+
+def init_state(options):
+    """Module state used by the handlers; also what capture.py replays against."""
+    global subscribers, last_imsi, mme_associations, reassembler, associations, stats, messages_total
+    global trace, message_counts, latency, mt_sms, smsc, msisdn_by_imsi, recorder, persistence, unbound_mmes
+    global timers, pending, jobs, billing, hss, stage_timers, stage_timing, sampler, profile_dir, profile_path
+    global profile_timer, mt_store
+
+    trace = Trace(logging.getLogger().level, sample_every=options.log_sample)
+    subscribers = SubscriberStore(TmsiAllocator(options.nri, options.nri_bits, options.tmsi_capacity,
+                                                options.tmsi_partition))
+    last_imsi = None
+    mme_associations = {}
+    persistence = None
+    if options.state:
+        persistence = Persistence(options.state)
+        persistence.load(subscribers)
+        subscribers.mirrors.append(persistence)
+    unbound_mmes = set(subscribers.by_mme)
+    reassembler = Reassembler(timeout=options.concat_timeout, max_pending=options.concat_pending)
+    timers = TimerWheel()
+    pending = PendingRequests(timers, transmit, options.page_interval, options.page_retries)
+    mt_store = None
+    if options.mt_store:
+        mt_store = MtStore(options.mt_store, options.mt_store_ttl, options.mt_store_limit)
+        mt_store.open()
+    mt_sms = MtSmsDispatcher(subscribers, VLR_IE, SMSC_ADDRESS, transmit, universal_time_and_local_time_zone,
+                             rate=options.mt_rate, concurrency=options.mt_concurrency,
+                             queue_limit=options.mt_queue_limit, timeout=options.mt_timeout,
+                             retries=options.mt_retries, timers=timers, delivered=sms_delivered, store=mt_store)
+    jobs = JobRunner(bulk_operation, rate=options.job_rate)
+    smsc = None
+    billing = None
+    hss = None
+    msisdn_by_imsi = {}
+    recorder = Recorder(options.record) if options.record else None
+
+    associations = {}
+    stats = {'peak_associations': 0, 'peak_rate': 0.0, 'malformed': 0, 'failed': 0, 'send_blocked': 0,
+             'send_refused': 0}
+    messages_total = 0
+    message_counts = MessageCounter('sgs_messages_total', "SGsAP messages by direction and type")
+    latency = Histogram('sgs_answer_latency_seconds', "Time from receiving a PDU to its answers being sent")
+    stage_timers = StageTimers()
+    stage_timing = stage_timers if options.stage_timers else None
+    sampler = Sampler(options.profile_interval)
+    profile_dir = options.profile_dir
+    profile_path = None
+    profile_timer = None
 
-    server.listen()
 
-    client, address = server.accept()
+def main():
+    (options, args) = option_parser().parse_args()
+
+    listener = setup_logging(logging.getLevelName(options.log_level.upper()))
+    logging.info("Starting SGsAP MSS Server...")
+    if options.workers > 1:
+        from shard import run_sharded
+        try:
+            run_sharded(options)
+        finally:
+            listener.stop()
+        return
+    init_state(options)
 
-    socket_list = [sys.stdin, client]
+    try:
+        asyncio.run(serve(options))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if recorder is not None:
+            recorder.close()
+        listener.stop()
 
-    while True:
-        read_sockets, write_sockets, error_sockets = select.select(socket_list, [], [])
-
-        for sock in read_sockets:
-            if sock == client:
-                buffer = client.recv(4096)
-                answer_list = handle_decode(sgs_decode(buffer))
-                for i in answer_list:
-                    if i is not None:
-                        client.send(i)
-
-            elif sock == sys.stdin:
-                msg = sys.stdin.readline()
-                if msg == "q\n":
-                    exit(1)
-                elif msg[:-1].isdigit() == True:
-
-                    request_list = handle_send(int(msg[:-1]))
-                    for i in request_list:
-                        if i is not None:
-                            client.send(i)
-
-    server.close()
-
-async def send_sms(current_user, message):
-    recipient_phone = message.recipient_phone.replace('+', '').replace(' ', '')
-
-    # Prepare request payload
-    payload = {
-        "cid": current_user.phone_number,
-        "body": message.content,
-        "to": [recipient_phone],
-        "encoding": "UCS2"
-    }
-
-    # Send message via external API
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            "https://smsc-api.vinoc.mx/api/v3/messages/send",
-            json=payload,
-            headers={
-                "Authorization": f"Bearer {settings.SMSC_API_TOKEN}",
-                "Content-Type": "application/json",
-                "accept": "application/json"
-            }
-        ) as response:
-            response_data = await response.json()
-            return response_data
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
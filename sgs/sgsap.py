@@ -0,0 +1,368 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     SGsAP codec (29.118)
+#     --------------------
+#
+#   -> decoder works on a memoryview and records IE offsets,
+#      IEs are only sliced (never copied) when they are read
+#   -> messages and IEs are declared in MESSAGES / IES; encode() builds any message from them,
+#      sizing the buffer once and writing it in one pass
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+
+# Information elements: IEI -> (name, value length, or None when variable)
+IES = {
+    1: ('imsi', None),
+    2: ('vlr_name', None),
+    3: ('tmsi', 4),
+    4: ('lai', 5),
+    5: ('channel_needed', 1),
+    6: ('emlpp_priority', 1),
+    7: ('tmsi_status', 1),
+    8: ('sgs_cause', 1),
+    9: ('mme_name', None),
+    10: ('eps_location_update_type', 1),
+    11: ('global_cn_id', 5),
+    14: ('mobile_identity', None),
+    15: ('reject_cause', 1),
+    16: ('imsi_detach_from_eps_service_type', 1),
+    17: ('imsi_detach_from_non_eps_service_type', 1),
+    21: ('imeisv', 8),
+    22: ('nas_message_container', None),
+    23: ('mm_information', None),
+    27: ('erroneous_message', None),
+    28: ('cli', None),
+    29: ('lcs_client_identity', None),
+    30: ('lcs_indicator', 1),
+    31: ('ss_code', 1),
+    32: ('service_indicator', 1),
+    33: ('ue_time_zone', 1),
+    34: ('mobile_station_classmark_2', 3),
+    35: ('tai', 5),
+    36: ('e_cgi', 7),
+    37: ('ue_emm_mode', 1),
+    38: ('additional_paging_indicators', 1),
+    39: ('tmsi_based_nri_container', 2),
+    40: ('selected_cs_domain_operator', 3),
+    41: ('maximum_ue_availability_time', 4),
+    42: ('sm_delivery_timer', 2),
+    43: ('sm_delivery_start_time', 4),
+    44: ('additional_ue_unreachable_indicators', 1),
+    45: ('maximum_retransmission_time', 4),
+    46: ('requested_retransmission_time', 4),
+}
+IEI = {name: iei for iei, (name, _) in IES.items()}
+IEI['old_lai'] = 4  # second LAI of a LOCATION-UPDATE-REQUEST
+
+# Messages: type -> (name, mandatory IEs, optional and conditional IEs[, encoding order]); without an encoding
+# order the mandatory IEs come first, then the others, each in the order given
+MESSAGES = {
+    1: ('paging_request', 'imsi vlr_name service_indicator',
+        'tmsi cli lai global_cn_id ss_code lcs_indicator lcs_client_identity channel_needed emlpp_priority '
+        'additional_paging_indicators sm_delivery_timer sm_delivery_start_time maximum_retransmission_time'),
+    2: ('paging_reject', 'imsi sgs_cause', ''),
+    6: ('service_request', 'imsi service_indicator',
+        'imeisv ue_time_zone mobile_station_classmark_2 tai e_cgi ue_emm_mode'),
+    7: ('downlink_unitdata', 'imsi nas_message_container', ''),
+    8: ('uplink_unitdata', 'imsi nas_message_container',
+        'imeisv ue_time_zone mobile_station_classmark_2 tai e_cgi'),
+    9: ('location_update_request', 'imsi mme_name eps_location_update_type lai',
+        'old_lai tmsi_status imeisv tai e_cgi tmsi_based_nri_container selected_cs_domain_operator'),
+    10: ('location_update_accept', 'imsi lai', 'mobile_identity'),
+    11: ('location_update_reject', 'imsi reject_cause', 'lai'),
+    12: ('tmsi_reallocation_complete', 'imsi', ''),
+    13: ('alert_request', 'imsi', ''),
+    14: ('alert_ack', 'imsi', ''),
+    15: ('alert_reject', 'imsi sgs_cause', ''),
+    16: ('ue_activity_indication', 'imsi', 'maximum_ue_availability_time'),
+    17: ('eps_detach_indication', 'imsi mme_name imsi_detach_from_eps_service_type', ''),
+    18: ('eps_detach_ack', 'imsi', ''),
+    19: ('imsi_detach_indication', 'imsi mme_name imsi_detach_from_non_eps_service_type', ''),
+    20: ('imsi_detach_ack', 'imsi', ''),
+    21: ('reset_indication', '', 'mme_name vlr_name'),
+    22: ('reset_ack', '', 'mme_name vlr_name'),
+    23: ('service_abort_request', 'imsi', ''),
+    24: ('mo_csfb_indication', 'imsi', 'tai e_cgi'),
+    26: ('mm_information_request', 'imsi mm_information', ''),
+    27: ('release_request', 'imsi', 'sgs_cause'),
+    29: ('status', 'sgs_cause erroneous_message', 'imsi', 'imsi sgs_cause erroneous_message'),  # 29.118 8.23
+    31: ('ue_unreachable', 'imsi sgs_cause', 'requested_retransmission_time additional_ue_unreachable_indicators'),
+}
+
+# SGs cause values (IE 8)
+CAUSE_IMSI_DETACHED_FOR_EPS = 0x01
+CAUSE_IMSI_DETACHED_FOR_EPS_AND_NON_EPS = 0x02
+CAUSE_IMSI_UNKNOWN = 0x03
+CAUSE_IMSI_DETACHED_FOR_NON_EPS = 0x04
+CAUSE_IMSI_IMPLICITLY_DETACHED_FOR_NON_EPS = 0x05
+CAUSE_UE_UNREACHABLE = 0x06
+CAUSE_MESSAGE_NOT_COMPATIBLE = 0x07
+CAUSE_MISSING_MANDATORY_IE = 0x08
+CAUSE_INVALID_MANDATORY_INFORMATION = 0x09
+CAUSE_CONDITIONAL_IE_ERROR = 0x0a
+CAUSE_SEMANTICALLY_INCORRECT = 0x0b
+CAUSE_MESSAGE_UNKNOWN = 0x0c
+
+
+def decode_bcd(bcd_bytes):
+    """Convert BCD-encoded bytes to a string (e.g., IMSI or phone numbers)."""
+    return "".join("%x%x" % (b & 0x0F, b >> 4) for b in bcd_bytes).rstrip("f")  # Remove padding
+
+
+def encode_bcd(digits):
+    """Digit string to swapped semi-octets, padded with 0xf (inverse of decode_bcd)."""
+    digits += 'f' * (len(digits) % 2)
+    return bytes(int(digits[i + 1], 16) << 4 | int(digits[i], 16) for i in range(0, len(digits), 2))
+
+
+def decode_imsi(imsi_ie):
+    """IMSI IE (IEI, length, identity digits) to a digit string."""
+    return "%d" % (imsi_ie[2] >> 4) + decode_bcd(imsi_ie[3:])
+
+
+def encode_imsi(digits):
+    """Digit string to an IMSI IE: first digit next to odd/even flag and type 001, then BCD pairs."""
+    odd = len(digits) % 2
+    rest = digits[1:] + ('' if odd else 'f')
+    identity = bytes([int(digits[0]) << 4 | odd << 3 | 0x01])
+    identity += encode_bcd(rest)
+    return b'\x01' + bytes([len(identity)]) + identity
+
+
+def encode_fqdn(name):
+    """Domain name as DNS labels: the contents of the VLR name and MME name IEs."""
+    return b''.join(bytes([len(label)]) + label.encode() for label in name.split('.'))
+
+
+def decode_fqdn(labels):
+    """Inverse of encode_fqdn (an MME name IE's contents to 'mmec01.mmegi0001.mme...')."""
+    names = []
+    offset = 0
+    while offset < len(labels):
+        length = labels[offset]
+        names.append(bytes(labels[offset + 1:offset + 1 + length]).decode(errors='replace'))
+        offset += 1 + length
+    return '.'.join(names)
+
+
+def encode_lai(mcc, mnc, lac):
+    """LAI IE from MCC / MNC digit strings and the LAC number (24.008 10.5.1.3)."""
+    plmn = encode_bcd(mcc[:2]) + encode_bcd(mcc[2] + (mnc[2] if len(mnc) == 3 else 'f')) + encode_bcd(mnc[:2])
+    return b'\x04\x05' + plmn + lac.to_bytes(2, 'big')
+
+
+class MessageSpec:
+    """One message of MESSAGES. fields: name -> (position, IEI, fixed value length or None, mandatory)."""
+
+    __slots__ = ('type', 'name', 'head', 'fields', 'mandatory')
+
+    def __init__(self, message_type, name, mandatory, optional, order=None):
+        required = mandatory.split()
+        fields = order.split() if order else required + optional.split()
+        self.type = message_type
+        self.name = name
+        self.head = bytes([message_type])
+        self.fields = {field: (position, IEI[field], IES[IEI[field]][1], field in required)
+                       for position, field in enumerate(fields)}
+        self.mandatory = tuple((IEI[field], IES[IEI[field]][1]) for field in required)  # (IEI, fixed length or None)
+
+
+SPECS = {}
+for _type, _definition in MESSAGES.items():
+    SPECS[_type] = SPECS[_definition[0]] = MessageSpec(_type, *_definition)
+
+# Message types, as used in metric labels and logs
+MESSAGE_NAMES = {message_type: definition[0] for message_type, definition in MESSAGES.items()}
+
+
+LENGTH_OCTETS = tuple(bytes([n]) for n in range(256))
+
+
+class Template:
+    """Encoder for one message with a fixed list of IEs, prepared from MESSAGES once.
+
+    Call it with the IE contents (without IEI and length) in the order the fields were given:
+    bytes-like, or an int for fixed-length IEs; None leaves an optional IE out. IEI and length
+    octets of fixed-length IEs are built here, so a call only joins the pieces (one copy).
+    """
+
+    __slots__ = ('spec', 'fields', 'layout', 'order')
+
+    def __init__(self, message, *fields):
+        spec = self.spec = SPECS[message]
+        unknown = [field for field in fields if field not in spec.fields]
+        if unknown:
+            raise ValueError("%s has no IE %s" % (spec.name, ", ".join(unknown)))
+        missing = [field for field, (_, _, _, mandatory) in spec.fields.items() if mandatory and field not in fields]
+        if missing:
+            raise ValueError("%s: mandatory IE %s missing" % (spec.name, ", ".join(missing)))
+        self.fields = fields
+        # argument index, IEI octet, fixed length, IEI + length octets (fixed length only), mandatory
+        self.layout = tuple((fields.index(field), bytes([iei]), size,
+                             bytes([iei, size]) if size is not None else None, mandatory)
+                            for field, (_, iei, size, mandatory) in sorted(
+                                ((field, spec.fields[field]) for field in fields), key=lambda f: f[1][0]))
+
+    def pieces(self, values):
+        pieces = [self.spec.head]
+        for index, iei, size, header, mandatory in self.layout:
+            value = values[index]
+            if value is None:
+                if mandatory:
+                    raise ValueError("%s: mandatory IE %s missing" % (self.spec.name, self.fields[index]))
+                continue
+            if size is None:
+                if len(value) > 255:
+                    raise ValueError("%s: IE %s too long" % (self.spec.name, self.fields[index]))
+                pieces.append(iei)
+                pieces.append(LENGTH_OCTETS[len(value)])
+            else:
+                if value.__class__ is int:
+                    value = value.to_bytes(size, 'big')
+                elif len(value) != size:
+                    raise ValueError("%s: IE %s has %d octets, not %d" % (self.spec.name, self.fields[index],
+                                                                         len(value), size))
+                pieces.append(header)
+            pieces.append(value)
+        return pieces
+
+    def __call__(self, *values):
+        return b''.join(self.pieces(values))
+
+
+_templates = {}
+
+
+def encode(message, **values):
+    """One message (type or name of MESSAGES) from IE contents given by IE name, see Template."""
+    key = (message, tuple(values))
+    template = _templates.get(key)
+    if template is None:
+        template = _templates[key] = Template(message, *values)
+    return template(*values.values())
+
+
+def check(pdu):
+    """SGs cause for a STATUS answer to a decoded PDU of unknown type, without a mandatory IE, or with an
+    empty mandatory IE or one of the wrong fixed length; else None."""
+    spec = SPECS.get(pdu.type)
+    if spec is None:
+        return CAUSE_MESSAGE_UNKNOWN
+    ies, buf = pdu.ies, pdu.buf
+    for iei, size in spec.mandatory:
+        offset = ies.get(iei)
+        if offset is None:
+            return CAUSE_MISSING_MANDATORY_IE
+        length = buf[offset + 1]
+        if (length != size) if size is not None else not length:
+            return CAUSE_INVALID_MANDATORY_INFORMATION
+    return None
+
+
+def status(cause, erroneous_message, imsi_ie=None):
+    """SGsAP-STATUS (29) quoting (the first 255 octets of) the offending PDU."""
+    return encode('status', sgs_cause=cause, erroneous_message=erroneous_message[:255],
+                  imsi=imsi_ie[2:] if imsi_ie is not None and len(imsi_ie) > 2 else None)
+
+
+# Service indicator (IE 32)
+SERVICE_CS_CALL = 0x01
+SERVICE_SMS = 0x02
+
+
+PAGING_REQUEST = Template('paging_request', 'imsi', 'vlr_name', 'service_indicator', 'tmsi', 'cli', 'lai')
+DOWNLINK_UNITDATA = Template('downlink_unitdata', 'imsi', 'nas_message_container')
+
+
+def paging_request(imsi_ie, vlr_ie, service_indicator, tmsi=None, lai=None, cli=None):
+    """SGsAP-PAGING-REQUEST (1) from the IMSI, VLR name and LAI IEs as stored. tmsi is an int."""
+    return PAGING_REQUEST(imsi_ie[2:], vlr_ie[2:], service_indicator, tmsi, cli, lai[2:] if lai is not None else None)
+
+
+def downlink_unitdata(imsi_ie, nas):
+    """SGsAP-DOWNLINK-UNITDATA (7) carrying one NAS message container."""
+    return DOWNLINK_UNITDATA(imsi_ie[2:], nas)
+
+
+class SgsDecodeError(ValueError):
+    """Malformed SGsAP PDU. offset points at the IE (or byte) where decoding stopped."""
+
+    def __init__(self, reason, offset, pdu):
+        super().__init__("%s at offset %d" % (reason, offset))
+        self.reason = reason
+        self.offset = offset
+        self.pdu = bytes(pdu)
+
+
+class SgsPdu:
+    """Decoded SGsAP message: the message type plus IE offsets into the received buffer.
+
+    pdu[iei] returns the whole IE (IEI, length, value) as a memoryview of the first occurrence,
+    get_all(iei) returns every occurrence (e.g. new and old LAI). The views point into the receive
+    buffer, so copy (bytes()) whatever has to outlive the next read.
+    """
+
+    __slots__ = ('buf', 'type', 'ies', 'repeated')
+
+    def __init__(self, buf, ies, repeated=None):
+        self.buf = buf
+        self.type = buf[0]
+        self.ies = ies            # iei -> offset of the first occurrence
+        self.repeated = repeated  # [(iei, offset), ...] for further occurrences, None if there are none
+
+    def __contains__(self, iei):
+        return iei in self.ies
+
+    def __getitem__(self, iei):
+        offset = self.ies[iei]
+        return self.buf[offset:offset + 2 + self.buf[offset + 1]]
+
+    def get(self, iei, default=None):
+        offset = self.ies.get(iei)
+        if offset is None:
+            return default
+        return self.buf[offset:offset + 2 + self.buf[offset + 1]]
+
+    def value(self, iei):
+        """IE contents without IEI and length."""
+        offset = self.ies[iei]
+        return self.buf[offset + 2:offset + 2 + self.buf[offset + 1]]
+
+    def get_all(self, iei):
+        offsets = [self.ies[iei]] if iei in self.ies else []
+        if self.repeated:
+            offsets += [offset for i, offset in self.repeated if i == iei]
+        return [self.buf[offset:offset + 2 + self.buf[offset + 1]] for offset in offsets]
+
+    def __repr__(self):
+        return "SgsPdu(type=%d, ies={%s})" % (
+            self.type, ", ".join("%d: %s" % (iei, self[iei].hex()) for iei in self.ies))
+
+
+def sgs_decode(buffer):
+    """Decode one complete SGsAP message. Raises SgsDecodeError on empty or truncated PDUs."""
+    view = buffer if isinstance(buffer, memoryview) else memoryview(buffer)
+    length = len(view)
+    if length == 0:
+        raise SgsDecodeError("empty PDU", 0, view)
+
+    ies = {}
+    repeated = None
+    pointer = 1
+    while pointer < length:
+        if pointer + 2 > length:
+            raise SgsDecodeError("truncated IE header", pointer, view)
+        iei = view[pointer]
+        end = pointer + 2 + view[pointer + 1]
+        if end > length:
+            raise SgsDecodeError("IE %d overruns PDU (%d > %d)" % (iei, end, length), pointer, view)
+        if iei not in ies:
+            ies[iei] = pointer
+        else:  # e.g. old LAI, which reuses the LAI IEI after the new one
+            if repeated is None:
+                repeated = []
+            repeated.append((iei, pointer))
+        pointer = end
+
+    return SgsPdu(view, ies, repeated)
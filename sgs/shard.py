@@ -0,0 +1,835 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     Multi-process SGs server (--workers N)
+#     --------------------------------------
+#
+#   -> the parent listens, accepts and hands every association (its fd) to the worker with the
+#      fewest associations; a worker serves its associations like the single process server
+#   -> workers mirror their subscribers into a shared-memory table (IMSI -> TMSI, LAI, worker),
+#      so the parent routes MT SMS (HTTP API) and operator commands to the worker that can reach a UE
+#   -> workers export metrics on metrics_port + 1 + index; the parent scrapes them for its own /metrics,
+#      labelled worker="N", so Prometheus scrapes one target whatever the number of workers
+#   -> a worker that exits is started again with the same index (so it restores <state>.N); one that exits
+#      within RESTART_UPTIME seconds of its start stops the parent, with exit status 1, for the supervisor
+#   -> parent <-> worker control over a SEQPACKET socketpair:
+#      'A' + fd  new association          'S' + json  MT SMS [imsi IE hex, from, text]
+#      'C' + line  operator command       'D'  association closed (worker -> parent)
+#   -> with --mt-store every worker keeps a store of its own: MT SMS for an IMSI no worker serves go to
+#      the worker chosen by a hash of the IMSI; when an IMSI moves to a worker, the others hand what
+#      they stored for it over through the parent:
+#      'M' + IMSI IE  now served here (worker -> parent)   'H' + IMSI IE  hand stored MT SMS over
+#      'T' + json  one stored MT SMS [imsi IE hex, from, TPDU hex] (worker -> parent -> new owner)
+#   -> a worker restores its own <state>.N; the parent places a new association only once its first PDU
+#      is in (peeked, not consumed), on the worker holding restored subscribers of the MME it names
+#      (or of the UE it is about), so that worker binds them to it:
+#      'U' + count + MME IE  waiting for that MME's association   'B' + MME IE  bound (worker -> parent)
+#      'R'  restored, every 'U' sent (worker -> parent)
+#      subscribers of the MME restored in other workers are served again after their next location update
+#   -> bulk jobs of the API run in every worker, on what it serves, at rate / workers (an alert only in the
+#      workers serving its IMSIs); the parent sums their progress:
+#      'J' + json  [job id, name, params, rate, more]  ('more': an alert's IMSIs continue in the next 'J')
+#      'K' + job id  cancel   'P' + json  [job id, progress] (worker -> parent, every second and at the end)
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+import zlib
+from multiprocessing import shared_memory
+
+import aiohttp
+
+import server
+from api import create_app, load_msisdn_map, start_api
+from jobs import Job
+from logconfig import Trace, setup_logging
+from metrics import Callback, Registry, start_metrics
+from sgsap import SgsDecodeError, decode_imsi, encode_imsi, sgs_decode
+
+# state, IMSI value length, IMSI value, LAI value, worker, TMSI
+SLOT = struct.Struct('=BB8s5sBI')
+EMPTY, USED, DELETED = 0, 1, 2
+NO_TMSI = 0xffffffff
+NO_LAI = b'\xff' * 5
+RESTART_UPTIME = 10.0  # a worker exiting sooner after its start is not started again
+
+
+class SharedSubscriberTable:
+    """Open addressing IMSI table in shared memory, written by the workers and read by the parent.
+
+    The table is split into segments with one lock each; a key probes only inside its segment,
+    so writers of different segments never touch the same slots. Create it before forking.
+    """
+
+    def __init__(self, capacity=1 << 21, segments=64):
+        self.segments = segments
+        self.segment_size = max(1 << (max(capacity // segments, 16) - 1).bit_length(), 16)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.segments * self.segment_size * SLOT.size)
+        self.buf = self.shm.buf
+        context = multiprocessing.get_context('fork')
+        self.locks = [context.Lock() for _ in range(segments)]
+        self.counts = context.Array('l', segments, lock=False)  # updated under the segment lock
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def _find(self, value):
+        """(segment, offset of the slot holding value or None, offset of the first free slot or None)."""
+        h = zlib.crc32(value)
+        segment = h % self.segments
+        base = segment * self.segment_size
+        mask = self.segment_size - 1
+        index = (h // self.segments) & mask
+        free = None
+        for _ in range(self.segment_size):
+            offset = (base + index) * SLOT.size
+            state, length = self.buf[offset], self.buf[offset + 1]
+            if state == EMPTY:
+                return segment, None, offset if free is None else free
+            if state == DELETED:
+                if free is None:
+                    free = offset
+            elif length == len(value) and self.buf[offset + 2:offset + 2 + length] == value:
+                return segment, offset, free
+            index = (index + 1) & mask
+        return segment, None, free
+
+    def put(self, imsi_ie, tmsi, lai_ie, worker):
+        """Insert or update. Returns the worker that had the IMSI before (-1 for none), None when the IMSI's
+        segment is full."""
+        value = bytes(imsi_ie[2:])
+        record = SLOT.pack(USED, len(value), value, bytes(lai_ie[2:7]) if lai_ie is not None else NO_LAI,
+                           worker, NO_TMSI if tmsi is None else tmsi)
+        segment = zlib.crc32(value) % self.segments
+        with self.locks[segment]:
+            _, offset, free = self._find(value)
+            if offset is None:
+                if free is None:
+                    return None
+                offset = free
+                previous = -1
+                self.counts[segment] += 1
+            else:
+                previous = self.buf[offset + 15]
+            self.buf[offset:offset + SLOT.size] = record
+        return previous
+
+    def get(self, imsi_ie):
+        """(tmsi, LAI IE, worker) or None."""
+        value = bytes(imsi_ie[2:])
+        with self.locks[zlib.crc32(value) % self.segments]:
+            _, offset, _ = self._find(value)
+            if offset is None:
+                return None
+            _, _, _, lai, worker, tmsi = SLOT.unpack_from(self.buf, offset)
+        return (None if tmsi == NO_TMSI else tmsi, None if lai == NO_LAI else b'\x04\x05' + lai, worker)
+
+    def delete(self, imsi_ie, worker=None):
+        """Remove an IMSI; with worker given, only if that worker still owns it."""
+        value = bytes(imsi_ie[2:])
+        segment = zlib.crc32(value) % self.segments
+        with self.locks[segment]:
+            _, offset, _ = self._find(value)
+            if offset is None or (worker is not None and self.buf[offset + 15] != worker):
+                return False
+            self.buf[offset] = DELETED
+            self.counts[segment] -= 1
+        return True
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class TableMirror:
+    """SubscriberStore mirror writing one worker's subscribers into the shared table.
+
+    moved(imsi) is called for an IMSI this worker did not serve before, if set.
+    """
+
+    def __init__(self, table, worker):
+        self.table = table
+        self.worker = worker
+        self.full = False
+        self.moved = None
+
+    def put(self, sub):
+        previous = self.table.put(sub.imsi, sub.tmsi, sub.lai, self.worker)
+        if previous is None:
+            if not self.full:
+                self.full = True
+                logging.warning("shared subscriber table full, raise --shared-capacity")
+        elif previous != self.worker and self.moved is not None:
+            self.moved(sub.imsi)
+
+    def delete(self, imsi):
+        self.table.delete(imsi, self.worker)
+
+
+# # # # # # # # # # # # # # # # worker # # # # # # # # # # # # # # # #
+
+def worker_main(index, channel, table, options):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent stops the workers
+    listener = setup_logging(logging.getLevelName(options.log_level.upper()))
+    if options.record:
+        options.record = "%s.%d" % (options.record, index)
+    if options.state:
+        options.state = "%s.%d" % (options.state, index)
+    options.sms_events_spill = "%s.%d" % (options.sms_events_spill, index)
+    if options.mt_store:
+        options.mt_store = "%s.%d" % (options.mt_store, index)
+    options.tmsi_partition = (index, options.workers)  # workers never hand out the same TMSI
+    server.init_state(options)
+    mirror = TableMirror(table, index)
+    for sub in server.subscribers.by_imsi.values():  # restored from the worker's snapshot
+        mirror.put(sub)
+    server.subscribers.mirrors.append(mirror)
+    if server.mt_store is not None:
+        mirror.moved = lambda imsi: send_parent(channel, b'M' + imsi)
+    try:
+        asyncio.run(serve_worker(index, channel, options))
+    finally:
+        if server.recorder is not None:
+            server.recorder.close()
+        listener.stop()
+
+
+class UnboundMmes(set):
+    """server.unbound_mmes of a worker, which tells the parent the MMEs it waits for ('U', 'B')."""
+
+    def __init__(self, mmes, channel):
+        super().__init__(mmes)
+        self.channel = channel
+
+    def report(self, mme):
+        subscribers = server.subscribers
+        count = len(subscribers.by_mme.get(mme, ())) + len(subscribers.unconfirmed.get(mme, ()))
+        send_parent(self.channel, b'U' + struct.pack('!I', count) + mme)
+
+    def add(self, mme):
+        super().add(mme)
+        self.report(mme)
+
+    def discard(self, mme):
+        if mme in self:
+            super().discard(mme)
+            send_parent(self.channel, b'B' + mme)
+
+
+def send_parent(channel, message):
+    try:
+        channel.send(message)
+        return True
+    except BlockingIOError:
+        logging.warning("control channel to the parent full")
+        return False
+
+
+async def hand_over(channel, imsi):
+    """Send the MT SMS stored here for an IMSI now served by another worker to the parent, for that worker."""
+    store = server.mt_store
+    rows = await store.load(imsi)
+    for sent, (row, tpdu, originator) in enumerate(rows):
+        if not send_parent(channel, b'T' + json.dumps([imsi.hex(), originator, tpdu.hex()]).encode()):
+            store.kept(imsi, [row for row, _, _ in rows[sent:]])  # the rest stays here
+            return
+        store.delete(row)
+    if rows:
+        logging.info("MT SMS to %s: %d stored message(s) handed over", imsi.hex(), len(rows))
+
+
+async def report_job(channel, job_id, job, running):
+    """Progress of a worker's part of a job to the parent, every second until it ends."""
+    while job.state == 'running':
+        send_parent(channel, b'P' + json.dumps([job_id, job.progress()]).encode())
+        await asyncio.wait([job.task], timeout=1.0)
+    running.pop(job_id, None)
+    send_parent(channel, b'P' + json.dumps([job_id, job.progress()]).encode())
+
+
+async def serve_worker(index, channel, options):
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    server.stop_on_sigterm(loop, stop)
+    server.profile_on_sigusr1(loop, lambda line: server.handle_command(line, stop))
+    channel.setblocking(False)
+    framed = options.transport == 'tcp'
+    arriving = {}  # parent job id -> IMSIs of an alert sent in several messages
+    running = {}  # parent job id -> Job
+
+    def start_job(job_id, name, params, rate, more):
+        if more:
+            arriving.setdefault(job_id, []).extend(params['imsis'])
+            return
+        if job_id in arriving:
+            params['imsis'] = arriving.pop(job_id) + params['imsis']
+        try:
+            job = running[job_id] = server.jobs.start(name, params, rate)
+        except ValueError as e:
+            logging.warning("job %d not started: %s", job_id, e)
+            send_parent(channel, b'P' + json.dumps([job_id, {'state': 'failed', 'done': 0, 'failed': 0,
+                                                                 'skipped': 0, 'total': 0}]).encode())
+            return
+        loop.create_task(report_job(channel, job_id, job, running))
+
+    def on_control():
+        while True:
+            try:
+                message, fds, _, _ = socket.recv_fds(channel, 65536, 1)
+            except (BlockingIOError, InterruptedError):
+                return
+            if not message:  # parent gone
+                if not stop.done():
+                    stop.set_result(None)
+                return
+            kind, body = message[:1], message[1:]
+            if kind == b'A' and fds:
+                sock = socket.socket(fileno=fds[0])
+                sock.setblocking(False)
+                loop.create_task(serve_pinned(sock, framed))
+            elif kind == b'S':
+                imsi, originator, text = json.loads(body)
+                server.mt_sms.submit(bytes.fromhex(imsi), originator, text)
+            elif kind == b'C':
+                server.handle_command(body.decode(), stop)
+            elif kind == b'J':
+                start_job(*json.loads(body))
+            elif kind == b'K':
+                job = running.get(int(body))
+                if job is not None:
+                    server.jobs.cancel(job.id)
+            elif kind == b'H':
+                if server.mt_store.has(body) and body not in server.mt_sms.loading:
+                    loop.create_task(hand_over(channel, body))
+            elif kind == b'T':
+                imsi, originator, tpdu = json.loads(body)
+                imsi = bytes.fromhex(imsi)
+                if server.mt_store.add(imsi, bytes.fromhex(tpdu), originator) is None:
+                    logging.warning("MT SMS to %s handed over but the store is full, dropped", imsi.hex())
+                server.mt_sms.resume(imsi)
+
+    async def serve_pinned(sock, framed):
+        try:
+            await server.serve_association(sock, sock.getpeername(), framed)
+        finally:
+            try:
+                channel.send(b'D')
+            except OSError:
+                pass
+
+    metrics_port = options.metrics_port + 1 + index if options.metrics_port else 0
+    _, exporter, tasks = await server.start_services(options, metrics_port)
+    server.unbound_mmes = UnboundMmes(server.unbound_mmes, channel)
+    for mme in server.unbound_mmes:
+        server.unbound_mmes.report(mme)
+    send_parent(channel, b'R')
+    loop.add_reader(channel.fileno(), on_control)
+    logging.info("worker %d ready (pid %d)", index, os.getpid())
+    try:
+        await stop
+    finally:
+        loop.remove_reader(channel.fileno())
+        await server.stop_services(exporter, tasks)
+
+
+# # # # # # # # # # # # # # # # parent # # # # # # # # # # # # # # # #
+
+class Worker:
+    __slots__ = ('index', 'process', 'channel', 'associations', 'ready', 'started')
+
+    def __init__(self, index, process, channel):
+        self.index = index
+        self.process = process
+        self.channel = channel
+        self.associations = 0
+        self.ready = False  # its restored MMEs are reported
+        self.started = time.monotonic()
+
+
+class ShardJob:
+    """A bulk job of the parent: the parts run by the workers, their last reported progress."""
+
+    def __init__(self, job_id, name, description, workers, skipped=0):
+        self.id = job_id
+        self.name = name
+        self.description = description
+        self.parts = dict.fromkeys(workers)  # worker index -> progress, None until reported
+        self.skipped = skipped  # targets no worker serves
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def state(self):
+        reports = self.parts.values()
+        if None in reports or any(p['state'] == 'running' for p in reports):
+            return 'running'
+        states = {p['state'] for p in reports}
+        return 'failed' if 'failed' in states else 'cancelled' if 'cancelled' in states else 'finished'
+
+    def report(self, index, progress):
+        self.parts[index] = progress
+        if self.state != 'running' and self.finished is None:
+            self.finished = time.monotonic()
+            logging.info("%s", self)
+
+    def progress(self):
+        reports = [p for p in self.parts.values() if p is not None]
+        counts = {key: sum(p[key] for p in reports) for key in ('done', 'failed', 'skipped')}
+        counts['skipped'] += self.skipped
+        totals = [p['total'] for p in reports]
+        total = None if len(reports) < len(self.parts) or None in totals else sum(totals) + self.skipped
+        elapsed = (self.finished or time.monotonic()) - self.started
+        processed = sum(counts.values())
+        return dict(counts, id=self.id, job=self.name, description=self.description, state=self.state,
+                    total=total, elapsed=round(elapsed, 3), rate=round(processed / elapsed, 1) if elapsed else 0.0,
+                    workers=len(self.parts))
+
+    __str__ = Job.__str__
+
+
+class ShardJobs:
+    """JobRunner for the API of the parent: the workers run the jobs, see the header."""
+
+    CHUNK = 2000  # IMSIs of an alert per message, well inside the 64 KiB the workers read at once
+
+    def __init__(self, controller, rate, keep=20):
+        self.controller = controller
+        self.rate = rate
+        self.keep = keep
+        self.jobs = {}
+        self.ids = itertools.count(1)
+
+    def start(self, name, params, rate=None):
+        if name not in server.JOBS:
+            raise ValueError("unknown job %r" % name)
+        if name == 'page_lai':
+            lai = server.parse_lai(str(params.get('lai', '')))
+        if name == 'alert' and not isinstance(params.get('imsis', []), list):
+            raise ValueError("imsis: expected a list")
+        workers = self.controller.workers
+        rate = (rate or self.rate) / len(workers)
+        job_id = next(self.ids)
+        skipped = 0
+        if name == 'alert':
+            imsis = params.get('imsis', [])
+            parts = {}
+            for imsi in imsis:
+                imsi = str(imsi)
+                worker = self.controller.owner(encode_imsi(imsi)) if imsi.isdigit() else None
+                if worker is None:
+                    skipped += 1
+                else:
+                    parts.setdefault(worker, []).append(imsi)
+            description = "%d IMSIs" % len(imsis)
+            messages = {worker: [[job_id, name, {'imsis': chunk[start:start + self.CHUNK]}, rate,
+                                  start + self.CHUNK < len(chunk)] for start in range(0, len(chunk), self.CHUNK)]
+                        for worker, chunk in parts.items()}
+        else:
+            if name == 'page_lai':
+                params = {'lai': params['lai'], 'service': params.get('service', 'sms')}
+                description = "LAI %s" % lai[2:].hex()
+            elif name == 'detach':
+                params = {'mme': str(params.get('mme', ''))}
+                description = "MME %s" % params['mme']
+            else:
+                params = {}
+                description = "every association"
+            messages = {worker: [[job_id, name, params, rate, False]] for worker in workers}
+        job = self.jobs[job_id] = ShardJob(job_id, name, description, [worker.index for worker in messages],
+                                           skipped)
+        for worker, parts in messages.items():
+            if not all(self.controller.send(worker, b'J' + json.dumps(part).encode()) for part in parts):
+                self.lost(worker.index)
+        if not messages:
+            job.finished = time.monotonic()
+        logging.info("job %d %s (%s) started in %d workers", job_id, name, description, len(messages))
+        self._forget()
+        return job
+
+    def _forget(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.state != 'running']
+        for job_id in finished[:max(0, len(finished) - self.keep)]:
+            del self.jobs[job_id]
+
+    def report(self, index, job_id, progress):
+        job = self.jobs.get(job_id)
+        if job is not None and index in job.parts:
+            job.report(index, progress)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.state != 'running':
+            return False
+        for worker in self.controller.workers:
+            if worker.index in job.parts:
+                self.controller.send(worker, b'K%d' % job_id)
+        return True
+
+    def lost(self, index):
+        """A worker's parts of the running jobs will not report any more."""
+        for job in self.jobs.values():
+            progress = job.parts.get(index, False)
+            if progress is None or progress is not False and progress['state'] == 'running':
+                job.report(index, dict(progress or {'done': 0, 'failed': 0, 'skipped': 0, 'total': None},
+                                       state='failed'))
+
+
+class Controller:
+    """Parent side: worker processes, association placement and routing by IMSI."""
+
+    def __init__(self, options):
+        self.options = options
+        self.table = SharedSubscriberTable(options.shared_capacity)
+        self.workers = []
+        self.stats = {'submitted': 0, 'rejected': 0, 'delivered': 0, 'failed': 0, 'queued': 0}
+        self.queues = {}  # MT SMS queues live in the workers
+        self.active = 0
+        self.jobs = ShardJobs(self, options.job_rate)
+        self.unbound = {}  # MME name IE -> {worker index: restored subscribers} while a worker waits for it
+        self.ready = None  # asyncio.Event, set once every worker is ready
+        self.stop = None  # future of serve_parent
+        self.failed = False  # a worker kept exiting
+
+    def start_worker(self, index):
+        context = multiprocessing.get_context('fork')
+        parent_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        process = context.Process(target=worker_main, args=(index, worker_end, self.table, self.options),
+                                  name="sgs-worker-%d" % index, daemon=True)
+        process.start()
+        worker_end.close()
+        parent_end.setblocking(False)
+        return Worker(index, process, parent_end)
+
+    def start_workers(self):
+        self.workers = [self.start_worker(index) for index in range(self.options.workers)]
+
+    def worker_exited(self, worker):
+        """Start a worker that exited again; its shared table entries are left to the new one, which restores
+        them (the others it answers as unknown IMSIs until they move)."""
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(worker.channel.fileno())
+        worker.channel.close()
+        worker.process.join(1)
+        uptime = time.monotonic() - worker.started
+        logging.error("worker %d exited (status %s) after %.0f s", worker.index, worker.process.exitcode, uptime)
+        self.jobs.lost(worker.index)
+        for mme in [mme for mme, holders in self.unbound.items() if holders.pop(worker.index, None) is not None]:
+            if not self.unbound[mme]:
+                del self.unbound[mme]
+        if uptime < RESTART_UPTIME:
+            logging.error("worker %d exits right after its start, stopping", worker.index)
+            self.failed = True
+            if not self.stop.done():
+                self.stop.set_result(None)
+            return
+        self.ready.clear()  # new associations wait until it has restored
+        worker = self.workers[worker.index] = self.start_worker(worker.index)
+        loop.add_reader(worker.channel.fileno(), self.on_worker_message, worker)
+        logging.info("worker %d started again (pid %d)", worker.index, worker.process.pid)
+
+    def stop_workers(self):
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            worker.process.join(5)
+            worker.channel.close()
+        self.table.close(unlink=True)
+
+    async def route(self, sock, framed):
+        """Place an accepted association once its first PDU is in and the workers are ready."""
+        pdu = await first_pdu(sock, framed)
+        await self.ready.wait()
+        self.place(sock, pdu)
+
+    def restored_on(self, pdu):
+        """Worker waiting for the MME (or holding the UE) a first PDU is about, if any."""
+        holders = self.unbound.get(bytes(pdu[9])) if 9 in pdu else None
+        if holders:
+            return self.workers[max(holders, key=holders.get)]
+        owner = self.owner(bytes(pdu[1])) if 1 in pdu else None
+        if owner is not None and any(owner.index in holders for holders in self.unbound.values()):
+            return owner
+        return None
+
+    def place(self, sock, pdu=None):
+        """Hand an accepted association to the worker holding its restored subscribers, else the least loaded."""
+        worker = self.restored_on(pdu) if pdu is not None and self.unbound else None
+        if worker is None:
+            worker = min(self.workers, key=lambda w: w.associations)
+        logging.info("association %s -> worker %d", sock_name(sock), worker.index)
+        socket.send_fds(worker.channel, [b'A'], [sock.fileno()])
+        worker.associations += 1
+        sock.close()
+
+    def on_worker_message(self, worker):
+        while True:
+            try:
+                message = worker.channel.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            if not message:
+                self.worker_exited(worker)
+                return
+            kind, body = message[:1], message[1:]
+            if kind == b'D':
+                worker.associations -= 1
+            elif kind == b'M':  # the others hand over what they stored for it
+                for other in self.workers:
+                    if other is not worker:
+                        self.send(other, b'H' + body)
+            elif kind == b'U':
+                self.unbound.setdefault(body[4:], {})[worker.index] = struct.unpack('!I', body[:4])[0]
+            elif kind == b'B':
+                holders = self.unbound.get(body, {})
+                holders.pop(worker.index, None)
+                if not holders:
+                    self.unbound.pop(body, None)
+            elif kind == b'R':
+                worker.ready = True
+                if all(w.ready for w in self.workers):
+                    self.ready.set()
+            elif kind == b'P':
+                self.jobs.report(worker.index, *json.loads(body))
+            elif kind == b'T':
+                imsi = bytes.fromhex(json.loads(body)[0])
+                self.send(self.owner(imsi) or self.home(imsi), message)
+
+    def owner(self, imsi_ie):
+        entry = self.table.get(imsi_ie)
+        return None if entry is None else self.workers[entry[2]]
+
+    def home(self, imsi_ie):
+        """Worker storing the MT SMS for an IMSI no worker serves."""
+        return self.workers[int(decode_imsi(imsi_ie)) % len(self.workers)]
+
+    def send(self, worker, message):
+        try:
+            worker.channel.send(message)
+            return True
+        except BlockingIOError:
+            logging.warning("control channel to worker %d full", worker.index)
+            return False
+
+    def broadcast(self, line):
+        for worker in self.workers:
+            self.send(worker, b'C' + line.encode())
+
+    # MT SMS API, same interface as MtSmsDispatcher.submit
+    def submit(self, imsi, originator, text):
+        worker = self.owner(imsi)
+        if worker is None:
+            if not self.options.mt_store:
+                self.stats['rejected'] += 1
+                return "subscriber not registered"
+            worker = self.home(imsi)
+        if not self.send(worker, b'S' + json.dumps([imsi.hex(), originator, text]).encode()):
+            self.stats['rejected'] += 1
+            return "worker busy"
+        self.stats['submitted'] += 1
+        return None
+
+    def command(self, line, stop):
+        parts = line.split()
+        if line == "" or parts[:1] == ["q"]:
+            stop.set_result(None)
+        elif parts[:1] in (["trace"], ["untrace"], ["debug"], ["sample"]):
+            server.handle_command(line, stop)  # through BroadcastTrace, which tells the workers
+        elif parts[:1] == ["record"] and len(parts) == 2:
+            for worker in self.workers:
+                target = parts[1] if parts[1] == "off" else "%s.%d" % (parts[1], worker.index)
+                self.send(worker, b'C' + ("record %s" % target).encode())
+        elif parts[:1] == ["profile"] and len(parts) == 3:  # a file of stacks per worker
+            for worker in self.workers:
+                self.send(worker, b'C' + ("profile %s %s.%d" % (parts[1], parts[2], worker.index)).encode())
+        elif parts[:1] in (["5"], ["job"], ["jobs"], ["cancel"], ["mmes"], ["hss"], ["stages"],
+                           ["profile"]):  # every worker, for its own state
+            self.broadcast(line)
+        elif parts and parts[0].isdigit():
+            if len(parts) < 2:
+                logging.warning("give an IMSI with --workers")
+                return
+            worker = self.owner(encode_imsi(parts[1]))
+            if worker is None:
+                logging.warning("no worker serving %s", parts[1])
+            else:
+                self.send(worker, b'C' + line.encode())
+
+
+class BroadcastTrace(Trace):
+    """Trace of the parent: API changes are applied here (for GET /trace) and sent to every worker."""
+
+    def __init__(self, controller, level, sample_every):
+        super().__init__(level, sample_every)
+        self.controller = controller
+
+    def add(self, imsi_ie):
+        super().add(imsi_ie)
+        self.controller.broadcast("trace %s" % decode_imsi(imsi_ie))
+
+    def remove(self, imsi_ie):
+        super().remove(imsi_ie)
+        self.controller.broadcast("untrace %s" % decode_imsi(imsi_ie))
+
+    def set_sample(self, sample_every):
+        super().set_sample(sample_every)
+        self.controller.broadcast("sample %d" % sample_every)
+
+    def set_debug(self, on):
+        super().set_debug(on)
+        self.controller.broadcast("debug %s" % ("on" if on else "off"))
+
+
+class WorkerMetrics:
+    """The workers' /metrics for the parent's, samples labelled worker="N" and grouped by metric."""
+
+    def __init__(self, controller, address, port, timeout=2.0):
+        host = '127.0.0.1' if address in (None, '', '0.0.0.0') else address
+        self.urls = ["http://%s:%d/metrics" % (host, port + 1 + worker.index) for worker in controller.workers]
+        self.timeout = timeout
+        self.session = None
+
+    async def fetch(self, index, url):
+        try:
+            async with self.session.get(url) as response:
+                return index, await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.debug("metrics of worker %d: %r", index, e)
+            return index, ""
+
+    async def __call__(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        families = {}  # metric -> header lines, samples; in the order first seen
+        for index, text in await asyncio.gather(*(self.fetch(i, url) for i, url in enumerate(self.urls))):
+            label = 'worker="%d"' % index
+            family = None
+            for line in text.splitlines():
+                if line.startswith("# "):
+                    parts = line.split(None, 3)
+                    family = families.setdefault(parts[2], ([], []))
+                    if len(family[0]) < 2:
+                        family[0].append(line)
+                elif line and family is not None:
+                    name, brace, rest = line.partition('{')
+                    if brace:
+                        family[1].append("%s{%s,%s" % (name, label, rest))
+                    else:
+                        name, value = line.split(' ', 1)
+                        family[1].append("%s{%s} %s" % (name, label, value))
+        lines = []
+        for headers, samples in families.values():
+            lines += headers + samples
+        return "\n".join(lines) + "\n" if lines else ""
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+async def first_pdu(sock, framed):
+    """The first PDU of a new association, peeked so the worker still reads it; None if unreadable."""
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+    loop.add_reader(sock.fileno(), lambda: readable.done() or readable.set_result(None))
+    try:
+        await readable
+        data = sock.recv(65536, socket.MSG_PEEK)
+    except OSError:
+        return None
+    finally:
+        loop.remove_reader(sock.fileno())
+    if framed:
+        length = int.from_bytes(data[:2], 'big')
+        if len(data) < 2 + length:
+            return None
+        data = data[2:2 + length]
+    try:
+        return sgs_decode(data)
+    except SgsDecodeError:
+        return None
+
+
+def sock_name(sock):
+    try:
+        return "%s:%s" % sock.getpeername()[:2]
+    except OSError:
+        return "?"
+
+
+async def serve_parent(controller, options):
+    listen, framed = server.listening_socket(options)
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    try:
+        loop.add_reader(sys.stdin, lambda: controller.command(sys.stdin.readline(), stop))
+    except (OSError, ValueError):
+        logging.debug("stdin control disabled")
+    server.stop_on_sigterm(loop, stop)
+    server.profile_on_sigusr1(loop, controller.broadcast)  # the workers profile themselves
+    controller.ready = asyncio.Event()
+    controller.stop = stop
+    for worker in controller.workers:
+        loop.add_reader(worker.channel.fileno(), controller.on_worker_message, worker)
+
+    msisdn_map = load_msisdn_map(options.msisdn_map) if options.msisdn_map else {}
+    server.trace = BroadcastTrace(controller, logging.getLogger().level, options.log_sample)
+    api = await start_api(create_app(controller, server.trace, msisdn_map, controller.jobs), options.api_address,
+                          options.api_port, options.api_socket)
+
+    exporter = scrape = None
+    if options.metrics_port:
+        registry = Registry()
+        registry.add(Callback('sgs_workers', "Worker processes alive",
+                              lambda: sum(w.process.is_alive() for w in controller.workers)))
+        registry.add(Callback('sgs_worker_associations', "MME associations per worker", label='worker',
+                              fn=lambda: {w.index: w.associations for w in controller.workers}))
+        registry.add(Callback('sgs_shared_subscribers', "Subscribers in the shared table",
+                              lambda: len(controller.table)))
+        scrape = WorkerMetrics(controller, options.api_address, options.metrics_port)
+        exporter = await start_metrics(registry, options.api_address, options.metrics_port, scrape)
+
+    async def accept():
+        while True:
+            sock, address = await loop.sock_accept(listen)
+            if framed:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            loop.create_task(controller.route(sock, framed))
+
+    task = loop.create_task(accept())
+    try:
+        await stop
+    finally:
+        task.cancel()
+        await api.cleanup()
+        if exporter is not None:
+            await exporter.cleanup()
+            await scrape.close()
+        listen.close()
+
+
+def run_sharded(options):
+    """Start options.workers worker processes and serve as their parent until stopped."""
+    controller = Controller(options)
+    controller.start_workers()
+    logging.info("%d workers started, shared table of %d slots", len(controller.workers),
+                 controller.table.segments * controller.table.segment_size)
+    try:
+        asyncio.run(serve_parent(controller, options))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        controller.stop_workers()
+    if controller.failed:
+        sys.exit(1)
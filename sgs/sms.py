@@ -0,0 +1,291 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     SMS over SGs: CP (24.011), RP (24.011) and TP (23.040)
+#     -------------------------------------------------------
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import logging
+import time
+from collections import OrderedDict
+
+from gsm0338 import decode_user_data, encode_user_data, gsm_decode, is_gsm, pack_septets, to_septets
+from sgsap import decode_bcd, encode_bcd
+
+# CP message types
+CP_DATA = 0x01
+CP_ACK = 0x04
+CP_ERROR = 0x10
+
+# RP message types (MS -> network are even, network -> MS odd)
+RP_DATA_MS = 0x00
+RP_DATA_N = 0x01
+RP_ACK_MS = 0x02
+RP_ACK_N = 0x03
+RP_ERROR_MS = 0x04
+RP_ERROR_N = 0x05
+RP_SMMA = 0x06
+
+# TP message types (MS -> network)
+TP_SMS_DELIVER_REPORT = 0x00
+TP_SMS_SUBMIT = 0x01
+TP_SMS_COMMAND = 0x02
+
+# TP message types (network -> MS), 0x04 is TP-MMS (no more messages waiting)
+TP_SMS_DELIVER = 0x00
+
+# Longest single-part user data: 160 septets or 140 octets
+MAX_SEPTETS = 160
+MAX_OCTETS = 140
+
+# TP-VP length by TP-VPF: not present, enhanced, relative, absolute
+VP_LENGTH = (0, 7, 1, 7)
+VPF_NONE, VPF_ENHANCED, VPF_RELATIVE, VPF_ABSOLUTE = range(4)
+
+# UDH information elements for concatenated messages (8 and 16 bit reference)
+UDH_CONCAT_8 = 0x00
+UDH_CONCAT_16 = 0x08
+
+
+def decode_address(digits, toa, data):
+    """TP/RP address value to a string. Alphanumeric (TON 5) addresses are packed 7-bit text."""
+    if (toa >> 4) & 0x07 == 5:
+        return gsm_decode(data, digits * 4 // 7)
+    number = decode_bcd(data)[:digits]
+    return '+' + number if (toa >> 4) & 0x07 == 1 else number
+
+
+def encode_address(address):
+    """Number ('+' for international) or alphanumeric sender to (digit count, TOA, value)."""
+    if address.startswith('+') and address[1:].isdigit():
+        return len(address) - 1, 0x91, encode_bcd(address[1:])
+    if address.isdigit():
+        return len(address), 0x81, encode_bcd(address)
+    septets = to_septets(address[:11])
+    data = pack_septets(septets)
+    return (len(septets) * 7 + 3) // 4, 0xd0, data
+
+
+def build_sms_deliver(originator, text, scts):
+    """SMS-DELIVER TPDU (single part, TP-MMS set). scts is the 7 octet service centre time stamp.
+
+    Raises ValueError when the text does not fit into one SMS.
+    """
+    dcs, udl, ud = encode_user_data(text)
+    if (udl > MAX_SEPTETS) if is_gsm(text) else (udl > MAX_OCTETS):
+        raise ValueError("text too long for a single SMS")
+    digits, toa, oa = encode_address(originator)
+    return b''.join((bytes([TP_SMS_DELIVER | 0x04, digits, toa]), oa, bytes([0x00, dcs]), scts,
+                     bytes([udl]), ud))
+
+
+def build_rp_data(mr, smsc, tpdu):
+    """RP-DATA (network -> MS) from the SMSC number with an empty RP-DA."""
+    oa = encode_bcd(smsc)
+    return b''.join((bytes([RP_DATA_N, mr, len(oa) + 1, 0x91]), oa, bytes([0x00, len(tpdu)]), tpdu))
+
+
+def build_sms_submit_report(scts):
+    """SMS-SUBMIT-REPORT (RP-ACK case) with only the service centre time stamp."""
+    return bytes([TP_SMS_SUBMIT, 0x00]) + scts
+
+
+def build_rp_ack(mr, tpdu):
+    """RP-ACK (network -> MS) with an RP-User data IE carrying tpdu."""
+    return b''.join((bytes([RP_ACK_N, mr, 0x41, len(tpdu)]), tpdu))
+
+
+def build_cp_data(ti, rp):
+    """CP-DATA. ti includes the TI flag: 0-6 for transactions of the network, the received ti ^ 8 to answer the MS."""
+    return bytes([(ti & 0x0f) << 4 | 0x09, CP_DATA, len(rp)]) + rp
+
+
+def build_cp_ack(ti):
+    """CP-ACK, ti as for build_cp_data."""
+    return bytes([(ti & 0x0f) << 4 | 0x09, CP_ACK])
+
+
+def decode_scts(data):
+    """7 octet semi-octet time stamp (TP-SCTS, absolute TP-VP) to 'YYYY-MM-DDThh:mm:ss+hh:mm'."""
+    fields = [(b & 0x0f) * 10 + (b >> 4) for b in data[:6]]
+    tz = data[6]
+    quarters = (tz & 0x07) * 10 + (tz >> 4)
+    sign = '-' if tz & 0x08 else '+'
+    return "20%02d-%02d-%02dT%02d:%02d:%02d%s%02d:%02d" % tuple(
+        fields + [sign, quarters // 4, quarters % 4 * 15])
+
+
+def decode_relative_vp(vp):
+    """Relative TP-VP octet to seconds (23.040 9.2.3.12.1)."""
+    if vp <= 143:
+        return (vp + 1) * 300
+    if vp <= 167:
+        return 12 * 3600 + (vp - 143) * 1800
+    if vp <= 196:
+        return (vp - 166) * 86400
+    return (vp - 192) * 7 * 86400
+
+
+def decode_validity_period(vpf, data):
+    if vpf == VPF_RELATIVE:
+        return decode_relative_vp(data[0])
+    if vpf == VPF_ABSOLUTE:
+        return decode_scts(data)
+    if vpf == VPF_ENHANCED:
+        return bytes(data).hex()
+    return None
+
+
+def parse_udh(ud):
+    """User data header to ([(iei, value), ...], concatenation) where concatenation is
+    (reference, total, sequence) or None. ud starts at the UDHL octet."""
+    end = 1 + ud[0]
+    ies = []
+    concat = None
+    pointer = 1
+    while pointer + 2 <= end:
+        iei = ud[pointer]
+        value = ud[pointer + 2:pointer + 2 + ud[pointer + 1]]
+        pointer += 2 + ud[pointer + 1]
+        if pointer > end:
+            raise ValueError("UDH IE %d overruns header" % iei)
+        ies.append((iei, bytes(value)))
+        if iei == UDH_CONCAT_8 and len(value) == 3:
+            concat = (value[0], value[1], value[2])
+        elif iei == UDH_CONCAT_16 and len(value) == 4:
+            concat = (value[0] << 8 | value[1], value[2], value[3])
+    return ies, concat
+
+
+def parse_cp_data(nas):
+    """NAS message container of an UPLINK-UNITDATA to its CP and RP fields.
+
+    Always returns 'ti' and 'cp'; for CP-DATA also 'rp_mti' and 'rp_mr', and for RP-DATA (MS -> network)
+    'rp_da' (SMSC address) and 'tpdu'.
+    """
+    result = {'ti': nas[0] >> 4, 'cp': nas[1]}
+    if nas[1] != CP_DATA:
+        return result
+
+    rp = nas[3:3 + nas[2]]
+    result['rp_mti'] = rp[0] & 0x07
+    result['rp_mr'] = rp[1]
+    if result['rp_mti'] == RP_DATA_MS:
+        pointer = 3 + rp[2]  # RP-OA is empty from the MS
+        da_length = rp[pointer]
+        result['rp_da'] = decode_bcd(rp[pointer + 2:pointer + 1 + da_length]) if da_length else ''
+        pointer += 1 + da_length
+        result['tpdu'] = rp[pointer + 1:pointer + 1 + rp[pointer]]
+    return result
+
+
+def parse_tpdu(tpdu_bytes):
+    """Parses a GSM 03.40 TPDU message (SMS-SUBMIT)."""
+    first = tpdu_bytes[0]
+    tp_mti = first & 0x03  # Extract Message Type Indicator
+    if tp_mti != TP_SMS_SUBMIT:
+        return {"TP-MTI": tp_mti}
+
+    tp_rd = (first >> 2) & 0x01
+    tp_vpf = (first >> 3) & 0x03
+    tp_srr = (first >> 5) & 0x01
+    tp_udhi = (first >> 6) & 0x01
+    tp_rp = (first >> 7) & 0x01
+    tp_mr = tpdu_bytes[1]
+
+    da_digits = tpdu_bytes[2]
+    da_toa = tpdu_bytes[3]
+    pointer = 4 + (da_digits + 1) // 2
+    tp_da = decode_address(da_digits, da_toa, tpdu_bytes[4:pointer])
+
+    tp_pid = tpdu_bytes[pointer]  # Protocol Identifier
+    tp_dcs = tpdu_bytes[pointer + 1]  # Data Coding Scheme
+    pointer += 2
+    tp_vp = decode_validity_period(tp_vpf, tpdu_bytes[pointer:pointer + VP_LENGTH[tp_vpf]])
+    pointer += VP_LENGTH[tp_vpf]
+    tp_udl = tpdu_bytes[pointer]  # User-Data Length (septets for 7-bit, octets otherwise)
+    tp_user_data = tpdu_bytes[pointer + 1:]
+
+    udh, concat = parse_udh(tp_user_data) if tp_udhi else ([], None)
+    header_length = tp_user_data[0] + 1 if tp_udhi else 0
+    sms_text = decode_user_data(tp_dcs, tp_udl, tp_user_data, header_length)
+
+    return {
+        "TP-MTI": tp_mti,
+        "TP-RD": tp_rd,
+        "TP-SRR": tp_srr,
+        "TP-RP": tp_rp,
+        "TP-MR": tp_mr,
+        "TP-DA": tp_da,
+        "TP-PID": tp_pid,
+        "TP-DCS": tp_dcs,
+        "TP-VP": tp_vp,
+        "TP-UDL": tp_udl,
+        "UDH": udh,
+        "Concatenation": concat,  # (reference, total, sequence) or None
+        "SMS Text": sms_text
+    }
+
+
+class Reassembler:
+    """Joins concatenated SMS parts per (IMSI, reference).
+
+    Partial messages are kept in LRU order and dropped after timeout seconds or when more than
+    max_pending are open, so UEs that never send the last part cannot grow memory without bound.
+    """
+
+    def __init__(self, timeout=60.0, max_pending=10000):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.pending = OrderedDict()  # (imsi, reference) -> [deadline, total, {sequence: text}, first part]
+        self.stats = {'completed': 0, 'expired': 0, 'evicted': 0}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, imsi, parsed, now=None):
+        """Returns the complete message (parsed TPDU dict with the joined text) or None while parts are missing."""
+        concat = parsed.get("Concatenation")
+        if concat is None:
+            return parsed
+        reference, total, sequence = concat
+        if total <= 1:
+            return parsed
+        if not 1 <= sequence <= total:
+            logging.warning("SMS part %d/%d from %s ignored", sequence, total, imsi)
+            return None
+
+        now = time.monotonic() if now is None else now
+        self.expire(now)
+
+        key = (imsi, reference)
+        entry = self.pending.get(key)
+        if entry is None or entry[1] != total:
+            self.pending.pop(key, None)
+            entry = self.pending[key] = [now + self.timeout, total, {}, parsed]
+            if len(self.pending) > self.max_pending:
+                self.pending.popitem(last=False)
+                self.stats['evicted'] += 1
+        else:
+            self.pending.move_to_end(key)
+            entry[0] = now + self.timeout
+        entry[2][sequence] = parsed["SMS Text"]
+
+        if len(entry[2]) < total:
+            return None
+        del self.pending[key]
+        self.stats['completed'] += 1
+        message = dict(entry[3])
+        message["SMS Text"] = "".join(entry[2][i] for i in range(1, total + 1))
+        return message
+
+    def expire(self, now=None):
+        """Drop partial messages whose last part arrived more than timeout seconds ago."""
+        now = time.monotonic() if now is None else now
+        while self.pending:
+            key, entry = next(iter(self.pending.items()))
+            if entry[0] > now:
+                break
+            del self.pending[key]
+            self.stats['expired'] += 1
+            logging.info("incomplete SMS from %s dropped (%d of %d parts)", key[0], len(entry[2]), entry[1])
@@ -0,0 +1,165 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     MO SMS forwarding to the SMSC HTTP API
+#     --------------------------------------
+#
+#   -> forward() only enqueues, the SGs answer (RP-ACK) never waits for the SMSC
+#   -> one pooled ClientSession shared by a fixed number of workers
+#   -> messages with the same sender and body go out in one request ("to" list)
+#   -> full queue or failing SMSC: messages wait in a bounded spill queue; a batch that failed goes back
+#      in front of everything still waiting, in its order
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import aiohttp
+
+SMSC_API_URL = "https://smsc-api.vinoc.mx/api/v3/messages/send"
+
+
+class SmscForwarder:
+    def __init__(self, url, token=None, workers=8, queue_size=10000, spill_size=100000, batch_size=50,
+                 batch_window=0.02, timeout=10.0):
+        self.url = url
+        self.token = token
+        self.workers = workers
+        self.queue_size = queue_size
+        self.spill = deque(maxlen=spill_size)
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.timeout = timeout
+
+        self.queue = None
+        self.session = None
+        self.tasks = []
+        self.stats = {'forwarded': 0, 'failed': 0, 'spilled': 0, 'dropped': 0, 'requests': 0}
+
+    def start(self):
+        """Open the pooled session and start the workers (call from the running loop)."""
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        headers = {"Content-Type": "application/json", "accept": "application/json"}
+        if self.token:
+            headers["Authorization"] = "Bearer " + self.token
+        self.session = aiohttp.ClientSession(
+            headers=headers,
+            connector=aiohttp.TCPConnector(limit=self.workers, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(self.work()) for _ in range(self.workers)]
+        return self.tasks
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.session is not None:
+            await self.session.close()
+
+    def depth(self):
+        return (self.queue.qsize() if self.queue is not None else 0) + len(self.spill)
+
+    def forward(self, sender, recipient, text):
+        """Queue one MO SMS without waiting. Spilled messages keep their order behind older ones."""
+        message = (sender, recipient.replace('+', '').replace(' ', ''), text)
+        if self.spill:
+            self._refill()
+        if not self.spill:
+            try:
+                self.queue.put_nowait(message)
+                return
+            except asyncio.QueueFull:
+                pass
+        self._spill(message)
+
+    def _spill(self, message):
+        if len(self.spill) == self.spill.maxlen:
+            self.stats['dropped'] += 1  # deque drops the oldest message
+            logging.warning("SMSC spill queue full, dropping oldest MO SMS")
+        self.spill.append(message)
+        self.stats['spilled'] += 1
+
+    def _requeue(self, messages):
+        """Messages that failed, back in front of those queued and spilled since (which follow in their order)."""
+        waiting = []
+        while not self.queue.empty():
+            waiting.append(self.queue.get_nowait())
+        overflow = len(messages) + len(waiting) + len(self.spill) - self.spill.maxlen
+        if overflow > 0:
+            self.stats['dropped'] += overflow  # extendleft drops the newest
+            logging.warning("SMSC spill queue full, dropping %d newest MO SMS", overflow)
+        self.spill.extendleft(reversed(waiting))
+        self.spill.extendleft(reversed(messages))
+        self.stats['spilled'] += len(messages)
+
+    def _refill(self):
+        while self.spill and not self.queue.full():
+            self.queue.put_nowait(self.spill.popleft())
+
+    async def _collect(self):
+        """First message plus whatever arrives within batch_window, up to batch_size."""
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            if self.queue.empty():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(min(remaining, 0.005))
+                continue
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def work(self):
+        backoff = 0.0
+        while True:
+            if backoff:
+                await asyncio.sleep(backoff)
+            self._refill()
+            batch = await self._collect()
+
+            groups = {}
+            for sender, recipient, text in batch:
+                groups.setdefault((sender, text), []).append(recipient)
+
+            failed = set()
+            for (sender, text), recipients in groups.items():
+                if not await self._post(sender, text, recipients):
+                    failed.add((sender, text))
+
+            if failed:  # SMSC unavailable: park the messages and slow down
+                self._requeue([message for message in batch if (message[0], message[2]) in failed])
+                backoff = min(max(backoff * 2, 0.1), 5.0)
+            else:
+                backoff = 0.0
+
+    async def _post(self, sender, text, recipients):
+        """True when done (accepted or permanently rejected), False when worth retrying."""
+        payload = {"cid": sender, "body": text, "to": recipients, "encoding": "UCS2"}
+        self.stats['requests'] += 1
+        try:
+            async with self.session.post(self.url, json=payload) as response:
+                if response.status < 300:
+                    self.stats['forwarded'] += len(recipients)
+                    return True
+                body = await response.text()
+                if response.status < 500:
+                    self.stats['failed'] += len(recipients)
+                    logging.warning("SMSC rejected SMS from %s: %s %s", sender, response.status, body[:200])
+                    return True
+                logging.warning("SMSC error %s: %s", response.status, body[:200])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning("SMSC request failed: %r", e)
+        return False
+
+
+def forwarder_from_env(url=None, workers=8):
+    """Forwarder configured from SMSC_API_URL / SMSC_API_TOKEN, or None when neither url nor token is set."""
+    token = os.environ.get('SMSC_API_TOKEN')
+    url = url or os.environ.get('SMSC_API_URL')
+    if url is None and token is None:
+        return None
+    return SmscForwarder(url or SMSC_API_URL, token, workers=workers)
@@ -0,0 +1,237 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     SGs subscriber table
+#     --------------------
+#
+#   -> one record per IMSI (keyed by the encoded IMSI IE)
+#   -> reverse indexes TMSI -> IMSI, MME -> IMSIs and LAI -> IMSIs
+#   -> the MME index is partitioned: IMSIs confirmed by a location update, and IMSIs whose MME has reset
+#      or lost its association since (29.118 "MME-Reset"); marking an MME moves its whole set, and the
+#      next location update of a subscriber moves it back
+#   -> UE-UNREACHABLE keeps the record (paging a stored MT SMS later needs its TMSI, LAI and MME), the
+#      IMSI is only marked unreachable until the UE is active again or makes a location update
+#   -> TMSIs come from a TmsiAllocator and go back to it when a subscriber leaves
+#   -> mirrors (put(sub) / delete(imsi)) are told about every change: the shared table of shard.py,
+#      the change log of snapshot.py
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import itertools
+
+from tmsi import TmsiAllocator
+
+
+class Subscriber:
+    """SGs association state of one UE. LAI and MME values are interned, so records share them."""
+
+    __slots__ = ('imsi', 'tmsi', 'lai', 'mme')
+
+    def __init__(self, imsi, tmsi=None, lai=None, mme=None):
+        self.imsi = imsi  # IMSI IE (b'\x01' + len + digits)
+        self.tmsi = tmsi  # int or None
+        self.lai = lai    # LAI IE (b'\x04\x05' + 5 bytes)
+        self.mme = mme    # MME name IE (b'\x09' + len + name)
+
+    def __repr__(self):
+        return "Subscriber(imsi=%s, tmsi=%s, lai=%s, mme=%s)" % (
+            self.imsi.hex(), self.tmsi, self.lai and self.lai.hex(), self.mme and self.mme[2:])
+
+
+class SubscriberStore:
+    def __init__(self, tmsis=None):
+        self.by_imsi = {}
+        self.by_tmsi = {}
+        self.by_mme = {}
+        self.unconfirmed = {}  # MME -> IMSIs not seen since that MME reset or went away
+        self.by_lai = {}
+        self.unreachable = set()  # IMSIs reported unreachable by their MME since they were last active
+        self._interned = {}
+        self.mirrors = []
+        self.tmsis = tmsis if tmsis is not None else TmsiAllocator()
+
+    def __len__(self):
+        return len(self.by_imsi)
+
+    def __contains__(self, imsi):
+        return imsi in self.by_imsi
+
+    def _intern(self, value):
+        if value is None:
+            return None
+        return self._interned.setdefault(value, value)
+
+    def get(self, imsi):
+        return self.by_imsi.get(imsi)
+
+    def find_tmsi(self, tmsi):
+        imsi = self.by_tmsi.get(tmsi)
+        return None if imsi is None else self.by_imsi[imsi]
+
+    def subscribers_of(self, mme):
+        imsis = itertools.chain(self.by_mme.get(mme, ()), self.unconfirmed.get(mme, ()))
+        return [self.by_imsi[imsi] for imsi in imsis]
+
+    def imsis_in(self, lai):
+        """IMSIs last seen in a LAI (IE), as a list."""
+        return list(self.by_lai.get(lai, ()))
+
+    def mmes(self):
+        """{MME name IE: (confirmed, unconfirmed)} subscriber counts."""
+        return {mme: (len(self.by_mme.get(mme, ())), len(self.unconfirmed.get(mme, ())))
+                for mme in self.by_mme.keys() | self.unconfirmed.keys()}
+
+    def confirmed(self, sub):
+        return sub.mme is not None and sub.imsi in self.by_mme.get(sub.mme, ())
+
+    def count_unconfirmed(self):
+        return sum(len(imsis) for imsis in self.unconfirmed.values())
+
+    def mark_unconfirmed(self, mme):
+        """An MME reset or went away: its subscribers stay, unconfirmed until their next location update.
+        Moves the MME's set (merging the smaller into the larger if some were already unconfirmed).
+        Returns the number of subscribers newly marked."""
+        imsis = self.by_mme.pop(mme, None)
+        if imsis is None:
+            return 0
+        marked = len(imsis)
+        previous = self.unconfirmed.get(mme)
+        if previous is None:
+            self.unconfirmed[mme] = imsis
+        elif len(previous) >= marked:
+            previous |= imsis
+        else:
+            imsis |= previous
+            self.unconfirmed[mme] = imsis
+        return marked
+
+    def mark_unreachable(self, imsi):
+        """UE-UNREACHABLE for a known IMSI; False if there is no record of it."""
+        if imsi not in self.by_imsi:
+            return False
+        self.unreachable.add(imsi)
+        return True
+
+    def reachable(self, imsi):
+        """The UE showed activity (UE-ACTIVITY-INDICATION, ALERT-ACK)."""
+        self.unreachable.discard(imsi)
+
+    def update(self, imsi, lai, mme):
+        """Create or refresh the record of an IMSI after a location update."""
+        imsi = bytes(imsi)
+        lai = self._intern(bytes(lai))
+        mme = self._intern(bytes(mme)) if mme is not None else None
+
+        self.unreachable.discard(imsi)
+        sub = self.by_imsi.get(imsi)
+        if sub is None:
+            sub = self.by_imsi[imsi] = Subscriber(imsi)
+        elif sub.mme is not None and (sub.mme != mme or sub.imsi in self.unconfirmed.get(mme, ())):
+            self._unlink_mme(sub)
+
+        if sub.lai is not lai:
+            self._unlink(self.by_lai, sub.lai, imsi)
+            sub.lai = lai
+            self.by_lai.setdefault(lai, set()).add(imsi)
+        if mme is not None and sub.mme != mme:
+            sub.mme = mme
+            self.by_mme.setdefault(mme, set()).add(imsi)
+        for mirror in self.mirrors:
+            mirror.put(sub)
+        return sub
+
+    def restore(self, imsi, tmsi, lai, mme):
+        """Insert a saved record as is (snapshot loading); mirrors are not told."""
+        self.discard(imsi)
+        sub = self.by_imsi[imsi] = Subscriber(imsi, tmsi, self._intern(lai), self._intern(mme))
+        if tmsi is not None:
+            self.by_tmsi[tmsi] = imsi
+            self.tmsis.mark(tmsi)
+        if sub.mme is not None:
+            self.by_mme.setdefault(sub.mme, set()).add(imsi)
+        if sub.lai is not None:
+            self.by_lai.setdefault(sub.lai, set()).add(imsi)
+        return sub
+
+    def restore_all(self, records):
+        """Fill an empty store with saved records (IMSI IE, TMSI, LAI IE, MME name IE), in one pass that builds
+        every index (snapshot loading). Equal LAI and MME IEs must be the same objects; mirrors are not told."""
+        if self.by_imsi:
+            for record in records:
+                self.restore(*record)
+            return
+        by_imsi, by_tmsi = self.by_imsi, self.by_tmsi
+        by_mme, by_lai = {}, {}  # lists first, sets once complete
+        tmsis = []
+        for imsi, tmsi, lai, mme in records:
+            by_imsi[imsi] = Subscriber(imsi, tmsi, lai, mme)
+            if tmsi is not None:
+                by_tmsi[tmsi] = imsi
+                tmsis.append(tmsi)
+            if mme is not None:
+                members = by_mme.get(mme)
+                if members is None:
+                    members = by_mme[mme] = []
+                members.append(imsi)
+            if lai is not None:
+                members = by_lai.get(lai)
+                if members is None:
+                    members = by_lai[lai] = []
+                members.append(imsi)
+        self.tmsis.mark_all(tmsis)
+        for index, groups in ((self.by_mme, by_mme), (self.by_lai, by_lai)):
+            for key, members in groups.items():
+                index[key] = set(members)
+                self._interned[key] = key
+
+    def set_tmsi(self, sub, tmsi):
+        if sub.tmsi is not None and self.by_tmsi.get(sub.tmsi) == sub.imsi:
+            del self.by_tmsi[sub.tmsi]
+            self.tmsis.release(sub.tmsi)
+        sub.tmsi = tmsi
+        if tmsi is not None:
+            self.by_tmsi[tmsi] = sub.imsi
+            self.tmsis.mark(tmsi)
+        for mirror in self.mirrors:
+            mirror.put(sub)
+
+    def assign_tmsi(self, sub):
+        """Give sub a TMSI unless it has one. Returns the TMSI, None when the TMSI space is exhausted."""
+        if sub.tmsi is None:
+            tmsi = self.tmsis.allocate()
+            if tmsi is not None:
+                self.set_tmsi(sub, tmsi)
+        return sub.tmsi
+
+    def evict(self, imsi):
+        """Forget an IMSI (detached). Returns the removed record or None."""
+        sub = self.discard(bytes(imsi))
+        if sub is not None:
+            for mirror in self.mirrors:
+                mirror.delete(sub.imsi)
+        return sub
+
+    def discard(self, imsi):
+        """Remove a record without telling the mirrors (log replay)."""
+        sub = self.by_imsi.pop(imsi, None)
+        if sub is None:
+            return None
+        self.unreachable.discard(imsi)
+        if sub.tmsi is not None and self.by_tmsi.get(sub.tmsi) == sub.imsi:
+            del self.by_tmsi[sub.tmsi]
+            self.tmsis.release(sub.tmsi)
+        self._unlink_mme(sub)
+        self._unlink(self.by_lai, sub.lai, imsi)
+        return sub
+
+    def _unlink_mme(self, sub):
+        self._unlink(self.by_mme, sub.mme, sub.imsi)
+        self._unlink(self.unconfirmed, sub.mme, sub.imsi)
+        sub.mme = None
+
+    @staticmethod
+    def _unlink(index, key, imsi):
+        members = index.get(key)
+        if members is not None:
+            members.discard(imsi)
+            if not members:
+                del index[key]
@@ -0,0 +1,126 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     Hierarchical timer wheel
+#     ------------------------
+#
+#   -> levels of 256 slots: level 0 holds the next 256 ticks, level n slots span 256**n ticks
+#   -> schedule and cancel are O(1); cancelled timers are only flagged and dropped when their slot comes up
+#   -> a tick touches one level 0 slot, every 256 ticks one higher slot is spread down (cascade)
+#   -> one task drives the wheel, and it sleeps while no timer is pending
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import asyncio
+import logging
+import time
+
+BITS = 8
+SIZE = 1 << BITS
+MASK = SIZE - 1
+
+
+class Timer:
+    __slots__ = ('wheel', 'expires', 'callback', 'args')
+
+    def __init__(self, wheel, expires, callback, args):
+        self.wheel = wheel
+        self.expires = expires  # absolute tick
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        if self.callback is not None:
+            self.callback = None
+            self.args = None
+            self.wheel.pending -= 1
+
+    def cancelled(self):
+        return self.callback is None
+
+
+class TimerWheel:
+    def __init__(self, tick=0.01, levels=4):
+        self.tick = tick
+        self.levels = levels
+        self.wheels = [[[] for _ in range(SIZE)] for _ in range(levels)]
+        self.horizon = (1 << (BITS * levels)) - 1
+        self.origin = time.monotonic()
+        self.current = 0  # next tick to process
+        self.pending = 0
+        self.fired = 0
+        self.wakeup = None
+
+    def __len__(self):
+        return self.pending
+
+    def now(self):
+        return int((time.monotonic() - self.origin) / self.tick)
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) after delay seconds (rounded up to the tick). Returns the Timer."""
+        now = self.now()
+        if not self.pending:  # idle wheel: skip the empty ticks before placing
+            self.current = max(self.current, now)
+        expires = max(now + int(delay / self.tick + 0.999999), self.current)
+        timer = Timer(self, expires, callback, args)
+        self._place(timer)
+        self.pending += 1
+        if self.wakeup is not None and not self.wakeup.done():
+            self.wakeup.set_result(None)
+        return timer
+
+    def _place(self, timer):
+        delta = min(timer.expires - self.current, self.horizon)
+        for level in range(self.levels):
+            if delta < 1 << (BITS * (level + 1)):
+                self.wheels[level][(timer.expires >> (BITS * level)) & MASK].append(timer)
+                return
+
+    def _cascade(self):
+        for level in range(1, self.levels):
+            index = (self.current >> (BITS * level)) & MASK
+            slot = self.wheels[level][index]
+            self.wheels[level][index] = []
+            for timer in slot:
+                if timer.callback is not None:
+                    self._place(timer)
+            if index:
+                break
+
+    def advance(self, until=None):
+        """Fire everything due up to tick until (default: now). Returns the number fired."""
+        until = self.now() if until is None else until
+        fired = 0
+        while self.current <= until:
+            index = self.current & MASK
+            if index == 0 and self.current:
+                self._cascade()
+            slot = self.wheels[0][index]
+            self.wheels[0][index] = []
+            self.current += 1
+            for timer in slot:
+                callback = timer.callback
+                if callback is None:
+                    continue
+                timer.callback = None
+                self.pending -= 1
+                fired += 1
+                try:
+                    callback(*timer.args)
+                except Exception:
+                    logging.exception("timer callback %r failed", callback)
+            if not self.pending:  # nothing left: jump ahead instead of walking empty slots
+                self.current = max(self.current, until + 1)
+                break
+        self.fired += fired
+        return fired
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.pending:
+                self.wakeup = loop.create_future()
+                await self.wakeup
+                self.wakeup = None
+            await asyncio.sleep(self.tick)
+            self.advance()
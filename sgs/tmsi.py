@@ -0,0 +1,99 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+#     TMSI allocation
+#     ---------------
+#
+#   -> TMSI bits 31..30 stay 00 (CS domain), bits 23..(24 - nri_bits) carry the NRI (23.236),
+#      the remaining bits number the TMSIs of this server
+#   -> allocate / release in O(1): FIFO free list of released numbers, then never used ones;
+#      a bitmap of numbers in use catches double use after a restore
+#   -> a partition (index, count) splits the numbers between worker processes
+#
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+from collections import deque
+
+
+class TmsiAllocator:
+    def __init__(self, nri=0, nri_bits=0, capacity=1 << 24, partition=(0, 1)):
+        if not 0 <= nri_bits <= 10 or nri >= 1 << nri_bits:
+            raise ValueError("NRI %d does not fit into %d bits" % (nri, nri_bits))
+        self.low_bits = 24 - nri_bits
+        self.nri_field = nri << self.low_bits
+        self.capacity = min(capacity, 1 << (30 - nri_bits))
+        self.index, self.count = partition
+        self.used = bytearray((self.capacity + 7) // 8)
+        self.free = deque()
+        self.next = 0  # next never used number of this partition (times count, plus index)
+        self.allocated = 0
+
+    def __len__(self):
+        return self.allocated
+
+    def to_tmsi(self, number):
+        low = number & ((1 << self.low_bits) - 1)
+        return (number >> self.low_bits) << 24 | self.nri_field | low
+
+    def to_number(self, tmsi):
+        """Number behind a TMSI of this allocator, or None for foreign TMSIs."""
+        if tmsi >> 30 or (tmsi & ((1 << 24) - 1)) >> self.low_bits != self.nri_field >> self.low_bits:
+            return None
+        number = (tmsi >> 24) << self.low_bits | tmsi & ((1 << self.low_bits) - 1)
+        return number if number < self.capacity else None
+
+    def _is_used(self, number):
+        return self.used[number >> 3] >> (number & 7) & 1
+
+    def allocate(self):
+        """A TMSI not in use, or None when the space is exhausted."""
+        while self.free:
+            number = self.free.popleft()
+            if not self._is_used(number):  # may have been taken by mark() since its release
+                return self._take(number)
+        while True:
+            number = self.next * self.count + self.index
+            if number >= self.capacity:
+                return None
+            self.next += 1
+            if not self._is_used(number):
+                return self._take(number)
+
+    def _take(self, number):
+        self.used[number >> 3] |= 1 << (number & 7)
+        self.allocated += 1
+        return self.to_tmsi(number)
+
+    def release(self, tmsi):
+        number = self.to_number(tmsi)
+        if number is None or not self._is_used(number):
+            return
+        self.used[number >> 3] &= ~(1 << (number & 7)) & 0xff
+        self.allocated -= 1
+        if number % self.count == self.index:
+            self.free.append(number)
+
+    def mark_all(self, tmsis):
+        """mark() for many TMSIs, at a fraction of the cost per TMSI."""
+        used = self.used
+        low_bits = self.low_bits
+        low_mask = (1 << low_bits) - 1
+        nri = self.nri_field >> low_bits
+        capacity = self.capacity
+        marked = 0
+        for tmsi in tmsis:
+            if tmsi >> 30 or (tmsi & 0xffffff) >> low_bits != nri:
+                continue
+            number = (tmsi >> 24) << low_bits | tmsi & low_mask
+            if number < capacity:
+                bit = 1 << (number & 7)
+                if not used[number >> 3] & bit:
+                    used[number >> 3] |= bit
+                    marked += 1
+        self.allocated += marked
+
+    def mark(self, tmsi):
+        """Record a TMSI restored from saved state as in use."""
+        number = self.to_number(tmsi)
+        if number is not None and not self._is_used(number):
+            self.used[number >> 3] |= 1 << (number & 7)
+            self.allocated += 1